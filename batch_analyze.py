@@ -0,0 +1,198 @@
+""" Headless batch analyzer for collections of EXPLAIN (FORMAT JSON) outputs. Does not import PySide6.
+
+Usage:
+    python batch_analyze.py plans_dir/ -o costs.csv
+    python batch_analyze.py workload.jsonl -o costs.parquet --workers 8
+    cat workload.jsonl | python batch_analyze.py - -o costs.csv
+    python batch_analyze.py analyze_plans/ --calibrate
+    python batch_analyze.py analyze_plans/ --validate
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from explain import (
+    flatten_plans, compute_expected_costs, cost_params, PlanNode, calibrate_cost_params, cost_params_sql,
+    decode_json, validate_cost_model
+)
+
+
+def read_plans(source):
+    """ Yields (source name, EXPLAIN JSON text) from a directory of .json files, a JSONL file, or '-' for
+    a JSONL stream on stdin. JSONL lines are named <file>:<line number>. """
+    if source != '-' and os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.endswith('.json'):
+                with open(os.path.join(source, name), 'r') as json_file:
+                    yield name, json_file.read()
+        return
+
+    stream = sys.stdin if source == '-' else open(source, 'r')
+    try:
+        for line_no, line in enumerate(stream, start=1):
+            if line.strip():
+                yield f"{source}:{line_no}", line
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def root_plan(plan_data):
+    """ Returns the root 'Plan' dict of an EXPLAIN JSON result, or of a single auto_explain plan object. """
+    if isinstance(plan_data, list):
+        plan_data = plan_data[0]
+    return plan_data['Plan']
+
+
+def analyze_shard(shard):
+    """ Computes expected cost, actual cost and discrepancy for every node of a shard of plans.
+    Runs in a worker process and returns one DataFrame row per plan node. """
+    sources, roots = [], []
+    for source, plan_text in shard:
+        try:
+            roots.append(root_plan(decode_json(plan_text)))
+            sources.append(source)
+        except (ValueError, KeyError, IndexError, TypeError) as error:
+            print(f"Skipping {source}: {error}", file=sys.stderr)
+
+    def skip(index, error):
+        print(f"Skipping {sources[index]}: {error!r}", file=sys.stderr)
+
+    node_table = flatten_plans(roots, on_error=skip)
+    plan_index = node_table['plan']
+    expected_costs, discrepancies = compute_expected_costs(node_table, cost_params)
+    rows = {
+        'Source': np.array(sources, dtype=object)[plan_index],
+        'Node Index': np.arange(len(plan_index)) - np.searchsorted(plan_index, plan_index),  # row within its plan
+        'Node Type': node_table['node_type_name'],
+        'Expected Cost': expected_costs,
+        'Actual Cost': node_table['total_cost'],
+        'Discrepancy': discrepancies,
+    }
+    return pd.DataFrame(rows)
+
+
+def shards(plans, shard_size):
+    plans = iter(plans)
+    while True:
+        shard = list(itertools.islice(plans, shard_size))
+        if not shard:
+            return
+        yield shard
+
+
+class ResultWriter:
+    """ Appends result frames to a CSV or Parquet file as they arrive. """
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith('.parquet')
+        self.parquet_writer = None
+        self.header = True
+
+    def write(self, df):
+        if not self.parquet:
+            df.to_csv(self.path, mode='w' if self.header else 'a', header=self.header, index=False)
+            self.header = False
+            return
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Error: writing Parquet requires pyarrow (pip install pyarrow).")
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        if self.parquet_writer is None:
+            self.parquet_writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.parquet_writer.write_table(table)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def calibrate(source):
+    """ Fits cost_params to the node times of EXPLAIN ANALYZE plans and prints them with SET statements. """
+    roots = []
+    for name, plan_text in read_plans(source):
+        try:
+            roots.append(PlanNode(root_plan(decode_json(plan_text))))
+        except (ValueError, KeyError, IndexError, TypeError) as error:
+            print(f"Skipping {name}: {error}", file=sys.stderr)
+
+    result = calibrate_cost_params(roots)
+    if result is None:
+        raise SystemExit("Error: no plan nodes with EXPLAIN ANALYZE timing data to calibrate on.")
+    print(f"-- fitted on {result['nodes']} nodes of {len(roots)} plans: RMSE {result['rmse']:.3f} ms per node, "
+          f"R^2 {result['r2']:.3f}, {result['ms_per_cost_unit']:.4f} ms per cost unit")
+    if result['fixed']:
+        print(f"-- no data for {', '.join(result['fixed'])}, left unchanged")
+    if result['undetermined']:
+        print(f"-- not determined (zero weight or collinear) {', '.join(result['undetermined'])}, left unchanged")
+    print(cost_params_sql(result['params']))
+
+
+def validate(source):
+    """ Prints how closely the expected costs follow the planner's Total Cost, per node type. """
+    names, roots = [], []
+    for name, plan_text in read_plans(source):
+        try:
+            roots.append(root_plan(decode_json(plan_text)))
+            names.append(name)
+        except (ValueError, KeyError, IndexError, TypeError) as error:
+            print(f"Skipping {name}: {error}", file=sys.stderr)
+    skipped = []
+
+    def skip(index, error):
+        skipped.append(index)
+        print(f"Skipping {names[index]}: {error!r}", file=sys.stderr)
+
+    summary = validate_cost_model(roots, on_error=skip)
+    if len(skipped) == len(roots):
+        raise SystemExit("Error: no plans to validate on.")
+    print(f"-- {int(summary['nodes'].sum())} nodes of {len(roots) - len(skipped)} plans")
+    print(summary.to_string(float_format=lambda value: f"{value:.3f}"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute expected vs actual cost for every node of many plans.")
+    parser.add_argument('source', help="directory of .json EXPLAIN outputs, a .jsonl file, or - for stdin")
+    parser.add_argument('-o', '--output', help="output file, .csv or .parquet")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument('--shard-size', type=int, default=500, help="plans per worker task")
+    parser.add_argument('--calibrate', action='store_true',
+                        help="fit cost_params to the measured times of EXPLAIN ANALYZE plans instead")
+    parser.add_argument('--validate', action='store_true',
+                        help="report how well expected costs match Total Cost per node type instead")
+    args = parser.parse_args(argv)
+
+    if args.calibrate:
+        calibrate(args.source)
+        return
+    if args.validate:
+        validate(args.source)
+        return
+    if args.output is None:
+        parser.error("the following arguments are required: -o/--output")
+
+    writer = ResultWriter(args.output)
+    n_nodes = 0
+    try:
+        with multiprocessing.Pool(args.workers) as pool:
+            # imap keeps shard order, so output rows follow input order
+            for df in pool.imap(analyze_shard, shards(read_plans(args.source), args.shard_size)):
+                if not df.empty:
+                    writer.write(df)
+                    n_nodes += len(df)
+    finally:
+        writer.close()
+    print(f"Wrote {n_nodes} plan nodes to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
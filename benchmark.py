@@ -0,0 +1,420 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from collections import deque
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from explain import (
+    build_plan, parse_plan, extract_nodes, extract_node_types, expected_plan_costs, compute_expected_costs,
+    flatten_plans, cost_params, decode_json, fetch_plan_text, set_json_decoder, JSON_DECODERS
+)
+
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'csv files', 'CREATE TABLE QUERIES')
+
+# Creation order respects the foreign keys between the TPC-H tables
+TPCH_TABLES = ['region', 'nation', 'supplier', 'customer', 'part', 'partsupp', 'orders', 'lineitem']
+
+# Synthetic TPC-H style data generated server-side, {sf} is the scale factor.
+# Row counts follow the TPC-H ratios (150k customers, 1.5M orders, ~6M lineitems per unit of scale).
+TPCH_DATA = {
+    'region': """
+        INSERT INTO region
+        SELECT i, (ARRAY['AFRICA', 'AMERICA', 'ASIA', 'EUROPE', 'MIDDLE EAST'])[i + 1], md5(i::text)
+        FROM generate_series(0, 4) i""",
+    'nation': """
+        INSERT INTO nation
+        SELECT i, 'NATION' || i, i % 5, md5(i::text)
+        FROM generate_series(0, 24) i""",
+    'supplier': """
+        INSERT INTO supplier
+        SELECT i, 'Supplier#' || lpad(i::text, 9, '0'), md5(i::text), i % 25, '10-' || lpad(i::text, 12, '0'),
+               round((random() * 10999 - 999)::numeric, 2), md5(random()::text)
+        FROM generate_series(1, greatest(1, (10000 * {sf})::int)) i""",
+    'customer': """
+        INSERT INTO customer
+        SELECT i, 'Customer#' || lpad(i::text, 9, '0'), md5(i::text), i % 25, '20-' || lpad(i::text, 12, '0'),
+               round((random() * 10999 - 999)::numeric, 2),
+               (ARRAY['AUTOMOBILE', 'BUILDING', 'FURNITURE', 'HOUSEHOLD', 'MACHINERY'])[1 + i % 5],
+               md5(random()::text)
+        FROM generate_series(1, greatest(1, (150000 * {sf})::int)) i""",
+    'part': """
+        INSERT INTO part
+        SELECT i, md5(i::text), 'Manufacturer#' || (1 + i % 5), 'Brand#' || (1 + i % 5) || (1 + i % 5),
+               (ARRAY['STANDARD', 'SMALL', 'MEDIUM', 'LARGE', 'ECONOMY', 'PROMO'])[1 + i % 6] || ' BRASS',
+               1 + i % 50, (ARRAY['SM BOX', 'MED BAG', 'LG CASE', 'JUMBO PKG', 'WRAP DRUM'])[1 + i % 5],
+               round((900 + (i % 20001) / 10.0)::numeric, 2), left(md5(random()::text), 23)
+        FROM generate_series(1, greatest(1, (200000 * {sf})::int)) i""",
+    'partsupp': """
+        INSERT INTO partsupp
+        SELECT p.p_partkey, 1 + (p.p_partkey + j * greatest(1, s.n / 4)) % s.n, (random() * 9998 + 1)::int,
+               round((random() * 999 + 1)::numeric, 2), md5(random()::text)
+        FROM part p, (SELECT count(*)::int AS n FROM supplier) s, generate_series(0, least(3, s.n - 1)) j""",
+    'orders': """
+        INSERT INTO orders
+        SELECT i, 1 + (i * 7919) % c.n, (ARRAY['F', 'O', 'P'])[1 + i % 3], round((random() * 500000)::numeric, 2),
+               date '1992-01-01' + (random() * 2400)::int,
+               (ARRAY['1-URGENT', '2-HIGH', '3-MEDIUM', '4-NOT SPECIFIED', '5-LOW'])[1 + i % 5],
+               'Clerk#' || lpad((i % 1000)::text, 9, '0'), 0, md5(random()::text)
+        FROM generate_series(1, greatest(1, (1500000 * {sf})::int)) i, (SELECT count(*)::int AS n FROM customer) c""",
+    'lineitem': """
+        INSERT INTO lineitem
+        SELECT o.o_orderkey, 1 + (o.o_orderkey * 31 + ln) % p.n, 1 + (o.o_orderkey + ln) % s.n, ln,
+               1 + (random() * 49)::int, round((random() * 100000)::numeric, 2), round((random() * 0.1)::numeric, 2),
+               round((random() * 0.08)::numeric, 2), (ARRAY['A', 'N', 'R'])[1 + ln % 3], (ARRAY['F', 'O'])[1 + ln % 2],
+               o.o_orderdate + 1 + ln, o.o_orderdate + 30 + ln, o.o_orderdate + 31 + ln,
+               (ARRAY['DELIVER IN PERSON', 'COLLECT COD', 'NONE', 'TAKE BACK RETURN'])[1 + ln % 4],
+               (ARRAY['REG AIR', 'AIR', 'RAIL', 'SHIP', 'TRUCK', 'MAIL', 'FOB'])[1 + ln % 7], left(md5(random()::text), 44)
+        FROM orders o, (SELECT count(*)::int AS n FROM part) p, (SELECT count(*)::int AS n FROM supplier) s,
+             generate_series(1, 1 + o.o_orderkey % 7) ln""",
+}
+
+# Queries timed by the pipeline benchmark when none are given on the command line
+DEFAULT_QUERIES = [
+    "SELECT l_returnflag, l_linestatus, sum(l_quantity), avg(l_extendedprice) FROM lineitem "
+    "WHERE l_shipdate <= date '1998-09-01' GROUP BY l_returnflag, l_linestatus ORDER BY l_returnflag, l_linestatus",
+    "SELECT c.c_name, o.o_orderdate, o.o_totalprice FROM customer c JOIN orders o ON o.o_custkey = c.c_custkey "
+    "WHERE o.o_totalprice > 10000",
+    "SELECT n.n_name, sum(l.l_extendedprice * (1 - l.l_discount)) FROM lineitem l "
+    "JOIN orders o ON l.l_orderkey = o.o_orderkey JOIN supplier s ON l.l_suppkey = s.s_suppkey "
+    "JOIN nation n ON s.s_nationkey = n.n_nationkey GROUP BY n.n_name",
+]
+
+NODE_TYPES = ['Seq Scan', 'Index Scan', 'Hash Join', 'Hash', 'Nested Loop', 'Aggregate', 'Memoize', 'Append']
+RELATIONS = ['lineitem', 'orders', 'customer', 'supplier', 'part', 'partsupp', 'nation', 'region']
+
+
+def synthetic_plan(n_nodes, max_children=3, seed=0):
+    """ Generates a decoded EXPLAIN (FORMAT JSON, ANALYZE, BUFFERS) result with n_nodes plan nodes. """
+    rng = random.Random(seed)
+
+    def make_node():
+        rows = rng.randint(1, 10_000_000)
+        return {
+            'Node Type': rng.choice(NODE_TYPES),
+            'Parallel Aware': False,
+            'Async Capable': False,
+            'Relation Name': rng.choice(RELATIONS),
+            'Alias': 'x',
+            'Startup Cost': rng.uniform(0, 1000),
+            'Total Cost': rng.uniform(1000, 1e7),
+            'Plan Rows': rows,
+            'Plan Width': rng.randint(4, 200),
+            'Actual Startup Time': rng.uniform(0, 100),
+            'Actual Total Time': rng.uniform(100, 30000),
+            'Actual Rows': rows + rng.randint(-rows // 10, rows // 10),
+            'Actual Loops': 1,
+            'Shared Hit Blocks': rng.randint(0, 100_000),
+            'Shared Read Blocks': rng.randint(0, 100_000),
+            'Shared Written Blocks': 0,
+        }
+
+    # Grow the tree breadth-first, plans of a realistic shape (see deep_plan for the worst case)
+    root = make_node()
+    frontier = deque([root])
+    created = 1
+    while created < n_nodes:
+        parent = frontier.popleft()
+        parent['Plans'] = []
+        for _ in range(min(rng.randint(1, max_children), n_nodes - created)):
+            child = make_node()
+            child['Parent Relationship'] = 'Outer' if not parent['Plans'] else 'Inner'
+            parent['Plans'].append(child)
+            frontier.append(child)
+            created += 1
+    return [{'Plan': root, 'Planning Time': 1.0, 'Triggers': [], 'Execution Time': 1.0}]
+
+
+def deep_plan(depth):
+    """ A decoded EXPLAIN result whose plan is a single chain of depth + 1 Nested Loop nodes. Built directly
+    rather than through json.loads, which itself refuses nesting this deep. """
+    root = node = {'Node Type': 'Nested Loop', 'Startup Cost': 0.0, 'Total Cost': 1.0, 'Plan Rows': 1,
+                   'Plan Width': 4, 'Actual Total Time': 1.0, 'Actual Rows': 1}
+    for _ in range(depth):
+        child = dict(node)
+        child.pop('Plans', None)
+        node['Plans'] = [child]
+        node = child
+    return [{'Plan': root}]
+
+
+def measure(func, *args):
+    """ Runs func once and returns (seconds, peak traced memory in bytes). """
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def json_round_trips(plan_data):
+    """ The per-submit plan handling before the plan model: re-encode in explain_query, decode in showPlan and
+    update_explain_table, then parse_plan and extract_nodes each walking the tree into new dicts. """
+    plan_json = json.dumps(plan_data)
+    shown = json.loads(plan_json)
+    extract_nodes(shown[0]['Plan'])
+    tabled = json.loads(plan_json)
+    parse_plan(tabled[0]['Plan'])
+
+
+def bench_plan_parse(sizes):
+    results = []
+    for n_nodes in sizes:
+        plan_data = synthetic_plan(n_nodes)
+        old_time, old_peak = measure(json_round_trips, plan_data)
+        new_time, new_peak = measure(build_plan, plan_data)
+        results.append({
+            'benchmark': 'plan_parse',
+            'nodes': n_nodes,
+            'json_round_trips_ms': old_time * 1000,
+            'json_round_trips_peak_kb': old_peak / 1024,
+            'build_plan_ms': new_time * 1000,
+            'build_plan_peak_kb': new_peak / 1024,
+        })
+    return results
+
+
+def bench_deep_plans(depths):
+    """ Walkers on single-chain plans, deeper than Python's recursion limit. """
+    results = []
+    for depth in depths:
+        plan_data = deep_plan(depth)
+        root = plan_data[0]['Plan']
+        result = {'benchmark': 'deep_plan', 'depth': depth}
+        for stage, func, arg in (('build_plan', build_plan, plan_data), ('parse_plan', parse_plan, root),
+                                 ('extract_node_types', extract_node_types, root),
+                                 ('flatten_plans', flatten_plans, [root])):
+            elapsed, _ = measure(func, arg)
+            result[f'{stage}_ms'] = elapsed * 1000
+        results.append(result)
+    return results
+
+
+def bench_json_decode(size_mb):
+    """ Decode time and peak memory of a plan of about size_mb MB of JSON text, for every installed decoder,
+    followed by building the plan model from the decoded result. """
+    sample = json.dumps(synthetic_plan(1000))
+    plan_text = json.dumps(synthetic_plan(max(1, int(size_mb * 1e6 / len(sample) * 1000))))
+    results = []
+    for name in JSON_DECODERS:
+        try:
+            set_json_decoder(name)
+        except ImportError:
+            continue
+        decode_time, decode_peak = measure(decode_json, plan_text)
+        plan_data = decode_json(plan_text)
+        build_time, build_peak = measure(build_plan, plan_data)
+        del plan_data
+        results.append({
+            'benchmark': 'json_decode',
+            'decoder': name,
+            'mb': round(len(plan_text) / 1e6),
+            'decode_ms': decode_time * 1000,
+            'decode_peak_kb': decode_peak / 1024,
+            'build_plan_ms': build_time * 1000,
+            'build_plan_peak_kb': build_peak / 1024,
+        })
+    set_json_decoder()
+    return results
+
+
+def scalar_costs(plans):
+    """ The scalar reference, expected_plan_costs plan by plan. """
+    return [cost for plan in plans for cost in expected_plan_costs(plan, cost_params)]
+
+
+def batch_costs(plans):
+    return compute_expected_costs(flatten_plans(plans), cost_params)[0]
+
+
+def bench_cost_model(n_plans, plan_nodes=20):
+    plans = [synthetic_plan(plan_nodes, seed=seed)[0]['Plan'] for seed in range(n_plans)]
+    scalar_time, _ = measure(scalar_costs, plans)
+    batch_time, _ = measure(batch_costs, plans)
+    table = flatten_plans(plans)
+    start = time.perf_counter()
+    compute_expected_costs(table, cost_params)
+    vector_time = time.perf_counter() - start
+    return [{
+        'benchmark': 'cost_model',
+        'plans': n_plans,
+        'nodes': int(table['plan'].shape[0]),
+        'scalar_ms': scalar_time * 1000,
+        'batch_with_flatten_ms': batch_time * 1000,
+        'batch_vector_only_ms': vector_time * 1000,
+        'identical': bool(np.allclose(np.array(scalar_costs(plans)), batch_costs(plans), rtol=1e-12)),
+    }]
+
+
+def load_tpch(db_conn, scale_factor):
+    """ Recreates the TPC-H tables from the CREATE TABLE scripts and fills them with generated data. """
+    with db_conn.cursor() as cursor:
+        for table in reversed(TPCH_TABLES):
+            cursor.execute(f"DROP TABLE IF EXISTS public.{table} CASCADE;")
+        for table in TPCH_TABLES:
+            with open(os.path.join(SCRIPT_DIR, f"create_{table}.sql"), 'r') as script:
+                # The scripts also set the table owner, which only works where a postgres role exists
+                create_sql = script.read().split('ALTER TABLE')[0]
+            cursor.execute(create_sql)
+            cursor.execute(TPCH_DATA[table].format(sf=float(scale_factor)))
+    db_conn.commit()
+
+    db_conn.autocommit = True
+    with db_conn.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE;")
+    db_conn.autocommit = False
+
+
+def timed(results, stage, func, *args, **fields):
+    """ Runs func(*args), records its duration under the given stage and returns its result. """
+    start = time.perf_counter()
+    value = func(*args)
+    results.append(dict({'benchmark': 'pipeline', 'stage': stage, 'ms': (time.perf_counter() - start) * 1000}, **fields))
+    return value
+
+
+def bench_pipeline(conn_params, queries, repeat, row_limit=1000):
+    """ Times every stage of a submit separately against a live database. """
+    results = []
+    for query_no, sql_query in enumerate(queries):
+        for run in range(repeat):
+            fields = {'query': query_no, 'run': run}
+            db_conn = timed(results, 'connect', lambda: psycopg2.connect(**conn_params), **fields)
+            try:
+                with db_conn.cursor() as cursor:
+                    # Fetch the plan as text so that server time and JSON decoding are timed apart
+                    plan_text = timed(results, 'explain_analyze', fetch_plan_text, cursor,
+                                      f"EXPLAIN (FORMAT JSON, ANALYZE, BUFFERS) {sql_query};", **fields)
+                db_conn.rollback()
+                plan_data = timed(results, 'json_decode', decode_json, plan_text, **fields)
+                root = plan_data[0]['Plan']
+                timed(results, 'parse_plan', parse_plan, root, **fields)
+                timed(results, 'build_plan', build_plan, plan_data, **fields)
+                timed(results, 'expected_plan_costs', expected_plan_costs, root, cost_params, **fields)
+                timed(results, 'compute_expected_costs', lambda: compute_expected_costs(flatten_plans([root]), cost_params),
+                      **fields)
+
+                cursor = db_conn.cursor(name='bench_fetch')
+                timed(results, 'result_execute', cursor.execute, sql_query, **fields)
+                rows = timed(results, 'result_fetch', cursor.fetchmany, row_limit, **fields)
+                col_names = [desc[0] for desc in cursor.description]
+                cursor.close()
+                db_conn.rollback()
+                timed(results, 'dataframe', lambda: pd.DataFrame(rows, columns=col_names), **fields)
+            finally:
+                db_conn.close()
+    return results
+
+
+def bench_gui_stages(sizes):
+    """ Times graph layout, scene building and tree view population on synthetic plans (offscreen Qt). """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    # Imported here so the other benchmarks run without PySide6
+    from PySide6.QtWidgets import QApplication
+    from interface import MainWindow, layout_plan
+
+    app = QApplication.instance() or QApplication([])
+    window = MainWindow()
+    results = []
+    for n_nodes in sizes:
+        fields = {'nodes': n_nodes}
+        root = build_plan(synthetic_plan(n_nodes))
+        layout = timed(results, 'graph_layout', layout_plan, root, **fields)
+        timed(results, 'graph_scene', window.draw_plan_graph, layout, **fields)
+        timed(results, 'graph_overview', window.plan_overview.set_layout, layout, window.graph_items, **fields)
+        timed(results, 'tree_view', lambda: (window.tree_model.set_plan(root),
+                                             window.expand_top_levels(8, 500)), **fields)
+        app.processEvents()
+    for result in results:
+        result['benchmark'] = 'gui'
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def result_key(result):
+    return tuple((k, v) for k, v in sorted(result.items()) if k not in ('ms', 'run') and not k.endswith(('_ms', '_kb')))
+
+
+def compare(baseline, current):
+    """ Prints the ratio of current to baseline time for every result present in both reports. """
+    def medians(report):
+        times = {}
+        for result in report['results']:
+            for field, value in result.items():
+                if field == 'ms' or field.endswith('_ms'):
+                    times.setdefault(result_key(result) + (field,), []).append(value)
+        return {key: float(np.median(values)) for key, values in times.items()}
+
+    before, after = medians(baseline), medians(current)
+    for key in sorted(set(before) & set(after), key=str):
+        ratio = after[key] / before[key] if before[key] else float('inf')
+        flag = '  REGRESSION' if ratio > 1.2 else ''
+        print(f"{dict(key[:-1])} {key[-1]}: {before[key]:.3f} -> {after[key]:.3f} ms ({ratio:.2f}x){flag}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the QEP explain pipeline. Prints a JSON report.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help="node counts of the synthetic plans")
+    parser.add_argument('--depths', type=int, nargs='+', default=[10000, 100000],
+                        help="depths of the single-chain plans walked by the deep plan benchmark")
+    parser.add_argument('--json-mb', type=float, default=50, help="size of the plan text for the JSON decode benchmark")
+    parser.add_argument('--plans', type=int, default=10000, help="number of plans scored by the cost model benchmark")
+    parser.add_argument('--no-gui', action='store_true', help="skip benchmarks that need PySide6")
+    parser.add_argument('--db', help="database for the pipeline benchmark, skipped when not given")
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='5432')
+    parser.add_argument('--load', type=float, metavar='SCALE_FACTOR',
+                        help="drop, recreate and fill the TPC-H tables at this scale factor first")
+    parser.add_argument('--query', action='append', help="query to time, may be repeated (default: built-in set)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help="also write the report to this file")
+    parser.add_argument('--compare', metavar='BASELINE', help="compare against an earlier report")
+    args = parser.parse_args()
+
+    results = (bench_plan_parse(args.sizes) + bench_deep_plans(args.depths) + bench_json_decode(args.json_mb) +
+               bench_cost_model(args.plans))
+    if not args.no_gui:
+        results += bench_gui_stages(args.sizes)
+    if args.db:
+        conn_params = dict(dbname=args.db, user=args.user, password=args.password, host=args.host, port=args.port)
+        if args.load is not None:
+            db_conn = psycopg2.connect(**conn_params)
+            try:
+                load_tpch(db_conn, args.load)
+            finally:
+                db_conn.close()
+        results += bench_pipeline(conn_params, args.query or DEFAULT_QUERIES, args.repeat)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'scale_factor': args.load,
+        'results': results,
+    }
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            compare(json.load(baseline_file), report)
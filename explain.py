@@ -1,14 +1,33 @@
+import numpy as np
 import pandas as pd
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
 import json
+import hashlib
+import re
+import shelve
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict, deque
 
+from plan_analysis import estimate_error, plan_hotspots
+from plan_store import PlanStore
+from plan_traversal import plan_children, preorder, walk_with_parents
+from tracing import span, traced
+
+# Default PostgreSQL cost settings extracted from pgAdmin4. Shared by the GUI, the batch analyzer and
+# test.py; calibrate_cost_params fits them to measured run times.
 cost_params = {
     'seq_page_cost': 1.0,
     'random_page_cost': 4.0,
     'cpu_tuple_cost': 0.01,
     'cpu_operator_cost': 0.0025,
     'cpu_index_tuple_cost': 0.005,
-    'cpu_hash_cost': 0.0025
+    'cpu_hash_cost': 0.0025,
+    'parallel_tuple_cost': 0.1,
+    'parallel_setup_cost': 1000.0
 }
 
 database = None
@@ -17,74 +36,945 @@ pwd = None
 hostname = None
 portno = None
 
+# Maximum number of result rows kept client-side for the result table preview
+PREVIEW_ROW_LIMIT = 1000
+# Rows per server-side cursor round-trip when streaming results
+RESULT_CHUNK_SIZE = 200
+
+# Default number of pooled database connections, login_credentials can be given another
+POOL_MAX_SIZE = 4
+
+# Plan cache bounds: number of cached submits and their lifetime in seconds
+PLAN_CACHE_MAX_ENTRIES = 64
+PLAN_CACHE_MAX_AGE = 600
+# shelve file the plan cache is mirrored to, so that it survives restarts
+PLAN_CACHE_PATH = 'plan_cache.shelve'
+
+# Number of earlier plans kept per query fingerprint for plan comparison
+PLAN_HISTORY_SIZE = 10
+# SQLite file every captured plan is recorded in, see plan_store.py
+PLAN_STORE_PATH = 'plan_history.sqlite'
+
+# Plan comparison thresholds: Actual Total Time ratio, Plan Rows vs Actual Rows ratio and growth in shared
+# read blocks above which a node is reported. Time swings below PLAN_DIFF_MIN_TIME ms are ignored.
+PLAN_DIFF_TIME_RATIO = 1.5
+PLAN_DIFF_MIN_TIME = 1.0
+PLAN_DIFF_ROW_ERROR = 10.0
+PLAN_DIFF_READ_BLOCKS = 1000
+
+# Number of nodes listed in the hotspot panel
+HOTSPOT_TOP_N = 10
+
+# Memory an in-memory sort or hash needs per kB it wrote to disk: tuples in memory carry headers and
+# pointers the on-disk format does not
+SPILL_MEMORY_FACTOR = 2.0
+# ms to write and read back one 8 kB temp block, used when the plan has no temp I/O timings
+SPILL_MS_PER_TEMP_BLOCK = 0.02
+# hash_mem_multiplier of servers that do not report it
+DEFAULT_HASH_MEM_MULTIPLIER = 2.0
+
+# Number of best what-if variants confirmed with EXPLAIN ANALYZE when asked for
+WHAT_IF_ANALYZE_TOP = 3
+
+# How a submit is explained, see run_query: mode -> description shown in the GUI
+ANALYZE_MODES = {
+    'analyze': "EXPLAIN ANALYZE",
+    'timing_off': "ANALYZE, TIMING OFF",
+    'explain': "EXPLAIN only (not executed)",
+    'sample': "ANALYZE on a table sample",
+    'limit': "ANALYZE with LIMIT",
+}
+# Share of the largest table read in 'sample' mode, and the row limit of 'limit' mode
+ANALYZE_SAMPLE_PERCENT = 1.0
+ANALYZE_LIMIT_ROWS = PREVIEW_ROW_LIMIT
+# Node types whose output row count does not grow with their input, left unscaled in sampled plans
+SAMPLE_UNSCALED_ROWS = {'Aggregate', 'Group', 'Unique', 'SetOp', 'Limit'}
+
+# Decoders tried for EXPLAIN JSON text, fastest first, see set_json_decoder
+JSON_DECODERS = ['orjson', 'simdjson', 'json']
+
+# Planner-relevant server settings, snapshotted once per login and made part of the plan cache key
+server_settings = None
+
+db_pool = None
+pool_slots = None
+pool_stats = {
+    'connects': 0,        # connections opened by the pool
+    'connect_time': 0.0,  # seconds spent opening them
+    'reuses': 0,          # checkouts served by an already open connection
+}
+pool_lock = threading.Lock()
+# id(connection) -> (pool, slots) it was checked out of, so that it goes back there after a new login
+checked_out = {}
+
+
+class TimedConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """ Connection pool that records how long it spends setting up new connections. """
 
-def login_credentials(db, usr, password, host, port):
-    """ Sets up the database login credentials. """
-    global database, username, pwd, hostname, portno
+    def __init__(self, *args, **kwargs):
+        self.fresh = set()  # ids of opened connections not checked out yet
+        super().__init__(*args, **kwargs)
+        # psycopg2 only keeps minconn idle connections and closes the rest on putconn, while it opens minconn
+        # connections up front. Open lazily, but keep every connection that is returned.
+        self.minconn = self.maxconn
+
+    def _connect(self, key=None):
+        start = time.perf_counter()
+        conn = super()._connect(key)
+        with pool_lock:
+            pool_stats['connects'] += 1
+            pool_stats['connect_time'] += time.perf_counter() - start
+            self.fresh.add(id(conn))
+        return conn
+
+
+def login_credentials(db, usr, password, host, port, max_size=POOL_MAX_SIZE):
+    """ Sets up the database login credentials and the connection pool that uses them. Connections still
+    checked out of the previous pool are returned to it, and closed, by release_db. """
+    global database, username, pwd, hostname, portno, db_pool, pool_slots, server_settings
     database = db
     username = usr
     pwd = password
     hostname = host
     portno = port
+    # The settings snapshot belongs to the previous login. Cached results stay: their keys name the database
+    server_settings = None
 
-
-def connect_db():
-    """ Modify according to how you set up your database. """
-    if not (database and username and pwd and hostname and portno):
-        print("Error: Please provide login credentials.")
-        return None
-    return psycopg2.connect(
+    close_pool()
+    # Connections are opened lazily on first checkout and kept open afterwards
+    db_pool = TimedConnectionPool(
+        0, max_size,
         dbname=database,
         user=username,
         password=pwd,
         host=hostname,
         port=portno
-        # dbname='TPC-H',
-        # user='postgres',
-        # password='secret',
-        # host='localhost',
-        # port='5432'
     )
+    pool_slots = threading.BoundedSemaphore(max_size)
+
+
+def close_pool():
+    """ Closes every pooled connection. Called on application exit. """
+    global db_pool
+    if db_pool is not None:
+        db_pool.closeall()
+        db_pool = None
+
+
+def pool_size():
+    """ Number of connections the current pool can hand out at once, POOL_MAX_SIZE before login. """
+    pool = db_pool
+    return pool.maxconn if pool is not None else POOL_MAX_SIZE
+
+
+def connection_time_saved():
+    """ Returns the connection setup time in seconds avoided by reusing pooled connections. """
+    if pool_stats['connects'] == 0:
+        return 0.0
+    return pool_stats['reuses'] * pool_stats['connect_time'] / pool_stats['connects']
+
+
+def connect_db():
+    """ Checks a connection out of the pool, replacing it if the backend has gone away.
+    Blocks while all connections of the pool (max_size of login_credentials) are in use. Return it with release_db.
+    Returns None without credentials; raises psycopg2.OperationalError if no connection can be opened. """
+    pool, slots = db_pool, pool_slots
+    if pool is None or not (database and username and pwd and hostname and portno):
+        print("Error: Please provide login credentials.")
+        return None
+    slots.acquire()
+    try:
+        # Validate on checkout. A server restart leaves every idle connection broken, so keep discarding
+        # them until one answers; once the idle ones are used up the pool opens new connections.
+        for _ in range(pool.maxconn + 1):
+            db_conn = pool.getconn()
+            try:
+                with db_conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+                db_conn.rollback()
+                break
+            except (psycopg2.InterfaceError, psycopg2.OperationalError):
+                pool.putconn(db_conn, close=True)
+        else:
+            raise psycopg2.OperationalError("No working connection to the database")
+        with pool_lock:
+            if id(db_conn) in pool.fresh:
+                pool.fresh.discard(id(db_conn))
+            else:
+                pool_stats['reuses'] += 1
+            checked_out[id(db_conn)] = pool, slots
+        return db_conn
+    except Exception:
+        slots.release()
+        raise
+
+
+def release_db(db_conn):
+    """ Returns a connection obtained from connect_db to the pool. """
+    if db_conn is None:
+        return
+    with pool_lock:
+        pool, slots = checked_out.pop(id(db_conn))
+    if pool.closed:
+        # Pool was shut down, or replaced by a new login, while the connection was checked out
+        db_conn.close()
+        slots.release()
+        return
+    try:
+        if not db_conn.closed:
+            db_conn.rollback()
+        pool.putconn(db_conn, close=bool(db_conn.closed))
+    except (psycopg2.InterfaceError, psycopg2.OperationalError):
+        pool.putconn(db_conn, close=True)
+    finally:
+        slots.release()
+
+
+_SQL_TOKEN = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>[eE]?'(?:[^']|'')*'|\$(?P<dollar_tag>(?:[A-Za-z_][A-Za-z0-9_]*)?)\$.*?\$(?P=dollar_tag)\$)
+  | (?P<ident>"(?:[^"]|"")*")
+  | (?P<number>\b\d+(?:\.\d*)?(?:[eE][+-]?\d+)?\b|\.\d+\b)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<space>\s+)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+
+def normalize_sql(sql_query):
+    """ Normalizes whitespace, keyword and identifier case, comments and literals of a query.
+    Returns (normalized text with literals replaced by ?, tuple of the literals in order). """
+    parts = []
+    literals = []
+    separated = False
+    for match in _SQL_TOKEN.finditer(sql_query):
+        kind = match.lastgroup
+        token = match.group()
+        if kind in ('comment', 'space'):
+            separated = True
+            continue
+        if kind in ('string', 'number'):
+            literals.append(token)
+            token = '?'
+        elif kind == 'word':
+            token = token.lower()
+        # Whitespace is only kept where it separates two words, so "a > 1" and "a>1" normalize the same
+        if separated and parts and _is_wordish(parts[-1][-1]) and _is_wordish(token[0]):
+            parts.append(' ')
+        parts.append(token)
+        separated = False
+    while parts and parts[-1] == ';':
+        parts.pop()
+    return ''.join(parts), tuple(literals)
+
+
+def _is_wordish(char):
+    return char.isalnum() or char in '_$?'
+
+
+def split_statements(script):
+    """ Splits a SQL script into statements at top-level semicolons, skipping ones inside string literals,
+    quoted identifiers and comments. Statements consisting only of comments are dropped. """
+    statements = []
+    start = 0
+    has_code = False
+    for match in _SQL_TOKEN.finditer(script):
+        kind = match.lastgroup
+        if kind == 'other' and match.group() == ';':
+            if has_code:
+                statements.append(script[start:match.start()].strip())
+            start = match.end()
+            has_code = False
+        elif kind not in ('comment', 'space'):
+            has_code = True
+    if has_code:
+        statements.append(script[start:].strip())
+    return statements
+
+
+def strip_statement_end(sql_query):
+    """ The query without the semicolons, comments and whitespace it ends with. """
+    end = 0
+    for match in _SQL_TOKEN.finditer(sql_query):
+        if match.lastgroup not in ('comment', 'space') and match.group() != ';':
+            end = match.end()
+    return sql_query[:end]
+
+
+# Keywords that end a FROM list, and words that cannot be a table alias
+_FROM_END = {'where', 'group', 'order', 'having', 'limit', 'offset', 'union', 'intersect', 'except', 'window',
+             'fetch', 'for', 'returning', 'select'}
+_NOT_ALIAS = _FROM_END | {'join', 'inner', 'left', 'right', 'full', 'cross', 'natural', 'on', 'using', 'as',
+                          'tablesample', 'lateral'}
+
+
+def _from_relations(sql_query):
+    """ Table references of a query: (relation name in lower case, offset just after the reference and its
+    alias) for every name following FROM, JOIN or a comma of a FROM list. Names that turn out not to be
+    tables (e.g. the column in EXTRACT(year FROM col)) are filtered by the caller. """
+    tokens = [(match.lastgroup, match.group(), match.end()) for match in _SQL_TOKEN.finditer(sql_query)
+              if match.lastgroup not in ('comment', 'space')]
+    relations = []
+    in_from = [False]  # per parenthesis depth
+    previous = None
+    i = 0
+    while i < len(tokens):
+        kind, text, end = tokens[i]
+        word = text.lower() if kind == 'word' else None
+        if text == '(':
+            in_from.append(False)
+        elif text == ')' and len(in_from) > 1:
+            in_from.pop()
+        elif word == 'from':
+            in_from[-1] = True
+        elif word in _FROM_END:
+            in_from[-1] = False
+        elif kind == 'word' and word not in _NOT_ALIAS and word != 'only' and (
+                previous in ('from', 'join') or (previous == ',' and in_from[-1])):
+            # Schema qualified names: keep the last part
+            while i + 2 < len(tokens) and tokens[i + 1][1] == '.' and tokens[i + 2][0] in ('word', 'ident'):
+                i += 2
+                word, end = tokens[i][1].lower(), tokens[i][2]
+            if i + 2 < len(tokens) and tokens[i + 1][1].lower() == 'as':
+                i += 2
+                end = tokens[i][2]
+            elif i + 1 < len(tokens) and tokens[i + 1][0] in ('word', 'ident') and tokens[i + 1][1].lower() not in _NOT_ALIAS:
+                i += 1
+                end = tokens[i][2]
+            relations.append((word, end))
+            previous = 'alias'
+            i += 1
+            continue
+        previous = word if word is not None else text
+        i += 1
+    return relations
+
+
+def sample_query(sql_query, relation, percent):
+    """ Rewrites every reference to relation in the FROM lists of a query to read a TABLESAMPLE SYSTEM
+    sample of percent % of its pages. """
+    parts = []
+    start = 0
+    for name, end in _from_relations(sql_query):
+        if name == relation:
+            parts.append(sql_query[start:end])
+            parts.append(f" TABLESAMPLE SYSTEM ({percent})")
+            start = end
+    parts.append(sql_query[start:])
+    return ''.join(parts)
+
+
+def query_fingerprint(sql_query):
+    """ Returns a stable identifier for the shape of a query, ignoring formatting and literal values. """
+    return hashlib.sha1(normalize_sql(sql_query)[0].encode()).hexdigest()
+
+
+def load_server_settings(db_conn):
+    """ Snapshots the planner settings of the server, they are part of the plan cache key. """
+    global server_settings
+    with db_conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT name, setting FROM pg_settings "
+            "WHERE category LIKE 'Query Tuning%' OR name IN ('work_mem', 'hash_mem_multiplier', 'server_version_num') ORDER BY name;"
+        )
+        server_settings = tuple(cursor.fetchall())
+    db_conn.rollback()
+
+
+def server_setting(name, default=None):
+    """ A setting from the server_settings snapshot as text, or default before it is taken. """
+    for setting_name, setting in server_settings or ():
+        if setting_name == name:
+            return setting
+    return default
+
 
+def plan_cache_key(sql_query, *options):
+    """ Key of a submit in the plan cache: normalized SQL, its literal values, cost_params, the server
+    settings snapshot, the database logged in to and any other options that change the result. None until
+    settings are known. """
+    if server_settings is None:
+        return None
+    key = (normalize_sql(sql_query), tuple(sorted(cost_params.items())), server_settings,
+           (database, hostname, portno, username), options)
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+class PlanCache:
+    """ Thread-safe LRU cache of submit results, bounded by entry count and age.
+    Optionally mirrored to a shelve file so that it survives restarts. """
+
+    def __init__(self, max_entries=PLAN_CACHE_MAX_ENTRIES, max_age=PLAN_CACHE_MAX_AGE, disk_path=None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()  # key -> (time stored, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk = None
+        if disk_path is not None:
+            self.open_disk(disk_path)
+
+    def open_disk(self, disk_path):
+        """ Mirrors the cache to a shelve file, dropping the entries in it that expired meanwhile. """
+        with self.lock:
+            self.disk = shelve.open(disk_path)
+            now = time.time()
+            for key in [key for key, entry in self.disk.items() if now - entry[0] > self.max_age]:
+                del self.disk[key]
+
+    def close(self):
+        with self.lock:
+            if self.disk is not None:
+                self.disk.close()
+                self.disk = None
+
+    def get(self, key):
+        """ Returns the cached value, or None on a miss. A None key (see plan_cache_key) is always a miss. """
+        with self.lock:
+            if key is None:
+                self.misses += 1
+                return None
+            entry = self.entries.get(key)
+            if entry is None and self.disk is not None:
+                entry = self.disk.get(key)
+                if entry is not None:
+                    self.entries[key] = entry
+            if entry is not None and time.time() - entry[0] <= self.max_age:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._discard(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            entry = (time.time(), value)
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if self.disk is not None:
+                self.disk[key] = entry
+            while len(self.entries) > self.max_entries:
+                self._discard(next(iter(self.entries)))
+
+    def invalidate(self, key=None):
+        """ Drops one entry, or every entry when no key is given. """
+        with self.lock:
+            if key is not None:
+                self._discard(key)
+                return
+            self.entries.clear()
+            if self.disk is not None:
+                self.disk.clear()
+
+    def _discard(self, key):
+        self.entries.pop(key, None)
+        if self.disk is not None and key in self.disk:
+            del self.disk[key]
+
+
+plan_cache = PlanCache()
+
+
+def invalidate_plan_cache():
+    """ Empties the plan cache and re-reads the server settings on the next submit. """
+    global server_settings
+    server_settings = None
+    plan_cache.invalidate()
+
+
+# query fingerprint -> deque of (timestamp, PlanNode root), oldest first
+plan_history = {}
+plan_history_lock = threading.Lock()
+# Persistent history, opened by project.py
+plan_store = PlanStore()
 
-def explain_query(sql_query):
-    """ Executes the EXPLAIN command on the provided SQL query and returns the analysis. """
-    db_conn = connect_db()
-    cursor = db_conn.cursor()
+
+def record_plan(sql_query, plan, plan_text=None):
+    """ Adds a freshly captured plan to the history of its query fingerprint, and queues it for the plan
+    store together with the EXPLAIN JSON text it was built from. """
+    fingerprint = query_fingerprint(sql_query)
+    with plan_history_lock:
+        history = plan_history.setdefault(fingerprint, deque(maxlen=PLAN_HISTORY_SIZE))
+        history.append((time.time(), plan))
+    if plan_text is not None:
+        plan_store.add(fingerprint, sql_query, plan, plan_text,
+                       {'server_settings': server_settings, 'cost_params': dict(cost_params)})
+
+
+def previous_plan(sql_query, plan):
+    """ Returns (timestamp, PlanNode) of the most recent run of the same query before plan, or None. """
+    with plan_history_lock:
+        history = list(plan_history.get(query_fingerprint(sql_query), ()))
+    for i in range(len(history) - 1, -1, -1):
+        if history[i][1] is plan:
+            return history[i - 1] if i > 0 else None
+    return history[-1] if history else None
+
+
+def recorded_plans():
+    """ Every plan in the history, oldest first per query. """
+    with plan_history_lock:
+        return [plan for history in plan_history.values() for _, plan in history]
+
+
+@traced('explain_query')
+def explain_query(sql_query, analyze=True, settings=(), hypothetical_indexes=(), record=False):
+    """ Executes the EXPLAIN command on the provided SQL query and returns the root PlanNode of the plan.
+    settings are (name, value) pairs applied with SET LOCAL semantics and hypothetical_indexes CREATE INDEX
+    statements simulated with the hypopg extension; both only last for this call, which always rolls back.
+    With record the plan is added to the plan history and store (see record_plan). """
+    db_conn = cursor = None
     try:
+        db_conn = connect_db()
+        if db_conn is None:
+            return "Error executing query: Please provide login credentials."
+        cursor = db_conn.cursor()
+        for name, value in settings:
+            cursor.execute("SELECT set_config(%s, %s, true);", (name, value))
+        for index_sql in hypothetical_indexes:
+            try:
+                cursor.execute("SELECT indexrelid FROM hypopg_create_index(%s);", (index_sql,))
+            except psycopg2.errors.UndefinedFunction:
+                return "Error executing query: hypothetical indexes need the hypopg extension (CREATE EXTENSION hypopg)"
         # Adjust the EXPLAIN command according to your needs
-        explain_sql = f"EXPLAIN (FORMAT JSON, ANALYZE, BUFFERS) {sql_query};"
-        cursor.execute(explain_sql)
-        result = cursor.fetchall()
-        plan_json = json.dumps(result[0][0])
-        return plan_json
+        if analyze:
+            explain_sql = f"EXPLAIN (FORMAT JSON, ANALYZE, BUFFERS) {sql_query};"
+        else:
+            explain_sql = f"EXPLAIN (FORMAT JSON) {sql_query};"
+        # Fetched as text and decoded once, straight into the plan model
+        plan_text = fetch_plan_text(cursor, explain_sql)
+        plan = build_plan(decode_json(plan_text))
+        if record:
+            record_plan(sql_query, plan, plan_text)
+        return plan
     except Exception as e:
         return f"Error executing query: {str(e)}"
     finally:
-        cursor.close()
-        db_conn.close()
+        if cursor is not None:
+            cursor.close()
+        if hypothetical_indexes and db_conn is not None and not db_conn.closed:
+            # hypopg keeps its indexes in backend memory, a rollback does not remove them
+            db_conn.rollback()
+            try:
+                with db_conn.cursor() as reset_cursor:
+                    reset_cursor.execute("SELECT hypopg_reset();")
+            except psycopg2.Error:
+                pass
+        release_db(db_conn)
+
+
+def summarize_plan(plan):
+    """ Headline figures of a plan: total time (ms over all loops, None without ANALYZE data), total
+    cost, the node with the largest self time or self cost and its share, and the largest Plan Rows vs
+    Actual Rows error of any node. """
+    hotspots = plan_hotspots(plan)
+    worst = top_hotspots(hotspots, 1)[0]
+    timed = worst['self_time'] is not None
+    measure = 'self_time' if timed else 'self_cost'
+    total = sum(hotspot[measure] or 0.0 for hotspot in hotspots)
+    errors = [hotspot['estimate_error'] for hotspot in hotspots if hotspot['estimate_error'] is not None]
+    return {
+        'total_time': plan.actual_total_time * (plan.actual_loops or 1) if plan.actual_total_time is not None else None,
+        'total_cost': plan.total_cost,
+        'worst_node': worst['node'],
+        'worst_share': (worst[measure] or 0.0) / total if total else 0.0,
+        'estimate_error': max(errors) if errors else None,
+    }
+
+
+@traced('explain_workload')
+def explain_workload(statements, analyze=False, concurrency=None, on_result=None):
+    """ Explains every statement of a workload, concurrency (default pool_size()) at a time on pooled
+    connections, and returns one result dict per statement in input order: 'index', 'sql', 'plan', 'error'
+    and, for successful plans, the summarize_plan figures. on_result is called with each result as soon as
+    it is ready. Plans are recorded in the plan history and store. """
+    def explain_statement(index, sql_query):
+        result = {'index': index, 'sql': sql_query, 'plan': None, 'error': None}
+        # A failure stays with its statement, the rest of the workload goes on
+        try:
+            plan = explain_query(sql_query, analyze=analyze, record=True)
+            if isinstance(plan, PlanNode):
+                result.update(summarize_plan(plan))
+                result['plan'] = plan
+            else:
+                result['error'] = plan
+        except Exception as e:
+            result['error'] = f"Error executing query: {str(e)}"
+        return result
+
+    if concurrency is None:
+        concurrency = pool_size()
+    results = [None] * len(statements)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [executor.submit(explain_statement, index, sql_query) for index, sql_query in enumerate(statements)]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result['index']] = result
+            if on_result is not None:
+                on_result(result)
+    return results
 
 
-def query_to_dataframe(sql_query):
-    db_conn = connect_db()
-    cursor = db_conn.cursor()
+def parse_variant(text):
+    """ Parses one what-if variant: items separated by ';', each either name = value for a setting
+    (e.g. work_mem = 256MB, enable_seqscan = off, random_page_cost = 1.1) or a CREATE INDEX statement
+    for a hypothetical index. Returns a dict with 'name', 'settings' and 'indexes'. """
+    variant = {'name': text.strip(), 'settings': [], 'indexes': []}
+    for item in text.split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        if item.upper().startswith('CREATE'):
+            variant['indexes'].append(item)
+            continue
+        name, sep, value = item.partition('=')
+        if not sep or not name.strip() or not value.strip():
+            raise ValueError(f"Cannot parse '{item}', expected name = value or CREATE INDEX ...")
+        variant['settings'].append((name.strip(), value.strip().strip("'")))
+    return variant
 
+
+def _explain_variant(sql_query, variant, analyze):
     try:
-        cursor.execute(sql_query)
-        rows = cursor.fetchall()
-        col_names = [desc[0] for desc in cursor.description]
+        plan = explain_query(sql_query, analyze=analyze, settings=variant['settings'],
+                             hypothetical_indexes=variant['indexes'])
+    except Exception as e:
+        plan = f"Error executing query: {str(e)}"
+    if isinstance(plan, PlanNode):
+        return {'variant': variant, 'plan': plan, 'cost': plan.total_cost, 'error': None,
+                'actual_time': plan.actual_total_time}
+    return {'variant': variant, 'plan': None, 'cost': None, 'error': plan, 'actual_time': None}
+
 
-        df = pd.DataFrame(rows, columns=col_names)
-        df.dropna(axis=1, how='all', inplace=True)
+@traced('what_if')
+def what_if(sql_query, variants, analyze_top=0):
+    """ Plans sql_query under each variant (see parse_variant) next to an unchanged baseline, all
+    concurrently on pooled connections, and returns result dicts ranked by estimated total cost, failed
+    variants last. The analyze_top best variants without hypothetical indexes are then confirmed with
+    EXPLAIN ANALYZE, which fills their 'actual_time' and replaces their plan. """
+    variants = [{'name': 'baseline', 'settings': [], 'indexes': []}] + list(variants)
+    with ThreadPoolExecutor(max_workers=pool_size()) as executor:
+        results = list(executor.map(lambda variant: _explain_variant(sql_query, variant, False), variants))
+        results.sort(key=lambda result: (result['cost'] is None, result['cost'] or 0.0))
 
-        return df
+        # hypopg indexes are invisible to ANALYZE, so only real settings can be confirmed
+        candidates = [result for result in results if result['error'] is None and not result['variant']['indexes']]
+        candidates = candidates[:analyze_top]
+        analyzed = executor.map(lambda result: _explain_variant(sql_query, result['variant'], True), candidates)
+        for result, confirmed in zip(candidates, list(analyzed)):
+            if confirmed['error'] is None:
+                result['plan'] = confirmed['plan']
+                result['actual_time'] = confirmed['actual_time']
+            else:
+                result['error'] = confirmed['error']
+    return results
+
+
+@traced('query_to_dataframe')
+def query_to_dataframe(sql_query, row_limit=PREVIEW_ROW_LIMIT, on_chunk=None):
+    """ Streams the query result into a DataFrame of at most row_limit rows.
+    Returns (DataFrame, total row count), or (None, 0) on error. """
+    db_conn = None
+    try:
+        db_conn = connect_db()
+        return stream_query(db_conn, sql_query, row_limit, on_chunk=on_chunk)
 
     except (Exception, psycopg2.DatabaseError) as error:
         print("Error:", error)
-        return None
+        return None, 0
+    finally:
+        release_db(db_conn)
+
+
+def _auto_explain_plan(notices):
+    """ Picks the JSON plan text logged by auto_explain out of the server notices of a connection.
+    auto_explain logs a single plan object, EXPLAIN (FORMAT JSON) returns a list of them. """
+    for notice in reversed(notices):
+        if 'plan:' in notice and '{' in notice:
+            return notice[notice.index('{'):]
+    return None
+
+
+def _load_json_decoder(name):
+    if name == 'orjson':
+        import orjson
+        return orjson.loads
+    if name == 'simdjson':
+        import simdjson
+        return simdjson.loads
+    if name == 'json':
+        return json.loads
+    raise ValueError(f"Unknown JSON decoder: {name}")
+
+
+def set_json_decoder(name=None):
+    """ Selects the decoder used by decode_json by name, or the first installed one of JSON_DECODERS.
+    Returns the name of the decoder in use. """
+    global _json_decoder, json_decoder_name
+    for candidate in ([name] if name else JSON_DECODERS):
+        try:
+            _json_decoder = _load_json_decoder(candidate)
+        except ImportError:
+            if name:
+                raise
+            continue
+        json_decoder_name = candidate
+        return candidate
+
+
+set_json_decoder()
+
+
+@traced('decode_json')
+def decode_json(text):
+    """ Decodes EXPLAIN JSON text with the selected decoder (see set_json_decoder). """
+    return _json_decoder(text)
+
+
+# json columns (oid 114) left as text, so a plan is decoded once, by decode_json
+JSON_TEXT = psycopg2.extensions.new_type((114,), 'JSON_TEXT', lambda value, cursor: value)
+
+
+def fetch_plan_text(cursor, explain_sql):
+    """ Runs an EXPLAIN (FORMAT JSON) statement and returns its output undecoded. """
+    psycopg2.extensions.register_type(JSON_TEXT, cursor)
+    cursor.execute(explain_sql)
+    return cursor.fetchone()[0]
+
+
+@traced('stream_query')
+def stream_query(db_conn, sql_query, row_limit=PREVIEW_ROW_LIMIT, chunk_size=RESULT_CHUNK_SIZE, on_chunk=None):
+    """ Runs the query through a server-side cursor and fetches it in chunks of chunk_size rows until
+    row_limit rows are held client-side; the rest is skipped on the server so client memory stays bounded.
+    on_chunk is called with (column names, rows) as each chunk arrives. Returns (DataFrame, total row count). """
+    cursor = db_conn.cursor(name='qep_preview')
+    cursor.itersize = chunk_size
+    try:
+        cursor.execute(sql_query)
+        rows = []
+        col_names = None
+        while len(rows) < row_limit:
+            chunk = cursor.fetchmany(min(chunk_size, row_limit - len(rows)))
+            if col_names is None:
+                col_names = [desc[0] for desc in cursor.description]
+            if not chunk:
+                break
+            rows.extend(chunk)
+            if on_chunk is not None:
+                on_chunk(col_names, chunk)
+
+        # Drain the remaining rows without sending them to the client, MOVE reports how many there were
+        with db_conn.cursor() as mover:
+            mover.execute('MOVE FORWARD ALL FROM "qep_preview";')
+            total_rows = len(rows) + max(mover.rowcount, 0)
     finally:
+        # Closing the cursor ends the executor, which is when auto_explain logs the plan
         cursor.close()
-        db_conn.close()
+
+    df = pd.DataFrame(rows, columns=col_names)
+    df.dropna(axis=1, how='all', inplace=True)
+    return df, total_rows
+
+
+@traced('run_query')
+def run_query(sql_query, row_limit=PREVIEW_ROW_LIMIT, on_connection=None, progress=None, on_chunk=None,
+              use_cache=True, mode='analyze', statement_timeout=0, cancelled=None):
+    """ Executes the query once and returns (PlanNode root, preview DataFrame, total row count).
+    The plan with ANALYZE and BUFFERS statistics is captured by auto_explain from the same run that fills
+    the result preview. If auto_explain cannot be loaded, a plain EXPLAIN (no ANALYZE) is shown instead.
+    on_connection is called with the connection running the query (and with None once it is released),
+    so that another thread can cancel the statement. The server ignores a cancel while no statement runs, so
+    cancelled, if given, is asked before each statement is started and ends the run once it returns True.
+    progress is called with a description of each stage
+    and on_chunk with each chunk of preview rows as it arrives (see stream_query).
+    mode (see ANALYZE_MODES) guards expensive queries: 'timing_off' skips per-node timing, 'explain' does
+    not execute the query at all, 'sample' runs it on a TABLESAMPLE of its largest table and scales the
+    plan and row count back up, 'limit' stops after ANALYZE_LIMIT_ROWS rows. A statement_timeout (ms)
+    cuts the run short, in which case the estimated plan is returned with an empty preview. Anything the
+    user should know about how the result was obtained is in the DataFrame's attrs['note'].
+    Results are kept in plan_cache, a repeated submit of the same query is answered without the database. """
+    def report(stage):
+        if progress is not None:
+            progress(stage)
+
+    def is_cancelled():
+        return cancelled is not None and cancelled()
+
+    key = None
+    if use_cache:
+        key = plan_cache_key(sql_query, row_limit, mode, statement_timeout)
+    if key is not None:
+        cached = plan_cache.get(key)
+        if cached is not None:
+            return cached
+
+    report("Waiting for a database connection...")
+    db_conn = None
+    try:
+        with span('connect'):
+            db_conn = connect_db()
+        if db_conn is None:
+            return "Error executing query: Please provide login credentials.", None, 0
+        if on_connection is not None:
+            on_connection(db_conn)
+        if is_cancelled():
+            return "Query cancelled.", None, 0
+        if use_cache and key is None:
+            if server_settings is None:
+                with span('load_server_settings'):
+                    load_server_settings(db_conn)
+            # The key could not be computed before the settings snapshot, e.g. a result cached before a restart
+            key = plan_cache_key(sql_query, row_limit, mode, statement_timeout)
+            cached = plan_cache.get(key)
+            if cached is not None:
+                return cached
+
+        if mode == 'explain':
+            with db_conn.cursor() as cursor:
+                plan_text = fetch_plan_text(cursor, f"EXPLAIN (FORMAT JSON) {sql_query};")
+            return _finish_run(sql_query, plan_text, pd.DataFrame(), 0,
+                               "Estimated plan only, the query was not executed.", key, record=False)
+
+        run_sql, fraction, note = sql_query, None, None
+        if mode == 'limit':
+            # On its own line, so that a comment ending the query cannot swallow the closing parenthesis
+            run_sql = f"SELECT * FROM (\n{strip_statement_end(sql_query)}\n) AS limited LIMIT {ANALYZE_LIMIT_ROWS}"
+            note = f"Executed with LIMIT {ANALYZE_LIMIT_ROWS}, times and counts cover the first rows only."
+        elif mode == 'sample':
+            relation = _largest_relation(db_conn, sql_query)
+            if relation is None:
+                note = "No table to sample, the full query was executed."
+            else:
+                run_sql = sample_query(sql_query, relation, ANALYZE_SAMPLE_PERCENT)
+                fraction = ANALYZE_SAMPLE_PERCENT / 100
+                note = (f"Executed on a {ANALYZE_SAMPLE_PERCENT:g}% sample of {relation}, "
+                        f"times and row counts are scaled up and approximate.")
+
+        report("Executing query...")
+        with span('explain_setup'):
+            cursor = db_conn.cursor()
+            try:
+                cursor.execute("LOAD 'auto_explain';")
+                cursor.execute("SET LOCAL auto_explain.log_min_duration = 0;")
+                cursor.execute("SET LOCAL auto_explain.log_analyze = on;")
+                cursor.execute("SET LOCAL auto_explain.log_buffers = on;")
+                if mode == 'timing_off':
+                    cursor.execute("SET LOCAL auto_explain.log_timing = off;")
+                cursor.execute("SET LOCAL auto_explain.log_format = 'json';")
+                cursor.execute("SET LOCAL auto_explain.log_level = 'notice';")
+                cursor.execute("SET LOCAL client_min_messages = 'notice';")
+                plan_text = None
+            except psycopg2.Error:
+                # auto_explain not installed or not permitted, fall back to the estimated plan
+                db_conn.rollback()
+                plan_text = fetch_plan_text(cursor, f"EXPLAIN (FORMAT JSON) {run_sql};")
+            finally:
+                cursor.close()
+            with db_conn.cursor() as cursor:
+                # stream_query runs the statement as DECLARE CURSOR, which the planner would plan for fast start
+                # (cursor_tuple_fraction 0.1). Plan it as if all rows are fetched, like the statement run directly.
+                cursor.execute("SET LOCAL cursor_tuple_fraction = 1.0;")
+                if statement_timeout:
+                    cursor.execute("SELECT set_config('statement_timeout', %s, true);", (f"{int(statement_timeout)}ms",))
+
+        del db_conn.notices[:]
+        if is_cancelled():
+            return "Query cancelled.", None, 0
+        try:
+            df, total_rows = stream_query(db_conn, run_sql, row_limit, on_chunk=on_chunk)
+        except psycopg2.errors.QueryCanceled as e:
+            if 'statement timeout' not in str(e):
+                raise
+            # Cut short: auto_explain logs nothing for a cancelled run, show what the planner expected
+            db_conn.rollback()
+            with db_conn.cursor() as cursor:
+                plan_text = fetch_plan_text(cursor, f"EXPLAIN (FORMAT JSON) {sql_query};")
+            return _finish_run(sql_query, plan_text, pd.DataFrame(), 0,
+                               f"Cut short by statement_timeout after {int(statement_timeout)} ms, "
+                               f"showing the estimated plan.", key, record=False)
+
+        report("Capturing plan...")
+        with span('capture_plan'):
+            if plan_text is None:
+                plan_text = _auto_explain_plan(db_conn.notices)
+            if plan_text is None:
+                # auto_explain loaded but its notice did not reach the client
+                with db_conn.cursor() as cursor:
+                    plan_text = fetch_plan_text(cursor, f"EXPLAIN (FORMAT JSON) {run_sql};")
+        return _finish_run(sql_query, plan_text, df, total_rows, note, key, fraction and (relation, fraction),
+                           record=mode in ('analyze', 'timing_off'))
+    except Exception as e:
+        return f"Error executing query: {str(e)}", None, 0
+    finally:
+        if on_connection is not None:
+            on_connection(None)
+        release_db(db_conn)
+
+
+def _finish_run(sql_query, plan_text, df, total_rows, note, cache_key, sampled=None, record=True):
+    """ Builds the plan of a run_query submit, attaches its note and caches the result. The plan is recorded
+    (see record_plan) unless record is off: plans of guarded modes are sampled, cut short or estimated only,
+    and would pass for regressions in comparisons and skew calibration and the plan store. """
+    plan_data = decode_json(plan_text)
+    if isinstance(plan_data, dict):
+        plan_data = [plan_data]
+    plan = build_plan(plan_data)
+    if sampled and scale_sampled_plan(plan, *sampled):
+        total_rows = round(total_rows / sampled[1])
+    df.attrs['note'] = note
+    df.attrs['recorded'] = record
+    result = plan, df, total_rows
+    if record:
+        record_plan(sql_query, plan, plan_text)
+    if cache_key:
+        plan_cache.put(cache_key, result)
+    return result
+
+
+def _largest_relation(db_conn, sql_query):
+    """ The table with the most rows (by pg_class.reltuples) that the query reads, or None. """
+    names = sorted({name for name, _ in _from_relations(sql_query)})
+    if not names:
+        return None
+    with db_conn.cursor() as cursor:
+        cursor.execute("SELECT relname FROM pg_class WHERE relname = ANY(%s) AND relkind IN ('r', 'm') "
+                       "ORDER BY reltuples DESC LIMIT 1;", (names,))
+        row = cursor.fetchone()
+    return None if row is None else row[0]
+
+
+def scale_sampled_plan(plan, relation, fraction):
+    """ Scales a plan run on a TABLESAMPLE of relation back to the full table: the Actual Total Time of
+    the Sample Scan of relation and of every node above it is divided by fraction, and so are its Actual
+    Rows and Plan Rows up to the first aggregating node (SAMPLE_UNSCALED_ROWS). A first-order estimate.
+    Returns True if the row count of the root, and so of the result, was scaled. """
+    parents = {}
+    sampled = []
+    for node, parent, _, _ in walk_with_parents(plan):
+        parents[id(node)] = parent
+        if node.node_type == 'Sample Scan' and node.relation_name == relation:
+            sampled.append(node)
+
+    scaled = {}  # id(node) -> (node, whether its rows scale)
+    for node in sampled:
+        rows_scale = True
+        while node is not None:
+            rows_scale = rows_scale and node.node_type not in SAMPLE_UNSCALED_ROWS
+            if id(node) in scaled and scaled[id(node)][1] >= rows_scale:
+                break  # Reached from another Sample Scan already
+            scaled[id(node)] = node, rows_scale
+            node = parents[id(node)]
+    for node, rows_scale in scaled.values():
+        if node.actual_total_time is not None:
+            node.actual_total_time /= fraction
+        if rows_scale:
+            node.plan_rows = round(node.plan_rows / fraction)
+            if node.actual_rows is not None:
+                node.actual_rows = round(node.actual_rows / fraction)
+    return scaled.get(id(plan), (None, False))[1]
 
 
 def format_plan(plan):
@@ -101,26 +991,24 @@ def analyze_costs(explain_result):
 
 
 def extract_nodes(plan, parent_item=None):
-    """ Recursively extract the nodes and add them to the tree model starting from the given parent item. """
-    # This recursive function builds a nested dictionary to represent the plan tree
-    node_data = {
-        'Node Type': plan['Node Type'],
-        'Startup Cost': plan['Startup Cost'],
-        'Total Cost': plan['Total Cost'],
-        'Plan Rows': plan['Plan Rows'],
-        'Plan Width': plan['Plan Width'],
-        'Actual Total Time': plan['Actual Total Time'],
-        'Actual Rows': plan['Actual Rows'],
-        'Plans': []
-    }
-
-    # Recursively call extract_nodes on sub-plans, if they exist
-    if 'Plans' in plan:
-        for subplan in plan['Plans']:
-            child_node_data = extract_nodes(subplan)
-            node_data['Plans'].append(child_node_data)
-
-    return node_data
+    """ Extract the nodes into a nested dictionary representing the plan tree, starting from the given plan. """
+    extracted = {}  # id(plan dict) -> its node_data
+    for node, parent, _, _ in walk_with_parents(plan):
+        node_data = {
+            'Node Type': node['Node Type'],
+            'Startup Cost': node['Startup Cost'],
+            'Total Cost': node['Total Cost'],
+            'Plan Rows': node['Plan Rows'],
+            'Plan Width': node['Plan Width'],
+            'Actual Total Time': node['Actual Total Time'],
+            'Actual Rows': node['Actual Rows'],
+            'Plans': []
+        }
+        extracted[id(node)] = node_data
+        # Parents come first in pre-order, so children are appended in their original order
+        if parent is not None:
+            extracted[id(parent)]['Plans'].append(node_data)
+    return extracted[id(plan)]
 
 
 def flatten_list(nested_list):
@@ -128,33 +1016,295 @@ def flatten_list(nested_list):
     Flattens a nested list into a single-level list.
     """
     flattened = []
-    for item in nested_list:
-        if isinstance(item, list):
-            flattened.extend(flatten_list(item))
-        else:
+    stack = [iter(nested_list)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, list):
+                stack.append(iter(item))
+                break
             flattened.append(item)
+        else:
+            stack.pop()
     return flattened
 
 
 def extract_node_types(plan):
-    """ Extract the node types from the nested dictionary representation of the plan tree. """
-    # This function extracts the node types from the nested dictionary
-    node_types = [plan['Node Type']]
+    """ Extract the node types of the plan tree, in pre-order. """
+    return [node['Node Type'] for node in preorder(plan)]
+
+
+# EXPLAIN JSON keys kept on each PlanNode: (attribute name, default when the key is absent).
+# Actual fields are missing without ANALYZE and Shared fields without BUFFERS.
+PLAN_FIELDS = {
+    'Node Type': ('node_type', ''),
+    'Parent Relationship': ('parent_relationship', None),
+    'Relation Name': ('relation_name', ''),
+    'Alias': ('alias', ''),
+    'Startup Cost': ('startup_cost', 0.0),
+    'Total Cost': ('total_cost', 0.0),
+    'Plan Rows': ('plan_rows', 0),
+    'Plan Width': ('plan_width', 0),
+    'Actual Startup Time': ('actual_startup_time', None),
+    'Actual Total Time': ('actual_total_time', None),
+    'Actual Rows': ('actual_rows', None),
+    'Actual Loops': ('actual_loops', None),
+    'Shared Hit Blocks': ('shared_hit_blocks', 0),
+    'Shared Read Blocks': ('shared_read_blocks', 0),
+    'Shared Written Blocks': ('shared_written_blocks', 0),
+    'Parallel Aware': ('parallel_aware', False),
+    'Workers Planned': ('workers_planned', None),
+    'Workers Launched': ('workers_launched', None),
+    # Memory use and spills, with ANALYZE: kB, batch counts and temp file I/O
+    'Sort Method': ('sort_method', None),
+    'Sort Space Used': ('sort_space_used', None),
+    'Sort Space Type': ('sort_space_type', None),
+    'Hash Batches': ('hash_batches', None),
+    'Original Hash Batches': ('original_hash_batches', None),
+    'Peak Memory Usage': ('peak_memory_usage', None),
+    'HashAgg Batches': ('hashagg_batches', None),
+    'Disk Usage': ('disk_usage', None),
+    'Temp Read Blocks': ('temp_read_blocks', 0),
+    'Temp Written Blocks': ('temp_written_blocks', 0),
+    'Temp I/O Read Time': ('temp_io_read_time', None),
+    'Temp I/O Write Time': ('temp_io_write_time', None),
+}
+_PLAN_FIELD_ITEMS = tuple((key, attr, default) for key, (attr, default) in PLAN_FIELDS.items())
+
+
+class PlanNode:
+    """ One node of a parsed query execution plan. The tree is built once per EXPLAIN result by build_plan
+    and shared by the graph, tree view and cost table. node['Node Type'] style access is supported so the
+    cost functions accept PlanNodes as well as the dicts returned by parse_plan. """
+    __slots__ = tuple(attr for attr, _ in PLAN_FIELDS.values()) + ('depth', 'children')
+
+    def __init__(self, plan, depth=0):
+        # Pre-order builds every parent before its children and hands the children out left to right
+        nodes = {}  # id(plan dict) -> its PlanNode
+        for node_plan, parent_plan, _, node_depth in walk_with_parents(plan):
+            if parent_plan is None:
+                node = self
+            else:
+                node = PlanNode.__new__(PlanNode)
+                nodes[id(parent_plan)].children.append(node)
+            node._load(node_plan, depth + node_depth)
+            nodes[id(node_plan)] = node
+
+    def _load(self, plan, depth):
+        for key, attr, default in _PLAN_FIELD_ITEMS:
+            setattr(self, attr, plan.get(key, default))
+        self.depth = depth
+        self.children = []
+
+    def __getitem__(self, key):
+        return getattr(self, PLAN_FIELDS[key][0])
+
+    def get(self, key, default=None):
+        if key not in PLAN_FIELDS:
+            return default
+        value = getattr(self, PLAN_FIELDS[key][0])
+        return default if value is None else value
+
+    def __repr__(self):
+        return f"PlanNode({self.node_type!r}, children={len(self.children)})"
+
+    def walk(self):
+        """ Yields this node and all of its descendants in pre-order. """
+        return preorder(self)
+
+
+@traced('build_plan')
+def build_plan(plan_data):
+    """ Builds the PlanNode tree from a decoded EXPLAIN (FORMAT JSON) result and returns its root. """
+    return PlanNode(plan_data[0]['Plan'])
+
+
+def _node_signature(node):
+    return node.node_type, node.relation_name
+
+
+def align_plans(old_root, new_root):
+    """ Pairs up the nodes of two plan trees and returns a list of (old node, new node) in pre-order of the
+    new tree, followed by the old nodes that have no counterpart (paired with None). Children are matched
+    by node type and relation first, in order, and the rest by position, so the work is linear in the
+    number of nodes. A new node without counterpart is paired with None as the old node. """
+    pairs = []
+    removed = []
+    stack = [(old_root, new_root)]
+    while stack:
+        old, new = stack.pop()
+        if new is None:
+            removed.extend((node, None) for node in old.walk())
+            continue
+        pairs.append((old, new))
+        if old is None:
+            stack.extend((None, child) for child in reversed(new.children))
+            continue
+
+        # Old children with the same signature are handed out in their original order
+        by_signature = {}
+        for child in old.children:
+            by_signature.setdefault(_node_signature(child), deque()).append(child)
+        matched = []
+        used = set()
+        for child in new.children:
+            candidates = by_signature.get(_node_signature(child))
+            match = candidates.popleft() if candidates else None
+            if match is not None:
+                used.add(id(match))
+            matched.append(match)
+        leftover = deque(child for child in old.children if id(child) not in used)
+        for i, match in enumerate(matched):
+            if match is None and leftover:
+                matched[i] = leftover.popleft()
+
+        children = list(zip(matched, new.children)) + [(child, None) for child in leftover]
+        stack.extend(reversed(children))
+    return pairs + removed
+
+
+def diff_plans(old_root, new_root):
+    """ Compares two plans of the same query node by node (see align_plans). Returns a list of
+    (old node, new node, status, changes) where status is 'regression', 'improvement', 'changed' or None
+    and changes describes every difference beyond the PLAN_DIFF_* thresholds. """
+    diffs = []
+    for old, new in align_plans(old_root, new_root):
+        if old is None:
+            diffs.append((None, new, 'changed', [f"new {new.node_type} node"]))
+            continue
+        if new is None:
+            diffs.append((old, None, 'changed', [f"{old.node_type} node removed"]))
+            continue
+
+        changes = []
+        worse = better = False
+        if old.node_type != new.node_type:
+            changes.append(f"{old.node_type} -> {new.node_type}")
+
+        old_time, new_time = old.actual_total_time, new.actual_total_time
+        if old_time is not None and new_time is not None and max(old_time, new_time) >= PLAN_DIFF_MIN_TIME:
+            ratio = (new_time + 1e-9) / (old_time + 1e-9)
+            if ratio >= PLAN_DIFF_TIME_RATIO or ratio <= 1 / PLAN_DIFF_TIME_RATIO:
+                changes.append(f"time {old_time:.2f} -> {new_time:.2f} ms")
+                worse, better = worse or ratio > 1, better or ratio < 1
+
+        old_error, new_error = estimate_error(old), estimate_error(new)
+        if new_error is not None and new_error >= PLAN_DIFF_ROW_ERROR and (old_error is None or new_error > old_error):
+            changes.append(f"rows estimated {new.plan_rows}, actual {new.actual_rows}")
+            worse = True
+
+        read_growth = new.shared_read_blocks - old.shared_read_blocks
+        if abs(read_growth) >= PLAN_DIFF_READ_BLOCKS:
+            changes.append(f"shared read {old.shared_read_blocks} -> {new.shared_read_blocks} blocks")
+            worse, better = worse or read_growth > 0, better or read_growth < 0
+
+        if worse:
+            status = 'regression'
+        elif better:
+            status = 'improvement'
+        elif changes:
+            status = 'changed'
+        else:
+            status = None
+        diffs.append((old, new, status, changes))
+    return diffs
+
+
+def _subtree_relation(node):
+    """ The first relation read below a node, to tell e.g. which table's rows a sort spilled. """
+    for descendant in node.walk():
+        if descendant.relation_name:
+            return descendant.relation_name
+    return None
+
+
+def _hash_work_mem(node, hash_mem_multiplier):
+    # Peak Memory Usage is that of the largest batch, the hash table limit is work_mem * hash_mem_multiplier
+    return (node.peak_memory_usage or 0) * node.hash_batches / hash_mem_multiplier
+
+
+def _temp_io_time(node):
+    return (node.temp_io_read_time or 0.0) + (node.temp_io_write_time or 0.0)
 
-    # Recursively add the node types from sub-plans
-    if 'Plans' in plan:
-        for subplan in plan['Plans']:
-            node_types.append(extract_node_types(subplan))
-    # return node_types
-    return flatten_list(node_types)
 
+@traced('detect_spills')
+def detect_spills(root):
+    """ Nodes of an EXPLAIN ANALYZE plan that ran out of work_mem: sorts that went to disk, hashes that needed
+    more than one batch, hash aggregates that spilled, and any other node writing temp files. Returns a list
+    of dicts in pre-order with 'node', 'relation' (first relation below it), 'detail' (what happened),
+    'temp_blocks' (its own temp blocks read and written), 'work_mem_kb' (work_mem that would have kept it
+    in memory, None where it cannot be told) and 'saving_ms' (time its temp I/O took: the I/O timings if
+    track_io_timing was on, else SPILL_MS_PER_TEMP_BLOCK per block, at most the node's self time). """
+    hash_mem_multiplier = float(server_setting('hash_mem_multiplier', DEFAULT_HASH_MEM_MULTIPLIER))
+    spills = []
+    for hotspot in plan_hotspots(root):
+        node = hotspot['node']
+        temp_blocks = node.temp_read_blocks + node.temp_written_blocks
+        for child in node.children:
+            temp_blocks -= child.temp_read_blocks + child.temp_written_blocks
+        temp_blocks = max(temp_blocks, 0)
 
+        detail, work_mem_kb = None, None
+        if node.sort_space_type == 'Disk' or (node.sort_method or '').startswith('external'):
+            detail = f"{node.sort_method}, {(node.sort_space_used or 0) / 1024:.1f} MB on disk"
+            work_mem_kb = (node.sort_space_used or 0) * SPILL_MEMORY_FACTOR
+        elif (node.hash_batches or 0) > 1:
+            detail = f"{node.hash_batches} batches"
+            if node.original_hash_batches is not None and node.original_hash_batches != node.hash_batches:
+                detail += f" (planned {node.original_hash_batches})"
+            work_mem_kb = _hash_work_mem(node, hash_mem_multiplier)
+        elif node.node_type == 'Hash Join' and temp_blocks > 0 and any(
+                (child.hash_batches or 0) > 1 for child in node.children):
+            # The join writes its outer rows out per batch of its Hash
+            hash_node = next(child for child in node.children if (child.hash_batches or 0) > 1)
+            detail = f"outer side split into {hash_node.hash_batches} batches"
+            work_mem_kb = _hash_work_mem(hash_node, hash_mem_multiplier)
+        elif (node.hashagg_batches or 0) > 1 or (node.disk_usage or 0) > 0:
+            detail = f"{node.hashagg_batches or 1} batches, {(node.disk_usage or 0) / 1024:.1f} MB on disk"
+            work_mem_kb = ((node.peak_memory_usage or 0) + (node.disk_usage or 0) * SPILL_MEMORY_FACTOR) / hash_mem_multiplier
+        elif temp_blocks > 0:
+            detail = f"{temp_blocks} temp blocks"
+        if detail is None:
+            continue
+
+        if node.temp_io_read_time is not None or node.temp_io_write_time is not None:
+            saving_ms = _temp_io_time(node)
+            for child in node.children:
+                saving_ms -= _temp_io_time(child)
+            saving_ms = max(saving_ms, 0.0)
+        else:
+            saving_ms = temp_blocks * SPILL_MS_PER_TEMP_BLOCK
+        if hotspot['self_time'] is not None:
+            saving_ms = min(saving_ms, hotspot['self_time'])
+        spills.append({
+            'node': node,
+            'relation': _subtree_relation(node),
+            'detail': detail,
+            'temp_blocks': temp_blocks,
+            'work_mem_kb': work_mem_kb,
+            'saving_ms': saving_ms,
+        })
+    return spills
+
+
+def format_work_mem(kb):
+    """ A work_mem setting of at least kb kB, rounded up to whole MB: '64MB'. """
+    return f"{max(int(np.ceil(kb / 1024)), 1)}MB"
+
+
+def top_hotspots(hotspots, n=HOTSPOT_TOP_N):
+    """ The n nodes with the largest self time, or self cost for plans without ANALYZE data. """
+    if any(hotspot['self_time'] is not None for hotspot in hotspots):
+        key = lambda hotspot: hotspot['self_time'] or 0.0
+    else:
+        key = lambda hotspot: hotspot['self_cost']
+    return sorted(hotspots, key=key, reverse=True)[:n]
+
+
+@traced('parse_plan')
 def parse_plan(plan):
-    # print(plan)
-    # print(type(plan))
     nodes = []
 
-    def recurse(node):
+    for node in preorder(plan):
         # Basic node details
         node_info = {
             'Node Type': node['Node Type'],
@@ -162,117 +1312,497 @@ def parse_plan(plan):
             'Total Cost': node['Total Cost'],
             'Plan Rows': node['Plan Rows'],
             'Plan Width': node['Plan Width'],
-            'Actual Rows': node['Actual Rows'],
-            'Shared Hit Blocks': node['Shared Hit Blocks'],
-            'Shared Read Blocks': node['Shared Read Blocks'],
-            'Shared Written Blocks': node['Shared Written Blocks'],
+            'Actual Rows': node.get('Actual Rows', 0),
+            'Actual Startup Time': node.get('Actual Startup Time'),
+            'Actual Total Time': node.get('Actual Total Time'),
+            'Actual Loops': node.get('Actual Loops'),
+            'Shared Hit Blocks': node.get('Shared Hit Blocks', 0),
+            'Shared Read Blocks': node.get('Shared Read Blocks', 0),
+            'Shared Written Blocks': node.get('Shared Written Blocks', 0),
+            'Parallel Aware': node.get('Parallel Aware', False),
+            'Sort Method': node.get('Sort Method'),
+            'Sort Space Used': node.get('Sort Space Used'),
+            'Sort Space Type': node.get('Sort Space Type'),
+            'Hash Batches': node.get('Hash Batches'),
+            'Original Hash Batches': node.get('Original Hash Batches'),
+            'Peak Memory Usage': node.get('Peak Memory Usage'),
+            'HashAgg Batches': node.get('HashAgg Batches'),
+            'Disk Usage': node.get('Disk Usage'),
+            'Temp Read Blocks': node.get('Temp Read Blocks', 0),
+            'Temp Written Blocks': node.get('Temp Written Blocks', 0),
             # 'Relation Name': node['Relation Name'] if 'Relation Name' in node else '',
             # 'Alias': node['Alias'] if 'Alias' in node else '',
             # 'Parent Relationship': node['Parent Relationship'] if 'Parent Relationship' in node else None
         }
         nodes.append(node_info)
-        
-        # Recursive parse subplans if they exist
-        if 'Plans' in node:
-            for subplan in node['Plans']:
-                recurse(subplan)
 
-    recurse(plan)
     return nodes
 
-# def compute_expected_cost(node, params):
-#     # To update those cases with return 0
-#     if node['Node Type'] == 'Seq Scan':
-#         # Assuming each page is read sequentially
-#         page_cost = node['Plan Rows'] * params['seq_page_cost'] + node['Plan Rows'] * params['cpu_tuple_cost']
-#         return page_cost
-#     elif node['Node Type'] == 'Index Scan':
-#         # Cost per index scan typically involves random page cost due to random access nature of indexes
-#         index_scan_cost = node['Plan Rows'] * params['random_page_cost'] + node['Plan Rows'] * params['cpu_index_tuple_cost']
-#         return index_scan_cost
-#     elif node['Node Type'] == 'Hash Join':
-#         # Simplified model: cost of building the hash table plus cost of probing
-#         build_cost = node['Plan Rows'] * params['cpu_hash_cost']  # Cost to build hash table
-#         probe_cost = node['Actual Rows'] * params['cpu_operator_cost']  # Cost to probe hash table
-#         return build_cost + probe_cost
-#     elif node['Node Type'] == 'Nested Loop':
-#         # Outer plan and inner plan were not saved in the node relationships so no calculations possible for now
-#         # For Nested Loops, the cost is the outer plan cost plus the inner plan cost multiplied by the number of rows in the outer plan
-#         # outer_plan_cost = compute_expected_cost(node['Outer Plan'], params)  # This function should be called on the outer plan node
-#         # inner_plan_cost = compute_expected_cost(node['Inner Plan'], params)  # This function should be called on the inner plan node
-#         # nested_loop_cost = outer_plan_cost + (inner_plan_cost * node['Outer Plan']['Plan Rows'])
-#         return 0
-#         # return nested_loop_cost
-#     elif node['Node Type'] == 'Hash':
-#         # Simplified model: cost of building the hash table plus cost of probing
-#         build_cost = node['Plan Rows'] * params['cpu_hash_cost']  # Cost to build hash table
-#         # probe_cost = node['Actual Rows'] * params['cpu_operator_cost']  # Cost to probe hash table
-#         return build_cost
-#     elif node['Node Type'] == 'Memoize':
-#         # Assuming memoization involves a fixed cost for cache lookup and a variable cost if a cache miss occurs
-#         cache_lookup_cost = params['cpu_operator_cost']  # Cost for looking up in the cache
-#         cache_miss_cost = node['Plan Rows'] * params['cpu_operator_cost']  # Assume each miss incurs some cost
-#         memoize_cost = cache_lookup_cost + cache_miss_cost
-#         return memoize_cost
-#     return 0
-
-
-def compute_expected_cost(node, params):
-    # To update those cases with return 0
-    total_blocks_accessed = (
-    node['Shared Hit Blocks'] +
-    node['Shared Read Blocks'] +
-    node['Shared Written Blocks']
-)
-    if node['Node Type'] == 'Seq Scan':
-        # Assuming each page is read sequentially
-        page_cost =  total_blocks_accessed * params['seq_page_cost'] + node['Plan Rows'] * params['cpu_tuple_cost'] 
-        return page_cost
-    elif node['Node Type'] == 'Index Scan':
-        # Cost per index scan typically involves random page cost due to random access nature of indexes
-        index_scan_cost =  total_blocks_accessed * params['random_page_cost'] + node['Plan Rows'] * params['cpu_index_tuple_cost']
-        return index_scan_cost
-    elif node['Node Type'] == 'Hash Join':
-        # Simplified model: cost of building the hash table plus cost of probing
-        # build_cost = node['Shared Hit Blocks'] * params['cpu_hash_cost']  # Cost to build hash table
-        probe_cost =  total_blocks_accessed * params['seq_page_cost'] +node['Plan Rows'] * (params['cpu_hash_cost'] + params['cpu_operator_cost'])  # Cost to probe hash table
-        return probe_cost
-    elif node['Node Type'] == 'Nested Loop':
-        # Outer plan and inner plan were not saved in the node relationships so no calculations possible for now
-        # For Nested Loops, the cost is the outer plan cost plus the inner plan cost multiplied by the number of rows in the outer plan
-        # outer_plan_cost = compute_expected_cost(node['Outer Plan'], params)  # This function should be called on the outer plan node
-        # inner_plan_cost = compute_expected_cost(node['Inner Plan'], params)  # This function should be called on the inner plan node
-        # nested_loop_cost = outer_plan_cost + (inner_plan_cost * node['Outer Plan']['Plan Rows'])
-        nested_loop_cost =   total_blocks_accessed* params['seq_page_cost'] +node['Plan Rows'] * params['cpu_operator_cost'] 
-        # return 0  
-        return nested_loop_cost
-    elif node['Node Type'] == 'Hash':
-        # Simplified model: cost of building the hash table plus cost of probing
-        build_cost =  total_blocks_accessed* params['seq_page_cost'] +  (node['Plan Rows']* params['cpu_hash_cost']) # Cost to build hash table
-        # probe_cost = node['Actual Rows'] * params['cpu_operator_cost']  # Cost to probe hash table
-        return build_cost
-    elif node['Node Type'] == 'Memoize':
-        # Assuming memoization involves a fixed cost for cache lookup and a variable cost if a cache miss occurs
-        cache_lookup_cost = params['cpu_operator_cost']  # Cost for looking up in the cache
-        cache_miss_cost = total_blocks_accessed * params['cpu_operator_cost']  # Assume each miss incurs some cost
-        memoize_cost = cache_lookup_cost + cache_miss_cost
-        return memoize_cost
-    elif node['Node Type'] == 'Aggregate':
-        aggregate_cost = node['Plan Rows'] * params['cpu_operator_cost'] 
-        return aggregate_cost
-    return 0
+
+# The work each plan node does itself, as blocks * a + rows * b + rows * log2(rows) * c + d where a, b, c and
+# d are sums of cost_params: node type -> (parameters charged per block, per row, per row and log2 level, once).
+# Blocks are the node's own buffer and temp file accesses for one execution, rows its Plan Rows. Modelled on the
+# planner's costsize.c with the same parameters, so that node by node the result is comparable to Total Cost.
+COST_FORMULAS = {
+    # Scans
+    'Seq Scan': (['seq_page_cost'], ['cpu_tuple_cost'], [], []),
+    'Sample Scan': (['random_page_cost'], ['cpu_tuple_cost'], [], []),
+    'Index Scan': (['random_page_cost'], ['cpu_index_tuple_cost'], [], []),
+    'Index Only Scan': (['random_page_cost'], ['cpu_index_tuple_cost'], [], []),
+    'Bitmap Index Scan': (['random_page_cost'], ['cpu_index_tuple_cost'], [], []),
+    'Bitmap Heap Scan': (['random_page_cost'], ['cpu_tuple_cost', 'cpu_operator_cost'], [], []),
+    'BitmapAnd': ([], [], [], ['cpu_operator_cost']),
+    'BitmapOr': ([], [], [], ['cpu_operator_cost']),
+    'Tid Scan': (['random_page_cost'], ['cpu_tuple_cost'], [], []),
+    'Tid Range Scan': (['seq_page_cost'], ['cpu_tuple_cost'], [], []),
+    'Foreign Scan': (['seq_page_cost'], ['cpu_tuple_cost'], [], []),
+    'Custom Scan': (['seq_page_cost'], ['cpu_tuple_cost'], [], []),
+    'Function Scan': ([], ['cpu_tuple_cost', 'cpu_operator_cost'], [], []),
+    'Table Function Scan': ([], ['cpu_tuple_cost', 'cpu_operator_cost'], [], []),
+    'Values Scan': ([], ['cpu_tuple_cost', 'cpu_operator_cost'], [], []),
+    'CTE Scan': ([], ['cpu_tuple_cost'], [], []),
+    'Named Tuplestore Scan': ([], ['cpu_tuple_cost'], [], []),
+    'WorkTable Scan': ([], ['cpu_tuple_cost'], [], []),
+    'Subquery Scan': ([], ['cpu_tuple_cost'], [], []),
+    'Result': ([], ['cpu_tuple_cost'], [], []),
+    'ProjectSet': ([], ['cpu_tuple_cost'], [], []),
+    # Joins
+    'Nested Loop': (['seq_page_cost'], ['cpu_operator_cost'], [], []),
+    'Hash Join': (['seq_page_cost'], ['cpu_hash_cost', 'cpu_operator_cost'], [], []),
+    'Merge Join': (['seq_page_cost'], ['cpu_tuple_cost', 'cpu_operator_cost'], [], []),
+    'Hash': (['seq_page_cost'], ['cpu_hash_cost'], [], []),
+    # Sorting and caching. A sort compares at 2 * cpu_operator_cost per row and level, like cost_sort.
+    'Sort': (['seq_page_cost'], ['cpu_operator_cost'], ['cpu_operator_cost', 'cpu_operator_cost'], []),
+    'Incremental Sort': (['seq_page_cost'], ['cpu_operator_cost'], ['cpu_operator_cost', 'cpu_operator_cost'], []),
+    'Materialize': (['seq_page_cost'], ['cpu_operator_cost', 'cpu_operator_cost'], [], []),
+    'Memoize': (['cpu_operator_cost'], [], [], ['cpu_operator_cost']),
+    # Grouping
+    'Aggregate': ([], ['cpu_operator_cost'], [], []),
+    'Group': ([], ['cpu_operator_cost'], [], []),
+    'WindowAgg': ([], ['cpu_tuple_cost', 'cpu_operator_cost'], [], []),
+    'Unique': ([], ['cpu_operator_cost'], [], []),
+    'SetOp': ([], ['cpu_operator_cost'], [], []),
+    # Passing rows on. The planner charges Append half a cpu_tuple_cost per row, close to cpu_operator_cost.
+    'Append': ([], ['cpu_operator_cost'], [], []),
+    'Merge Append': ([], ['cpu_tuple_cost', 'cpu_operator_cost'], [], []),
+    'Recursive Union': ([], ['cpu_tuple_cost'], [], []),
+    'Limit': ([], [], [], []),
+    'LockRows': ([], ['cpu_tuple_cost'], [], []),
+    'ModifyTable': (['random_page_cost'], ['cpu_tuple_cost'], [], []),
+    # Parallelism: starting the workers, then moving every row from a worker to the leader
+    'Gather': ([], ['parallel_tuple_cost'], [], ['parallel_setup_cost']),
+    'Gather Merge': ([], ['parallel_tuple_cost', 'cpu_operator_cost', 'cpu_operator_cost'], [], ['parallel_setup_cost']),
+}
+COST_PARAM_NAMES = list(cost_params)
+
+# Node types with a formula. Their index is the node type code used by the batch cost functions;
+# every other node type gets code 0 and costs nothing itself.
+COST_NODE_TYPES = ['Other'] + list(COST_FORMULAS)
+NODE_TYPE_CODES = {node_type: code for code, node_type in enumerate(COST_NODE_TYPES)}
+
+
+def parallel_divisor(workers):
+    """ Number of processes the planner divides the rows of a parallel plan among, as in costsize.c: the
+    workers plus the part of the leader's time not spent gathering their results. """
+    leader_contribution = 1.0 - 0.3 * workers
+    return workers + max(leader_contribution, 0.0)
+
+
+def _total_blocks(node):
+    return (node.get('Shared Hit Blocks', 0) + node.get('Shared Read Blocks', 0) + node.get('Shared Written Blocks', 0) +
+            node.get('Temp Read Blocks', 0) + node.get('Temp Written Blocks', 0))
+
+
+def _self_blocks(node):
+    """ Buffer and temp file accesses of a node minus those of its children, over all loops and processes.
+    Temp blocks are what a sort or hash that spilled to disk wrote and read back. """
+    blocks = _total_blocks(node)
+    for child in plan_children(node):
+        blocks -= _total_blocks(child)
+    return max(blocks, 0)
+
+
+def _child_scale(child, parent, child_no):
+    """ How many times the cost of one execution of child is paid for one execution of parent. """
+    parent_type = parent['Node Type']
+    if parent_type in ('Gather', 'Gather Merge'):
+        # Below a Gather every process runs its share of the plan at the same time, costs are per process
+        return 1.0
+    if parent_type == 'Limit':
+        # The child stops once the limit is reached: its startup work, then the fetched share of the rest,
+        # split as in the planner's own Startup and Total Cost
+        if not child['Plan Rows'] or not child['Total Cost']:
+            return 1.0
+        startup_share = child['Startup Cost'] / child['Total Cost']
+        return startup_share + (1.0 - startup_share) * min(1.0, parent['Plan Rows'] / child['Plan Rows'])
+    if child.get('Parallel Aware'):
+        # Shared among however many processes of the parallel section reach it
+        return 1.0
+    child_loops = child.get('Actual Loops')
+    parent_loops = parent.get('Actual Loops')
+    if child_loops is not None and parent_loops is not None:
+        return child_loops / parent_loops if parent_loops else 0.0
+    if parent_type == 'Nested Loop' and child_no == 1:
+        # Without ANALYZE: the inner side is rescanned for every estimated outer row
+        return max(plan_children(parent)[0]['Plan Rows'], 1)
+    return 1.0
+
+
+def _cost_walk(root):
+    """ Yields (node, parent index, depth, rows scale, child scale) for every node of a plan in pre-order.
+    The rows scale corrects the per-process Plan Rows below a Gather that launched fewer workers than
+    planned; the child scale is _child_scale. The root has parent index -1. """
+    indexes = {}  # id(node) -> pre-order index
+    rows_scales = {}  # id(node) -> rows scale of its children
+    for index, (node, parent, child_no, depth) in enumerate(walk_with_parents(root)):
+        indexes[id(node)] = index
+        if parent is None:
+            rows_scale, child_scale, parent_index = 1.0, 1.0, -1
+        else:
+            rows_scale = rows_scales[id(parent)]
+            child_scale = _child_scale(node, parent, child_no)
+            parent_index = indexes[id(parent)]
+        children_scale = rows_scale
+        planned, launched = node.get('Workers Planned'), node.get('Workers Launched')
+        if planned and launched is not None:
+            children_scale = parallel_divisor(planned) / parallel_divisor(launched)
+        rows_scales[id(node)] = children_scale
+        yield node, parent_index, depth, rows_scale, child_scale
+
+
+def _formula_sums(formula, params):
+    return [sum(params[name] for name in names) for names in formula]
+
+
+def compute_expected_cost(node, params, rows_scale=1.0):
+    """ Expected cost of the work a node does itself (COST_FORMULAS) in one execution by one process.
+    Buffer accesses are the node's own, averaged over Actual Loops; a parallel aware node shares one scan
+    among its processes and is charged all of it. Children are taken from 'Plans' or .children, a node
+    without them (e.g. from parse_plan) is charged its total blocks. rows_scale multiplies Plan Rows. """
+    formula = COST_FORMULAS.get(node['Node Type'])
+    if formula is None:
+        return 0
+    per_block, per_row, per_row_log, once = _formula_sums(formula, params)
+    loops = node.get('Actual Loops') or 1
+    blocks = _self_blocks(node) / (1 if node.get('Parallel Aware') else loops)
+    rows = node['Plan Rows'] * rows_scale
+    return blocks * per_block + rows * per_row + rows * np.log2(max(rows, 2)) * per_row_log + once
+
+
+@traced('expected_plan_costs')
+def expected_plan_costs(root, params):
+    """ Expected Total Cost of every node of a plan, in pre-order: the node's compute_expected_cost plus
+    the expected cost of each child times the number of times the child runs per execution of the node
+    (Actual Loops, or the outer rows of a Nested Loop without ANALYZE). Scalar reference implementation of
+    compute_expected_costs. """
+    walk = list(_cost_walk(root))
+    totals = [compute_expected_cost(node, params, rows_scale) for node, _, _, rows_scale, _ in walk]
+    for index in range(len(walk) - 1, 0, -1):
+        _, parent_index, _, _, child_scale = walk[index]
+        totals[parent_index] += totals[index] * child_scale
+    return totals
+
+
+def cost_param_matrices():
+    """ COST_FORMULAS as four (node type code, parameter) count matrices for blocks, rows, row log levels and
+    constants, so that a = A @ params etc. Parameters follow COST_PARAM_NAMES. """
+    matrices = np.zeros((4, len(COST_NODE_TYPES), len(COST_PARAM_NAMES)))
+    for node_type, terms in COST_FORMULAS.items():
+        code = NODE_TYPE_CODES[node_type]
+        for matrix, names in zip(matrices, terms):
+            for name in names:
+                matrix[code, COST_PARAM_NAMES.index(name)] += 1
+    return matrices
+
+
+def cost_coefficients(params):
+    """ Expresses each COST_FORMULAS entry as blocks * a + rows * b + rows * log2(rows) * c + d and returns
+    the a, b, c and d arrays indexed by node type code. """
+    values = np.array([params[name] for name in COST_PARAM_NAMES])
+    a, b, c, d = cost_param_matrices() @ values
+    return a, b, c, d
+
+
+# Node type codes the batch child scaling looks at
+_LIMIT_CODE = NODE_TYPE_CODES['Limit']
+_NESTED_LOOP_CODE = NODE_TYPE_CODES['Nested Loop']
+_GATHER_CODES = [NODE_TYPE_CODES['Gather'], NODE_TYPE_CODES['Gather Merge']]
+
+
+@traced('flatten_plans')
+def flatten_plans(plans, on_error=None):
+    """ Flattens one or more plans into a columnar node table (dict of NumPy arrays, one entry per node in
+    pre-order). Each plan may be a PlanNode or the 'Plan' dict of an EXPLAIN (FORMAT JSON) result;
+    the 'plan' column holds the index of the plan each node came from, 'parent' the row of its parent
+    (-1 for roots). One pass collects the raw fields, self blocks and child scales (see _self_blocks and
+    _child_scale) are then derived with NumPy over the parent column.
+    A malformed plan raises, unless on_error is given: it is then called with (plan index, error) and the
+    plan is left out of the table. """
+    rows = []  # one tuple of raw fields per node, unpacked into columns below
+    node_types = []
+    children_scales = []  # rows scale a node passes on to its children
+    nan = float('nan')
+    for i, root in enumerate(plans):
+        first = len(rows)
+        indexes = {}  # id(node) -> its row
+        try:
+            for node, parent_node, child_no, depth in walk_with_parents(root):
+                indexes[id(node)] = len(rows)
+                parent = -1 if parent_node is None else indexes[id(parent_node)]
+                get = node.get
+                node_type = node['Node Type']
+                node_loops = get('Actual Loops')
+                rows_scale = 1.0 if parent < 0 else children_scales[parent]
+                rows.append((i, NODE_TYPE_CODES.get(node_type, 0), float(node['Plan Rows']),
+                             get('Shared Hit Blocks', 0), get('Shared Read Blocks', 0), get('Shared Written Blocks', 0),
+                             get('Temp Read Blocks', 0) + get('Temp Written Blocks', 0), get('Startup Cost', 0.0),
+                             float(node['Total Cost']), parent, child_no, depth,
+                             nan if node_loops is None else node_loops, bool(get('Parallel Aware')), rows_scale))
+                node_types.append(node_type)
+                planned, launched = get('Workers Planned'), get('Workers Launched')
+                if planned and launched is not None:
+                    rows_scale = parallel_divisor(planned) / parallel_divisor(launched)
+                children_scales.append(rows_scale)
+        except (KeyError, TypeError, ValueError, AttributeError) as error:
+            if on_error is None:
+                raise
+            del rows[first:], node_types[first:], children_scales[first:]
+            on_error(i, error)
+
+    (plan_index, codes, plan_rows, hit, read, written, temp, startup_cost, total_cost, parents, child_nos, depths,
+     actual_loops, parallel_aware, rows_scales) = np.array(rows, dtype=np.float64).reshape(-1, 15).T
+    codes = codes.astype(np.int16)
+    parents = parents.astype(np.int64)
+    parallel_aware = parallel_aware.astype(bool)
+    n = len(codes)
+
+    # Own blocks: the node's total minus those of its children
+    blocks = hit + read + written + temp
+    has_parent = parents >= 0
+    self_blocks = np.maximum(blocks - np.bincount(parents[has_parent], weights=blocks[has_parent], minlength=n), 0.0)
+
+    # Child scale, by the same rules and in the same precedence as _child_scale
+    parent = np.where(has_parent, parents, 0)
+    parent_code = codes[parent]
+    parent_loops = actual_loops[parent]
+    child_scale = np.ones(n)
+    loops_known = ~np.isnan(actual_loops) & ~np.isnan(parent_loops)
+    nested_loop_inner = ~loops_known & (parent_code == _NESTED_LOOP_CODE) & (child_nos == 1)
+    outer_rows = plan_rows[np.minimum(parent + 1, max(n - 1, 0))]  # The first child follows its parent
+    child_scale[nested_loop_inner] = np.maximum(outer_rows[nested_loop_inner], 1)
+    loop_ratio = np.zeros(n)
+    np.divide(actual_loops, parent_loops, out=loop_ratio, where=loops_known & (parent_loops != 0))
+    child_scale[loops_known] = loop_ratio[loops_known]
+    child_scale[parallel_aware] = 1.0
+    limit = (parent_code == _LIMIT_CODE) & has_parent
+    partial = limit & (plan_rows > 0) & (total_cost > 0)
+    startup_share = np.divide(startup_cost, total_cost, out=np.ones(n), where=partial)
+    fetched = np.minimum(1.0, np.divide(plan_rows[parent], plan_rows, out=np.ones(n), where=partial))
+    child_scale[limit] = 1.0
+    child_scale[partial] = (startup_share + (1.0 - startup_share) * fetched)[partial]
+    child_scale[np.isin(parent_code, _GATHER_CODES)] = 1.0
+    child_scale[~has_parent] = 1.0
+
+    return {
+        'plan': plan_index.astype(np.int64),
+        'node_type': codes,
+        'node_type_name': np.array(node_types, dtype=object),
+        'plan_rows': plan_rows,
+        'shared_hit_blocks': hit,
+        'shared_read_blocks': read,
+        'shared_written_blocks': written,
+        'total_cost': total_cost,
+        'parent': parents,
+        'depth': depths.astype(np.int64),
+        'loops': np.where(np.isnan(actual_loops) | (actual_loops == 0), 1.0, actual_loops),
+        'parallel_aware': parallel_aware,
+        'self_blocks': self_blocks,
+        'rows_scale': rows_scales,
+        'child_scale': child_scale,
+    }
+
+
+@traced('compute_expected_costs')
+def compute_expected_costs(node_table, params):
+    """ Batch version of expected_plan_costs over a node table from flatten_plans.
+    Returns (expected cost, discrepancy against Total Cost) arrays. """
+    a, b, c, d = cost_coefficients(params)
+    codes = node_table['node_type']
+    blocks = node_table['self_blocks'] / np.where(node_table['parallel_aware'], 1.0, node_table['loops'])
+    rows = node_table['plan_rows'] * node_table['rows_scale']
+    expected = blocks * a[codes] + rows * b[codes] + rows * np.log2(np.maximum(rows, 2)) * c[codes] + d[codes]
+
+    # Add children into their parents, deepest level first; each level is one vectorized step
+    depth = node_table['depth']
+    order = np.argsort(depth, kind='stable')
+    level_starts = np.searchsorted(depth[order], np.arange(depth.max(initial=0) + 2))
+    for level in range(len(level_starts) - 2, 0, -1):
+        children = order[level_starts[level]:level_starts[level + 1]]
+        np.add.at(expected, node_table['parent'][children], expected[children] * node_table['child_scale'][children])
+    return expected, node_table['total_cost'] - expected
+
+
+# Only these are PostgreSQL settings, cpu_hash_cost exists in the cost model alone
+PG_COST_SETTINGS = ['seq_page_cost', 'random_page_cost', 'cpu_tuple_cost', 'cpu_index_tuple_cost', 'cpu_operator_cost',
+                    'parallel_tuple_cost', 'parallel_setup_cost']
+
+
+def calibration_features(plans):
+    """ Builds the least squares problem behind calibrate_cost_params from EXPLAIN ANALYZE plans (PlanNode
+    roots). Returns (X, y): one row per node with a cost formula and timing data, X holding how many times
+    each cost parameter is charged for the work the node actually did (exclusive blocks, Actual Rows times
+    loops, the same times log2 of the rows per loop, loops) and y its exclusive time in ms. """
+    matrices = cost_param_matrices()
+    charged = matrices.any(axis=(0, 2))  # Node types that cost anything
+    codes, blocks, rows, row_logs, loops, self_times = [], [], [], [], [], []
+    for root in plans:
+        for hotspot in plan_hotspots(root):
+            node = hotspot['node']
+            code = NODE_TYPE_CODES.get(node.node_type, 0)
+            if not charged[code] or hotspot['self_time'] is None:
+                continue
+            node_loops = node.actual_loops or 1
+            node_rows = node.actual_rows or 0
+            codes.append(code)
+            blocks.append(hotspot['self_hit_blocks'] + hotspot['self_read_blocks'] + hotspot['self_written_blocks'])
+            rows.append(node_rows * node_loops)
+            row_logs.append(node_rows * node_loops * np.log2(max(node_rows, 2)))
+            loops.append(node_loops)
+            self_times.append(hotspot['self_time'])
+
+    block_counts, row_counts, row_log_counts, const_counts = matrices
+    codes = np.array(codes, dtype=np.int64)
+    X = (np.array(blocks, dtype=np.float64)[:, None] * block_counts[codes] +
+         np.array(rows, dtype=np.float64)[:, None] * row_counts[codes] +
+         np.array(row_logs, dtype=np.float64)[:, None] * row_log_counts[codes] +
+         np.array(loops, dtype=np.float64)[:, None] * const_counts[codes])
+    return X, np.array(self_times, dtype=np.float64)
+
+
+def _nnls(A, b):
+    """ Non-negative least squares, min ||A x - b|| subject to x >= 0, by the Lawson-Hanson active set method.
+    Columns are scaled to unit norm first, the cost parameters differ by orders of magnitude. """
+    norms = np.linalg.norm(A, axis=0)
+    norms[norms == 0] = 1.0
+    A = A / norms
+    n = A.shape[1]
+    tol = 10 * np.finfo(float).eps * max(A.shape) * max(np.abs(A).sum(axis=0).max(initial=0.0), 1.0)
+    x = np.zeros(n)
+    passive = np.zeros(n, dtype=bool)
+    for _ in range(3 * n):
+        gradient = A.T @ (b - A @ x)
+        if passive.all() or gradient[~passive].max() <= tol:
+            break
+        passive[np.argmax(np.where(passive, -np.inf, gradient))] = True
+        while True:
+            # Unconstrained solution on the passive set, step back towards x while any of it is not positive
+            z = np.zeros(n)
+            z[passive] = np.linalg.lstsq(A[:, passive], b, rcond=None)[0]
+            if (z[passive] > tol).all():
+                break
+            blocking = passive & (z <= tol)
+            alpha = np.min(x[blocking] / (x[blocking] - z[blocking]))
+            x += alpha * (z - x)
+            passive &= x > tol
+            x[~passive] = 0.0
+            if not passive.any():
+                z = x
+                break
+        x = z
+    return x / norms
+
+
+def _collinear_columns(A):
+    """ Indexes of the columns of A (none all zero) that take part in a linear dependency, whose weights the
+    data cannot separate from each other. """
+    if A.shape[1] == 0:
+        return []
+    _, singular_values, vt = np.linalg.svd(A / np.linalg.norm(A, axis=0))
+    # Same rank tolerance as np.linalg.matrix_rank
+    rank = (singular_values > singular_values.max() * max(A.shape) * np.finfo(float).eps).sum()
+    null_space = vt[rank:]
+    return [i for i in range(A.shape[1]) if (np.abs(null_space[:, i]) > 1e-8).any()]
+
+
+def calibrate_cost_params(plans, params=cost_params):
+    """ Fits the cost parameters to the measured exclusive node times of EXPLAIN ANALYZE plans by
+    non-negative least squares. The fit is in ms per unit of work; like PostgreSQL's own settings the
+    result is scaled so seq_page_cost keeps its value in params, with the ms per cost unit reported separately.
+    Only parameters the plans determine are returned: those without data are listed in 'fixed', those that
+    came out at zero or cannot be told apart from another parameter (collinear) in 'undetermined'.
+    Returns a dict with 'params', 'ms_per_cost_unit', 'rmse' (ms per node), 'r2', 'nodes', 'fixed' and
+    'undetermined', or None without usable nodes. """
+    X, y = calibration_features(plans)
+    if len(y) == 0:
+        return None
+
+    weights = np.zeros(X.shape[1])
+    with_data = np.flatnonzero(X.any(axis=0))
+    weights[with_data] = _nnls(X[:, with_data], y)
+
+    residual = y - X @ weights
+    total = ((y - y.mean()) ** 2).sum()
+    fixed = [COST_PARAM_NAMES[i] for i in range(X.shape[1]) if i not in with_data]
+    # NNLS may zero one of two collinear parameters and give the other their combined weight
+    collinear = {with_data[i] for i in _collinear_columns(X[:, with_data])}
+    undetermined = [COST_PARAM_NAMES[i] for i in with_data if weights[i] <= 0 or i in collinear]
+    determined = [name for name in COST_PARAM_NAMES if name not in fixed and name not in undetermined]
+    # Express the weights relative to seq_page_cost, or to the first determined parameter at its given value
+    anchor = 'seq_page_cost' if 'seq_page_cost' in determined else (determined[0] if determined else None)
+    scale = weights[COST_PARAM_NAMES.index(anchor)] / params[anchor] if anchor else 0.0
+    return {
+        'params': {name: float(weights[COST_PARAM_NAMES.index(name)] / scale) for name in determined},
+        'ms_per_cost_unit': float(scale),
+        'rmse': float(np.sqrt((residual ** 2).mean())),
+        'r2': float(1 - (residual ** 2).sum() / total) if total > 0 else 1.0,
+        'nodes': len(y),
+        'fixed': fixed,
+        'undetermined': undetermined,
+    }
+
+
+def cost_params_sql(params):
+    """ SET statements applying fitted cost parameters to a session. """
+    lines = [f"SET {name} = {params[name]:.6g};" for name in PG_COST_SETTINGS if name in params]
+    lines += [f"-- {name} = {params[name]:.6g} (cost model only, not a server setting)"
+              for name in params if name not in PG_COST_SETTINGS]
+    return "\n".join(lines)
+
+
+def validate_cost_model(plans, params=cost_params, on_error=None):
+    """ How well expected costs track the planner's Total Cost over a corpus of plans (PlanNodes or 'Plan'
+    dicts): a DataFrame with one row per node type, ordered by node count, holding the number of nodes,
+    the median expected / Total Cost ratio and the share of nodes within a factor of 2. Node types without
+    a formula are marked in the 'modelled' column. on_error is passed to flatten_plans, malformed plans
+    are then left out instead of raising. """
+    node_table = flatten_plans(plans, on_error=on_error)
+    expected, _ = compute_expected_costs(node_table, params)
+    actual = node_table['total_cost']
+    usable = actual > 0
+    ratio = np.divide(expected, actual, out=np.full_like(expected, np.nan), where=usable)
+    df = pd.DataFrame({
+        'node_type': node_table['node_type_name'],
+        'ratio': ratio,
+        'within_2x': (ratio >= 0.5) & (ratio <= 2.0),
+    })
+    summary = df.groupby('node_type').agg(nodes=('ratio', 'size'), median_ratio=('ratio', 'median'),
+                                          within_2x=('within_2x', 'mean'))
+    summary['modelled'] = summary.index.isin(list(COST_FORMULAS))
+    return summary.sort_values('nodes', ascending=False)
 
 
 def analyze_qep(json_input):
+    """ Returns a per-node report of expected cost, actual cost and discrepancy for an EXPLAIN JSON text. """
     # Load JSON data
-    plan_data = json.loads(json_input)
-    plan = plan_data[0]['Plan']
+    plan_data = decode_json(json_input)
 
     # Parse and compute costs
-    nodes = parse_plan(plan)
-    for node in nodes:
-        expected_cost = compute_expected_cost(node, cost_params)
-        print(f"Node: {node['Node Type']}")
-        print(f"Expected: {expected_cost:.2f}")
-        print(f"Actual: {node['Total Cost']}")
-        print(f"Discrepancy: {node['Total Cost'] - expected_cost:.2f}\n")
\ No newline at end of file
+    root = build_plan(plan_data)
+    expected_costs, _ = compute_expected_costs(flatten_plans([root]), cost_params)
+    report = []
+    for node, expected_cost in zip(root.walk(), expected_costs):
+        report.append(f"Node: {node['Node Type']}\n"
+                      f"Expected: {expected_cost:.2f}\n"
+                      f"Actual: {node['Total Cost']}\n"
+                      f"Discrepancy: {node['Total Cost'] - expected_cost:.2f}\n")
+    return '\n'.join(report)
\ No newline at end of file
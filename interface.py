@@ -7,9 +7,9 @@ from PySide6.QtWidgets import (
     QHBoxLayout,
     QWidget,
     QTreeView,
+    QTableView,
+    QHeaderView,
     QGraphicsItem,
-    QGraphicsTextItem,
-    QGraphicsEllipseItem,
     QGraphicsView,
     QGraphicsScene,
     QGraphicsLineItem,
@@ -18,65 +18,233 @@ from PySide6.QtWidgets import (
     QLabel,
     QMessageBox,
     QLineEdit,
+    QCheckBox,
+    QFileDialog,
+    QTabWidget,
+    QSpinBox,
+    QComboBox,
 )
-from PySide6.QtCore import QRectF, Qt
+from PySide6.QtCore import QRectF, QLineF, QPointF, Qt, QObject, QRunnable, QThreadPool, QTimer, Signal, QAbstractTableModel, QAbstractItemModel, QModelIndex
 from PySide6.QtGui import (
-    QStandardItemModel,
-    QStandardItem,
     QBrush,
     QColor,
     QPen,
     QWheelEvent,
     QPainter,
+    QPainterPath,
+    QPixmap,
+    QFont,
+    QFontMetrics,
     QMouseEvent
 )
-import sys, json
+import sys, json, time, math
 from explain import *
+import tracing
+from tracing import Trace, activate, span, traced
+from plan_traversal import walk_with_parents
 
-cost_params = {
-    'seq_page_cost': 1.0,
-    'random_page_cost': 4.0,
-    'cpu_tuple_cost': 0.01,
-    'cpu_operator_cost': 0.0025,
-    'cpu_index_tuple_cost': 0.005,
-    'cpu_hash_cost': 0.0025
+
+# Horizontal distance between neighbouring leaves and vertical distance between levels of the plan graph
+GRAPH_X_STEP = 160
+GRAPH_Y_STEP = 80
+
+# The QEP tree view initially expands this many levels, stopping early once this many rows are shown
+TREE_EXPAND_DEPTH = 8
+TREE_EXPAND_MAX_ROWS = 500
+
+# Below this view scale the plan graph is drawn as a single overview item instead of individual nodes
+GRAPH_DETAIL_MIN_SCALE = 0.4
+
+# Node fill colors used when comparing a plan with the previous run of its query, see diff_plans
+PLAN_DIFF_COLORS = {
+    'regression': QColor('tomato'),
+    'improvement': QColor('lightgreen'),
+    'changed': QColor('gold'),
 }
 
+# Nodes taking at least this share of the plan's self time (or self cost) are tinted towards HOTSPOT_COLOR
+HOTSPOT_MIN_SHARE = 0.05
+HOTSPOT_COLOR = QColor(220, 40, 40)
+
+# Background of the spill columns of nodes that ran out of work_mem
+SPILL_COLOR = QColor(255, 200, 170)
+
+
+def hotspot_color(share):
+    """ White for cold nodes, shading to HOTSPOT_COLOR as a node's share of the plan time grows. """
+    if share < HOTSPOT_MIN_SHARE:
+        return QColor('white')
+    weight = math.sqrt(min(share, 1.0))
+    return QColor(round(255 + (HOTSPOT_COLOR.red() - 255) * weight),
+                  round(255 + (HOTSPOT_COLOR.green() - 255) * weight),
+                  round(255 + (HOTSPOT_COLOR.blue() - 255) * weight))
+
+@traced('layout_plan')
+def layout_plan(root, x_step=GRAPH_X_STEP, y_step=GRAPH_Y_STEP):
+    """ Tidy tree layout of a PlanNode tree: leaves take consecutive slots from left to right and every parent
+    is centred over its first and last child, so subtrees never overlap. Iterative and linear in the number
+    of nodes, and free of Qt objects so it can run on a worker thread.
+    Returns [key, node, parent index, x, y] entries in pre-order. The key is the node's pre-order index, unique
+    within the plan, and is used to diff the scene between plans. """
+    entries = []
+    indexes = {}  # id(node) -> its entry index
+    for node, parent_node, child_no, depth in walk_with_parents(root):
+        parent = -1 if parent_node is None else indexes[id(parent_node)]
+        key = indexes[id(node)] = len(entries)
+        entries.append([key, node, parent, 0.0, depth * y_step])
+
+    # Pre-order visits leaves from left to right
+    first_child = {}
+    last_child = {}
+    slot = 0
+    for index, entry in enumerate(entries):
+        parent = entry[2]
+        if parent >= 0:
+            first_child.setdefault(parent, index)
+            last_child[parent] = index
+        if not entry[1].children:
+            entry[3] = slot * x_step
+            slot += 1
+
+    # Every node comes after its parent in pre-order, so a reverse pass places children before their parents
+    for index in range(len(entries) - 1, -1, -1):
+        if index in first_child:
+            entries[index][3] = (entries[first_child[index]][3] + entries[last_child[index]][3]) / 2
+    return entries
+
 
 class GraphNode(QGraphicsItem):
+    """ A plan node drawn as a white ellipse with its label. Painted directly (no child items) from a label
+    pixmap shared by every node with the same label, and cached in device coordinates. """
+    label_pixmaps = {}
+
     def __init__(self, label, parent=None):
         super().__init__(parent)
         self.label = label
+        self.color = QColor('white')
         self.setFlag(QGraphicsItem.ItemIsMovable)
+        self.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+
+        self.label_pixmap = self.label_glyphs(label)
+        width = self.label_pixmap.width() / self.label_pixmap.devicePixelRatio()
+        height = self.label_pixmap.height() / self.label_pixmap.devicePixelRatio()
+        self.label_pos = QPointF(-width / 2, -height / 2)
+        # Ellipse around the text
+        self.rect = QRectF(-(width + 20) / 2, -(height + 20) / 2, width + 20, height + 20)
+
+    @classmethod
+    def label_glyphs(cls, label):
+        """ Renders a label once, at twice the resolution so it stays sharp when zoomed in. """
+        pixmap = cls.label_pixmaps.get(label)
+        if pixmap is None:
+            font = QFont()
+            text_rect = QFontMetrics(font).boundingRect(label).adjusted(-4, -4, 4, 4)
+            pixmap = QPixmap(text_rect.width() * 2, text_rect.height() * 2)
+            pixmap.setDevicePixelRatio(2)
+            pixmap.fill(Qt.transparent)
+            painter = QPainter(pixmap)
+            painter.setRenderHint(QPainter.TextAntialiasing)
+            painter.setFont(font)
+            painter.setPen(QColor("black"))
+            painter.drawText(QRectF(0, 0, text_rect.width(), text_rect.height()), Qt.AlignCenter, label)
+            painter.end()
+            cls.label_pixmaps[label] = pixmap
+        return pixmap
+
+    def set_color(self, color):
+        if color != self.color:
+            self.color = color
+            self.update()
 
-        # Add a text item as a child of this item
-        self.text_item = QGraphicsTextItem(label, self)
-        self.text_item.setDefaultTextColor(QColor("black"))
-        self.text_item.setZValue(1)
-        rect = self.text_item.boundingRect()
+    def boundingRect(self):
+        return self.rect
 
-        # Optionally add an ellipse or rectangle around the text
-        self.background_item = QGraphicsEllipseItem(-(rect.width()+20)/2, -(rect.height()+20)/2, rect.width()+20, rect.height()+20, self)
-        self.background_item.setBrush(QBrush(QColor('white')))
-        self.background_item.setPen(QPen(QColor('white')))
-        self.background_item.setZValue(0.8)
+    def paint(self, painter, option, widget=None):
+        painter.setPen(QPen(QColor('white')))
+        painter.setBrush(QBrush(self.color))
+        painter.drawEllipse(self.rect)
+        painter.drawPixmap(self.label_pos, self.label_pixmap)
 
-        self.text_item.setPos(-rect.width() / 2, -rect.height() /2)
+
+class GraphLayer(QGraphicsItem):
+    """ Invisible parent of all GraphNodes and edges, so they can be shown or hidden together. """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setFlag(QGraphicsItem.ItemHasNoContents)
 
     def boundingRect(self):
-        return self.background_item.boundingRect()
+        return QRectF()
 
     def paint(self, painter, option, widget=None):
-        # The painting is handled by the child items
         pass
 
 
+class PlanOverview(QGraphicsItem):
+    """ Draws a whole plan as one path of node boxes and one path of edges, without labels.
+    Shown instead of the GraphNodes when zoomed out far enough that labels are unreadable. """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.node_path = QPainterPath()
+        self.edge_path = QPainterPath()
+        self.bounds = QRectF()
+
+    def set_layout(self, layout, graph_items):
+        node_path = QPainterPath()
+        edge_path = QPainterPath()
+        for key, node, parent, x, y in layout:
+            node_path.addRect(graph_items[key][0].rect.translated(x, y))
+            if parent >= 0:
+                edge_path.moveTo(layout[parent][3], layout[parent][4])
+                edge_path.lineTo(x, y)
+        self.prepareGeometryChange()
+        self.node_path = node_path
+        self.edge_path = edge_path
+        self.bounds = node_path.boundingRect().united(edge_path.boundingRect())
+
+    def boundingRect(self):
+        return self.bounds
+
+    def paint(self, painter, option, widget=None):
+        edge_pen = QPen(QColor('white'))
+        edge_pen.setCosmetic(True)
+        painter.setPen(edge_pen)
+        painter.drawPath(self.edge_path)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QBrush(QColor('white')))
+        painter.drawPath(self.node_path)
+
+
+def bsp_tree_depth(item_count):
+    """ BSP depth that leaves roughly ten scene items per leaf of the index. """
+    return min(16, max(4, math.ceil(math.log2(max(item_count, 1) / 10 + 1))))
+
+
 class GraphicsView(QGraphicsView):
     def __init__(self, scene, parent=None):
         super().__init__(scene, parent)
         self.setRenderHints(QPainter.Antialiasing | QPainter.SmoothPixmapTransform)
         self.setDragMode(QGraphicsView.ScrollHandDrag)
+        self.setOptimizationFlags(QGraphicsView.DontSavePainterState | QGraphicsView.DontAdjustForAntialiasing)
         # self.setBackgroundBrush(QBrush(Qt.black))
+        self.detail_layer = None
+        self.overview = None
+
+    def set_plan_layers(self, detail_layer, overview):
+        self.detail_layer = detail_layer
+        self.overview = overview
+        self.update_level_of_detail()
+
+    def update_level_of_detail(self):
+        """ Switches between individual GraphNodes and the single PlanOverview item depending on the zoom. """
+        if self.detail_layer is None:
+            return
+        zoomed_out = self.transform().m11() < GRAPH_DETAIL_MIN_SCALE
+        self.overview.setVisible(zoomed_out)
+        self.detail_layer.setVisible(not zoomed_out)
+        self.setRenderHint(QPainter.Antialiasing, not zoomed_out)
+        self.setRenderHint(QPainter.SmoothPixmapTransform, not zoomed_out)
 
     def wheelEvent(self, event: QWheelEvent):
         factor = 1.1  # This is the zoom factor
@@ -84,6 +252,7 @@ class GraphicsView(QGraphicsView):
             self.scale(factor, factor)
         else:
             self.scale(1 / factor, 1 / factor)
+        self.update_level_of_detail()
 
     def mousePressEvent(self, event: QMouseEvent):
         if event.button() == Qt.MiddleButton:
@@ -96,6 +265,248 @@ class GraphicsView(QGraphicsView):
         super().mouseReleaseEvent(event)
 
 
+class ResultTableModel(QAbstractTableModel):
+    """ Table model over column arrays. Cells are only formatted when the view asks for them,
+    so populating it costs the same for 100 or 1M rows. """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.col_names = []
+        self.columns = []
+        self.row_count = 0
+
+    def set_dataframe(self, df):
+        self.beginResetModel()
+        self.col_names = [str(name) for name in df.columns]
+        # By position: with repeated column names (count(*), count(x)) df[name] is a 2-D frame
+        self.columns = [df.iloc[:, i].to_numpy() for i in range(df.shape[1])]
+        self.row_count = df.shape[0]
+        self.endResetModel()
+
+    def clear(self):
+        self.beginResetModel()
+        self.col_names = []
+        self.columns = []
+        self.row_count = 0
+        self.endResetModel()
+
+    def append_rows(self, col_names, rows):
+        """ Appends a chunk of row tuples, transposed into the column lists. """
+        if not self.col_names:
+            self.beginResetModel()
+            self.col_names = list(col_names)
+            self.columns = [[] for _ in col_names]
+            self.endResetModel()
+        self.beginInsertRows(QModelIndex(), self.row_count, self.row_count + len(rows) - 1)
+        for column, values in zip(self.columns, zip(*rows)):
+            column.extend(values)
+        self.row_count += len(rows)
+        self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.row_count
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.col_names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return str(self.columns[index.column()][index.row()])
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.col_names[section]
+        return str(section + 1)
+
+
+class PlanTreeModel(QAbstractItemModel):
+    """ Tree model over a PlanNode tree. Child rows are only exposed, FETCH_BATCH at a time, when the view
+    expands a branch or scrolls to its end, so memory follows what has been shown rather than the plan size. """
+    HEADERS = ['Node', 'Cost', 'Planned Rows', 'Actual Rows', 'Actual Total Time (ms)']
+    FETCH_BATCH = 100
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.root = None
+        self.fetched = {}  # id(node) -> number of children exposed so far
+        self.parents = {}  # id(node) -> (parent node, row), only for exposed nodes
+
+    def set_plan(self, root):
+        self.beginResetModel()
+        self.root = root
+        self.fetched = {}
+        self.parents = {id(root): (None, 0)}
+        self.endResetModel()
+
+    def node(self, index):
+        return index.internalPointer() if index.isValid() else None
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not parent.isValid():
+            if self.root is None or row != 0:
+                return QModelIndex()
+            return self.createIndex(row, column, self.root)
+        node = self.node(parent)
+        if row >= self.fetched.get(id(node), 0):
+            return QModelIndex()
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index=QModelIndex()):
+        if not index.isValid():
+            return QModelIndex()
+        parent_node, _ = self.parents[id(self.node(index))]
+        if parent_node is None:
+            return QModelIndex()
+        return self.createIndex(self.parents[id(parent_node)][1], 0, parent_node)
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return 0 if self.root is None else 1
+        if parent.column() > 0:
+            return 0
+        return self.fetched.get(id(self.node(parent)), 0)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.HEADERS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return self.root is not None
+        return parent.column() == 0 and bool(self.node(parent).children)
+
+    def canFetchMore(self, parent):
+        if not parent.isValid():
+            return False
+        node = self.node(parent)
+        return self.fetched.get(id(node), 0) < len(node.children)
+
+    def fetchMore(self, parent):
+        node = self.node(parent)
+        start = self.fetched.get(id(node), 0)
+        end = min(start + self.FETCH_BATCH, len(node.children))
+        if end <= start:
+            return
+        self.beginInsertRows(parent, start, end - 1)
+        for row in range(start, end):
+            self.parents[id(node.children[row])] = (node, row)
+        self.fetched[id(node)] = end
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        node = self.node(index)
+        column = index.column()
+        if column == 0:
+            return node.node_type
+        if column == 1:
+            return f"{node.total_cost}"
+        if column == 2:
+            return f"{node.plan_rows}"
+        if column == 3:
+            return f"{node.get('Actual Rows', '')}"
+        return f"{node.get('Actual Total Time', '')}"
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+
+class QueryWorkerSignals(QObject):
+    progress = Signal(str)
+    rows = Signal(object, object)
+    finished = Signal(object)
+
+
+class QueryWorker(QRunnable):
+    """ Runs a submitted query on a QThreadPool thread so the GUI stays responsive. """
+
+    def __init__(self, sql_query, trace=None, mode='analyze', statement_timeout=0, use_cache=True):
+        super().__init__()
+        self.setAutoDelete(False)  # MainWindow keeps the reference until the result is delivered
+        self.sql_query = sql_query
+        self.mode = mode
+        self.statement_timeout = statement_timeout  # ms, 0 for none
+        self.use_cache = use_cache
+        self.trace = trace  # Spans of this submit, None while tracing is off
+        self.signals = QueryWorkerSignals()
+        self.db_conn = None
+        self.cancelled = False
+        self.streamed_rows = 0
+        self.started_at = time.perf_counter()
+
+    def run(self):
+        # finished is always emitted, MainWindow only lets go of the worker and stops the progress display then
+        try:
+            with activate(self.trace):
+                plan, df, total_rows = run_query(self.sql_query, on_connection=self.set_connection,
+                                                 progress=self.signals.progress.emit, on_chunk=self.signals.rows.emit,
+                                                 use_cache=self.use_cache, mode=self.mode,
+                                                 statement_timeout=self.statement_timeout,
+                                                 cancelled=lambda: self.cancelled)
+                # Lay the graph out here as well, the GUI thread only has to move scene items
+                layout = layout_plan(plan) if isinstance(plan, PlanNode) else None
+        except Exception as e:
+            plan, df, total_rows, layout = f"Error executing query: {e}", None, 0, None
+        self.signals.finished.emit((plan, df, total_rows, layout))
+
+    def set_connection(self, db_conn):
+        # A cancel before the first statement is picked up by run_query through self.cancelled
+        self.db_conn = db_conn
+
+    def cancel(self):
+        """ Asks the server to cancel the running statement. Safe to call from the GUI thread. """
+        self.cancelled = True
+        db_conn = self.db_conn
+        if db_conn is not None:
+            db_conn.cancel()
+
+
+class WhatIfWorker(QRunnable):
+    """ Runs what_if for a query and a list of variants on a QThreadPool thread. """
+
+    def __init__(self, sql_query, variants, analyze_top):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.sql_query = sql_query
+        self.variants = variants
+        self.analyze_top = analyze_top
+        self.signals = QueryWorkerSignals()
+
+    def run(self):
+        # finished is always emitted, with an error message if what_if itself fails
+        try:
+            results = what_if(self.sql_query, self.variants, self.analyze_top)
+        except Exception as e:
+            results = f"What-if failed: {e}"
+        self.signals.finished.emit(results)
+
+
+class WorkloadWorker(QRunnable):
+    """ Runs explain_workload on a QThreadPool thread, reporting each statement's result as it completes. """
+
+    def __init__(self, statements, analyze, concurrency):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.statements = statements
+        self.analyze = analyze
+        self.concurrency = concurrency
+        self.signals = QueryWorkerSignals()
+
+    def run(self):
+        # finished is always emitted, with an error message if explain_workload itself fails
+        try:
+            results = explain_workload(self.statements, self.analyze, self.concurrency,
+                                       on_result=lambda result: self.signals.rows.emit(result['index'], result))
+        except Exception as e:
+            results = f"Workload failed: {e}"
+        self.signals.finished.emit(results)
+
+
 class LoginWindow(QWidget):
     def __init__(self):
         super().__init__()
@@ -146,11 +557,22 @@ class LoginWindow(QWidget):
         port_layout.addWidget(port_label)
         port_layout.addWidget(self.port_input)
 
+        # Number of pooled connections, which bounds how many queries run at once
+        pool_size_label = QLabel("Connections:")
+        self.pool_size_input = QSpinBox()
+        self.pool_size_input.setRange(1, 64)
+        self.pool_size_input.setValue(POOL_MAX_SIZE)
+        self.pool_size_input.setFixedSize(500, 30)
+        pool_size_layout = QHBoxLayout()
+        pool_size_layout.addWidget(pool_size_label)
+        pool_size_layout.addWidget(self.pool_size_input)
+
         login_layout.addLayout(db_layout)
         login_layout.addLayout(user_input_layout)
         login_layout.addLayout(pwd_layout)
         login_layout.addLayout(host_layout)
         login_layout.addLayout(port_layout)
+        login_layout.addLayout(pool_size_layout)
 
         self.btn_login = QPushButton('Login')
         self.btn_login.clicked.connect(self.onLogin)
@@ -176,8 +598,7 @@ class LoginWindow(QWidget):
         host = self.host_input.toPlainText().strip()
         port = self.port_input.toPlainText().strip()
         pwd = self.pwd_input.text().strip()
-        print(pwd)
-        login_credentials(db, user, pwd, host, port)
+        login_credentials(db, user, pwd, host, port, max_size=self.pool_size_input.value())
         QMessageBox.information(self, "Success", "Login credentials saved!")
 
         self.open_main_window()
@@ -210,16 +631,99 @@ class MainWindow(QMainWindow):
         left_layout = QVBoxLayout()
 
         self.scene = QGraphicsScene()
+        self.graph_items = {}  # layout key -> (GraphNode, edge to parent), see draw_plan_graph
         self.view = GraphicsView(self.scene)
         self.view.setRenderHint(QPainter.Antialiasing)  # For smoother graphics
         self.view.setBackgroundBrush(QBrush(Qt.black))
         left_layout.addWidget(self.view)
 
-        self.table_widget = QTableWidget()
-        self.table_widget.setEditTriggers(QTableWidget.NoEditTriggers)
-        self.table_widget.setAlternatingRowColors(True)
-        self.table_widget.setFixedHeight(180)
-        left_layout.addWidget(self.table_widget)
+        self.graph_layer = GraphLayer()
+        self.plan_overview = PlanOverview()
+        self.scene.addItem(self.graph_layer)
+        self.scene.addItem(self.plan_overview)
+        self.view.set_plan_layers(self.graph_layer, self.plan_overview)
+
+        self.result_model = ResultTableModel()
+        self.result_view = QTableView()
+        self.result_view.setModel(self.result_model)
+        self.result_view.setEditTriggers(QTableView.NoEditTriggers)
+        self.result_view.setAlternatingRowColors(True)
+        # Fixed row heights and sampled column widths keep the view independent of the row count
+        self.result_view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.result_view.horizontalHeader().setResizeContentsPrecision(100)
+        self.analysis_tabs = QTabWidget()
+        self.analysis_tabs.addTab(self.result_view, "Results")
+        left_layout.addWidget(self.analysis_tabs)
+
+        # What-if mode: the query planned under alternative settings and hypothetical indexes
+        what_if_tab = QWidget()
+        what_if_layout = QVBoxLayout(what_if_tab)
+        self.variant_input = QTextEdit()
+        self.variant_input.setPlaceholderText("One variant per line, items separated by ';', e.g.\n"
+                                              "enable_hashjoin = off; work_mem = 256MB\n"
+                                              "CREATE INDEX ON lineitem (l_shipdate)")
+        self.variant_input.setFixedHeight(70)
+        what_if_layout.addWidget(self.variant_input)
+
+        self.btn_what_if = QPushButton('Run What-If')
+        self.btn_what_if.clicked.connect(self.onWhatIf)
+        self.what_if_analyze = QCheckBox(f'Confirm top {WHAT_IF_ANALYZE_TOP} with ANALYZE')
+        what_if_buttons = QHBoxLayout()
+        what_if_buttons.addWidget(self.btn_what_if)
+        what_if_buttons.addWidget(self.what_if_analyze)
+        what_if_layout.addLayout(what_if_buttons)
+
+        self.what_if_table = QTableWidget()
+        self.what_if_table.setColumnCount(6)
+        self.what_if_table.setHorizontalHeaderLabels(['Variant', 'Estimated Cost', 'vs Baseline', 'Actual Time (ms)',
+                                                      'Top Node', 'Error'])
+        self.what_if_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.what_if_table.setSelectionBehavior(QTableWidget.SelectRows)
+        self.what_if_table.cellDoubleClicked.connect(self.on_what_if_selected)
+        what_if_layout.addWidget(self.what_if_table)
+        self.analysis_tabs.addTab(what_if_tab, "What-If")
+
+        # Workload mode: every statement of the query box explained concurrently
+        workload_tab = QWidget()
+        workload_layout = QVBoxLayout(workload_tab)
+        self.btn_workload = QPushButton('Run Workload')
+        self.btn_workload.clicked.connect(self.onWorkload)
+        self.workload_analyze = QCheckBox('ANALYZE')
+        self.workload_concurrency = QSpinBox()
+        # More concurrent statements than pooled connections would only wait for a connection
+        self.workload_concurrency.setRange(1, pool_size())
+        self.workload_concurrency.setValue(pool_size())
+        self.workload_concurrency.setPrefix("Concurrency: ")
+        workload_buttons = QHBoxLayout()
+        workload_buttons.addWidget(self.btn_workload)
+        workload_buttons.addWidget(self.workload_analyze)
+        workload_buttons.addWidget(self.workload_concurrency)
+        workload_layout.addLayout(workload_buttons)
+
+        self.workload_table = QTableWidget()
+        self.workload_table.setColumnCount(8)
+        self.workload_table.setHorizontalHeaderLabels(['#', 'Statement', 'Total Time (ms)', 'Total Cost', 'Worst Node',
+                                                       'Worst Node %', 'Max Estimate Error', 'Error'])
+        self.workload_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.workload_table.setSelectionBehavior(QTableWidget.SelectRows)
+        self.workload_table.cellDoubleClicked.connect(self.on_workload_selected)
+        workload_layout.addWidget(self.workload_table)
+        self.analysis_tabs.addTab(workload_tab, "Workload")
+        self.workload_results = []
+        self.workload_worker = None
+        self.analysis_tabs.setFixedHeight(240)
+        self.what_if_results = []
+        self.what_if_worker = None
+
+        # Per-stage timings of the last submit, filled while tracing is on
+        self.timing_table = QTableWidget()
+        self.timing_table.setColumnCount(4)
+        self.timing_table.setHorizontalHeaderLabels(['Stage', 'Thread', 'Start (ms)', 'Duration (ms)'])
+        self.timing_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.timing_table.setFixedHeight(160)
+        self.timing_table.setVisible(False)
+        left_layout.addWidget(self.timing_table)
+        self.last_trace = None
 
         right_layout = QVBoxLayout()
 
@@ -229,21 +733,82 @@ class MainWindow(QMainWindow):
 
         self.btn_submit = QPushButton('Explain Cost')
         self.btn_submit.clicked.connect(self.onSubmit)
-        right_layout.addWidget(self.btn_submit)
+
+        self.btn_cancel = QPushButton('Cancel')
+        self.btn_cancel.clicked.connect(self.onCancel)
+        self.btn_cancel.setEnabled(False)
+
+        self.btn_clear_cache = QPushButton('Clear Plan Cache')
+        self.btn_clear_cache.clicked.connect(self.onClearCache)
+
+        # Guards for expensive queries, see ANALYZE_MODES
+        self.analyze_mode = QComboBox()
+        for mode, description in ANALYZE_MODES.items():
+            self.analyze_mode.addItem(description, mode)
+        self.statement_timeout = QSpinBox()
+        self.statement_timeout.setRange(0, 3600)
+        self.statement_timeout.setSpecialValueText("No timeout")
+        self.statement_timeout.setSuffix(" s timeout")
+
+        submit_layout = QHBoxLayout()
+        submit_layout.addWidget(self.btn_submit)
+        submit_layout.addWidget(self.analyze_mode)
+        submit_layout.addWidget(self.statement_timeout)
+        submit_layout.addWidget(self.btn_cancel)
+        submit_layout.addWidget(self.btn_clear_cache)
+
+        self.btn_calibrate = QPushButton('Calibrate Costs')
+        self.btn_calibrate.clicked.connect(self.onCalibrate)
+        submit_layout.addWidget(self.btn_calibrate)
+        right_layout.addLayout(submit_layout)
+
+        self.trace_checkbox = QCheckBox('Trace timings')
+        self.trace_checkbox.setChecked(tracing.enabled)
+        self.trace_checkbox.toggled.connect(self.onTraceToggled)
+
+        self.btn_export_trace = QPushButton('Export Trace')
+        self.btn_export_trace.clicked.connect(self.onExportTrace)
+        self.btn_export_trace.setEnabled(False)
+
+        trace_layout = QHBoxLayout()
+        trace_layout.addWidget(self.trace_checkbox)
+        trace_layout.addWidget(self.btn_export_trace)
+        right_layout.addLayout(trace_layout)
+
+        # Highlights what changed since the previous run of the same query
+        self.compare_checkbox = QCheckBox('Compare with previous run')
+        self.compare_checkbox.toggled.connect(lambda checked: self.color_plan_nodes())
+        right_layout.addWidget(self.compare_checkbox)
+        self.current_sql = None
+        self.current_plan = None
+        self.current_recorded = False  # Whether current_plan is in the plan history and can be compared
+        self.current_layout = []
+
+        # Queries run on worker threads, the GUI thread only renders their results
+        self.thread_pool = QThreadPool()
+        self.thread_pool.setMaxThreadCount(pool_size())
+        self.workers = []
+        self.latest_worker = None
+        self.progress_stage = ""
+        self.progress_timer = QTimer(self)
+        self.progress_timer.setInterval(250)
+        self.progress_timer.timeout.connect(self.show_progress)
 
         self.tree_label = QLabel("Query Execution Plan:")
 
         self.tree_view = QTreeView()
-        self.tree_model = QStandardItemModel()
-        header_labels = ['Node', 'Cost', 'Planned Rows', 'Actual Rows', 'Actual Total Time (ms)']
-        self.tree_model.setHorizontalHeaderLabels(header_labels)
+        self.tree_model = PlanTreeModel()
+        self.tree_view.setUniformRowHeights(True)
+        # Column widths are computed from the first rows only
+        self.tree_view.header().setResizeContentsPrecision(100)
         self.tree_view.setModel(self.tree_model)
 
         self.explain_label = QLabel("Query Execution Plan Explanation:")
 
         self.explain_table = QTableWidget()
-        self.explain_table.setColumnCount(4)
-        self.explain_table.setHorizontalHeaderLabels(['Node Type', 'Expected Cost', 'Actual Cost', 'Discrepancy'])
+        self.explain_table.setColumnCount(7)
+        self.explain_table.setHorizontalHeaderLabels(['Node Type', 'Expected Cost', 'Actual Cost', 'Discrepancy',
+                                                      'Spill', 'work_mem Needed', 'Est. Saving (ms)'])
         self.explain_table.setEditTriggers(QTableWidget.NoEditTriggers)
 
         right_layout.addWidget(self.tree_label)
@@ -251,6 +816,18 @@ class MainWindow(QMainWindow):
         right_layout.addWidget(self.explain_label)
         right_layout.addWidget(self.explain_table)
 
+        self.hotspot_label = QLabel("Hotspots (exclusive time):")
+
+        self.hotspot_table = QTableWidget()
+        self.hotspot_table.setColumnCount(7)
+        self.hotspot_table.setHorizontalHeaderLabels(['Node Type', 'Relation', 'Self Time (ms)', 'Self %',
+                                                      'Self Read Blocks', 'Self Hit Blocks', 'Misestimate'])
+        self.hotspot_table.setEditTriggers(QTableWidget.NoEditTriggers)
+
+        right_layout.addWidget(self.hotspot_label)
+        right_layout.addWidget(self.hotspot_table)
+        self.hotspots = []
+
         main_layout.addLayout(left_layout)
         main_layout.addLayout(right_layout)
 
@@ -264,122 +841,450 @@ class MainWindow(QMainWindow):
         # costs_list = []
 
         sql_query = self.query_input.toPlainText().strip()
-        plan = explain_query(sql_query)
+        # Plan, buffer statistics and the result preview all come from a single execution. A comparison
+        # needs a fresh run, a cached result would only be compared with itself
+        worker = QueryWorker(sql_query, Trace() if tracing.enabled else None, self.analyze_mode.currentData(),
+                             self.statement_timeout.value() * 1000, use_cache=not self.compare_checkbox.isChecked())
+        worker.signals.progress.connect(self.on_query_progress)
+        worker.signals.rows.connect(lambda col_names, rows, worker=worker: self.on_query_rows(worker, col_names, rows))
+        worker.signals.finished.connect(lambda result, worker=worker: self.on_query_finished(worker, result))
+        self.workers.append(worker)
+        self.latest_worker = worker
+        self.thread_pool.start(worker)
+
+        self.progress_stage = "Queued..."
+        self.btn_cancel.setEnabled(True)
+        self.progress_timer.start()
+        self.show_progress()
+
+    def onCancel(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.statusBar().showMessage("Cancelling query...")
+
+    def onClearCache(self):
+        invalidate_plan_cache()
+        self.statusBar().showMessage("Plan cache cleared.")
+
+    def onCalibrate(self):
+        """ Fits cost_params to the run times of every plan captured this session and offers to use them. """
+        result = calibrate_cost_params(recorded_plans())
+        if result is None:
+            QMessageBox.information(self, "Calibrate Costs", "No EXPLAIN ANALYZE runs with timing data recorded yet.")
+            return
 
-        self.showPlan(plan)
+        lines = [f"Fitted on {result['nodes']} plan nodes: RMSE {result['rmse']:.3f} ms per node, "
+                 f"R² {result['r2']:.3f}, {result['ms_per_cost_unit']:.4f} ms per cost unit.", ""]
+        lines += [f"{name}: {cost_params[name]:g} -> {value:.6g}" for name, value in result['params'].items()]
+        lines += [f"{name}: {cost_params[name]:g} (no data, unchanged)" for name in result['fixed']]
+        lines += [f"{name}: {cost_params[name]:g} (not determined, unchanged)" for name in result['undetermined']]
+        message = QMessageBox(self)
+        message.setWindowTitle("Calibrate Costs")
+        message.setText("\n".join(lines))
+        message.setDetailedText(cost_params_sql(result['params']))
+        message.setStandardButtons(QMessageBox.Apply | QMessageBox.Close)
+        if message.exec() == QMessageBox.Apply:
+            self.apply_cost_params(result['params'])
+
+    def apply_cost_params(self, params):
+        """ Uses params for the expected costs from now on and recomputes the current explain table. """
+        cost_params.update(params)
+        if self.current_plan is not None:
+            self.update_explain_table(self.current_plan)
+        self.statusBar().showMessage("Calibrated cost parameters applied.")
+
+    def onWhatIf(self):
+        sql_query = self.query_input.toPlainText().strip()
+        if sql_query == "":
+            self.statusBar().showMessage("Please enter a query to explain.")
+            return
+        if self.what_if_worker is not None:
+            self.statusBar().showMessage("A what-if run is already in progress.")
+            return
+        try:
+            variants = [parse_variant(line) for line in self.variant_input.toPlainText().splitlines() if line.strip()]
+        except ValueError as error:
+            self.statusBar().showMessage(str(error))
+            return
 
-        self.update_result_table(sql_query)
+        analyze_top = WHAT_IF_ANALYZE_TOP if self.what_if_analyze.isChecked() else 0
+        self.what_if_worker = WhatIfWorker(sql_query, variants, analyze_top)
+        self.what_if_worker.signals.finished.connect(self.on_what_if_finished)
+        self.thread_pool.start(self.what_if_worker)
+        self.btn_what_if.setEnabled(False)
+        self.statusBar().showMessage(f"Planning {len(variants) + 1} variants...")
+
+    def on_what_if_finished(self, results):
+        self.what_if_worker = None
+        self.btn_what_if.setEnabled(True)
+        if isinstance(results, str):
+            self.statusBar().showMessage(results)
+            return
+        self.what_if_results = results
+        baseline = next((result['cost'] for result in results if result['variant']['name'] == 'baseline'), None)
+
+        self.what_if_table.setRowCount(len(results))
+        for i, result in enumerate(results):
+            cost, plan = result['cost'], result['plan']
+            relative = f"{cost / baseline * 100:.1f}%" if cost is not None and baseline else ""
+            actual = result['actual_time']
+            self.what_if_table.setItem(i, 0, QTableWidgetItem(result['variant']['name']))
+            self.what_if_table.setItem(i, 1, QTableWidgetItem("" if cost is None else f"{cost:.2f}"))
+            self.what_if_table.setItem(i, 2, QTableWidgetItem(relative))
+            self.what_if_table.setItem(i, 3, QTableWidgetItem("" if actual is None else f"{actual:.3f}"))
+            self.what_if_table.setItem(i, 4, QTableWidgetItem("" if plan is None else plan.node_type))
+            self.what_if_table.setItem(i, 5, QTableWidgetItem(result['error'] or ""))
+        self.what_if_table.resizeColumnsToContents()
+        self.analysis_tabs.setCurrentIndex(1)
+        self.statusBar().showMessage("What-if done, double-click a variant to show its plan.")
+
+    def on_what_if_selected(self, row, column):
+        """ Shows the plan of a what-if variant in the graph, tree and cost views. """
+        plan = self.what_if_results[row]['plan']
+        if plan is None:
+            return
+        self.showPlan(plan)
         self.update_explain_table(plan)
+        self.update_hotspot_table(plan)
+        self.current_recorded = False
+        self.color_plan_nodes()
+        self.statusBar().showMessage(f"Showing the plan for variant: {self.what_if_results[row]['variant']['name']}")
+
+    def onWorkload(self):
+        statements = split_statements(self.query_input.toPlainText())
+        if not statements:
+            self.statusBar().showMessage("Please enter the statements of the workload.")
+            return
+        if self.workload_worker is not None:
+            self.statusBar().showMessage("A workload run is already in progress.")
+            return
 
+        self.workload_results = [None] * len(statements)
+        self.workload_table.setRowCount(len(statements))
+        for i, statement in enumerate(statements):
+            self.workload_table.setItem(i, 0, QTableWidgetItem(str(i + 1)))
+            self.workload_table.setItem(i, 1, QTableWidgetItem(" ".join(statement.split())[:80]))
+            for column in range(2, 8):
+                self.workload_table.setItem(i, column, QTableWidgetItem(""))
+
+        self.workload_worker = WorkloadWorker(statements, self.workload_analyze.isChecked(),
+                                              self.workload_concurrency.value())
+        self.workload_worker.signals.rows.connect(self.on_workload_result)
+        self.workload_worker.signals.finished.connect(self.on_workload_finished)
+        self.workload_started_at = time.perf_counter()
+        self.thread_pool.start(self.workload_worker)
+        self.btn_workload.setEnabled(False)
+        self.analysis_tabs.setCurrentIndex(2)
+        self.statusBar().showMessage(f"Explaining {len(statements)} statements...")
+
+    def on_workload_result(self, index, result):
+        self.workload_results[index] = result
+        if result['error'] is not None:
+            self.workload_table.setItem(index, 7, QTableWidgetItem(result['error']))
+            return
+        total_time, error = result['total_time'], result['estimate_error']
+        self.workload_table.setItem(index, 2, QTableWidgetItem("" if total_time is None else f"{total_time:.3f}"))
+        self.workload_table.setItem(index, 3, QTableWidgetItem(f"{result['total_cost']:.2f}"))
+        worst = result['worst_node']
+        self.workload_table.setItem(index, 4, QTableWidgetItem(
+            worst.node_type + (f" on {worst.relation_name}" if worst.relation_name else "")))
+        self.workload_table.setItem(index, 5, QTableWidgetItem(f"{result['worst_share'] * 100:.1f}"))
+        self.workload_table.setItem(index, 6, QTableWidgetItem("" if error is None else f"{error:.1f}x"))
+
+    def on_workload_finished(self, results):
+        self.workload_worker = None
+        self.btn_workload.setEnabled(True)
+        self.workload_table.resizeColumnsToContents()
+        if isinstance(results, str):
+            self.statusBar().showMessage(results)
+            return
+        failed = sum(result['error'] is not None for result in results)
+        elapsed = time.perf_counter() - self.workload_started_at
+        self.statusBar().showMessage(f"Workload done: {len(results)} statements in {elapsed:.1f}s, {failed} failed. "
+                                     "Double-click a statement to show its plan.")
+
+    def on_workload_selected(self, row, column):
+        """ Shows the plan of a workload statement in the graph, tree and cost views. """
+        result = self.workload_results[row]
+        if result is None or result['plan'] is None:
+            return
+        self.showPlan(result['plan'])
+        self.update_explain_table(result['plan'])
+        self.update_hotspot_table(result['plan'])
+        self.current_sql = result['sql']
+        self.current_recorded = True
+        self.color_plan_nodes()
+
+    def onTraceToggled(self, checked):
+        tracing.enabled = checked
+        self.timing_table.setVisible(checked)
+
+    def onExportTrace(self):
+        if self.last_trace is None:
+            return
+        path, _ = QFileDialog.getSaveFileName(self, "Export Trace", "trace.json", "Chrome trace (*.json)")
+        if path:
+            self.last_trace.export_chrome_trace(path)
+            self.statusBar().showMessage(f"Trace written to {path}")
+
+    def on_query_progress(self, stage):
+        self.progress_stage = stage
+        self.show_progress()
+
+    def on_query_rows(self, worker, col_names, rows):
+        # Show preview rows as soon as each chunk arrives, before the query has finished
+        if worker is not self.latest_worker:
+            return
+        if worker.streamed_rows == 0:
+            self.result_model.clear()
+        self.result_model.append_rows(col_names, rows)
+        worker.streamed_rows += len(rows)
+        self.progress_stage = f"Fetched {worker.streamed_rows} rows..."
+        self.show_progress()
+
+    def show_progress(self):
+        if not self.workers:
+            return
+        elapsed = time.perf_counter() - self.workers[-1].started_at
+        running = f" ({len(self.workers)} queries running)" if len(self.workers) > 1 else ""
+        self.statusBar().showMessage(f"{self.progress_stage} {elapsed:.1f}s{running}")
+
+    def on_query_finished(self, worker, result):
+        latest = worker is self.latest_worker
+        self.workers.remove(worker)
+        if not self.workers:
+            self.progress_timer.stop()
+            self.btn_cancel.setEnabled(False)
+
+        # Results of a query superseded by a newer submit are dropped
+        if not latest:
+            return
 
-    def display_explanation(self, plan):
-        self.explain_label.clear()
-        output_str = ""
-        
-        plan = json.loads(plan)
-        root_plan = plan[0]["Plan"]
-        nodes = parse_plan(root_plan)
-
-        for node in nodes:
-            expected_cost = compute_expected_cost(node, cost_params)
-            print(f"Node: {node['Node Type']}")
-            print(f"Expected Cost: {expected_cost:.4f}")
-            print(f"Actual Total Cost: {node['Total Cost']}")
-            print(f"Discrepancy: {node['Total Cost'] - expected_cost:.4f}\n")
-            output_str += f"Node type: \t{node['Node Type']}; Expected: {expected_cost:.4f}; Actual: {node['Total Cost']}; Discrepancy: {node['Total Cost'] - expected_cost:.4f}\n"
-
-        self.explain_label.setPlainText(output_str)
-
-    def add_nodes_edges(self, node, parent_graphics_item=None, x=0, y=0, y_step=50, depth=0):
-        # Define horizontal offset
-        x_offset = 200 // (depth + 1)
-
-        # Create the graphics item for this node
-        node_graphics_item = GraphNode(node['Node Type'])
-        node_graphics_item.setPos(x, y)
-        node_graphics_item.setZValue(1)
-        self.scene.addItem(node_graphics_item)
-
-        # If this is not the root node, draw an edge from the parent
-        if parent_graphics_item is not None:
-            line = QGraphicsLineItem(parent_graphics_item.x(), parent_graphics_item.y(), x, y)
-            line.setPen(QPen(QColor('white')))
-            line.setZValue(0.2)
-            self.scene.addItem(line)
-
-        # Recursively add child nodes
-        if 'Plans' in node:
-            child_offset = -x_offset if depth % 2 == 0 else x_offset  # Alternate left and right placement
-            for index, subplan in enumerate(node['Plans']):
-                new_x = x + (index - 0.5) * 2 * child_offset  # Position children with offset
-                self.add_nodes_edges(subplan, node_graphics_item, new_x, y + y_step, y_step, depth + 1)
-
-    def showPlan(self, plan):
-        self.scene.clear()  # Clear the scene for a new plan
-
-        plan_dict = json.loads(plan)  # Load plan from JSON string
-        root_node = plan_dict[0]['Plan']
-        self.add_nodes_edges(root_node)  # Pass the root node of the plan
-
-        self.view.fitInView(self.scene.itemsBoundingRect(), Qt.KeepAspectRatio)  # Fit the scene in the view
-
-        # # Clear the current model
-        self.tree_model.removeRows(0, self.tree_model.rowCount())
-        
-        # Recursively load the plan nodes into the table tree view
-        self.load_nodes(plan_dict[0]['Plan'], self.tree_model.invisibleRootItem())
+        plan, sql_query_results, total_rows, layout = result
+        if sql_query_results is None:
+            self.statusBar().showMessage("Query cancelled." if worker.cancelled else plan)
+            return
 
-        # Expand all nodes in the view for visibility
-        self.tree_view.expandAll()
+        # Rendering is recorded into the same trace as the worker's spans
+        with activate(worker.trace), span('render'):
+            self.showPlan(plan, layout)
+
+            self.update_result_table(sql_query_results, total_rows)
+            self.update_explain_table(plan)
+            self.update_hotspot_table(plan)
+
+            self.current_sql = worker.sql_query
+            self.current_recorded = sql_query_results.attrs.get('recorded', True)
+            self.color_plan_nodes()
+
+        if worker.trace is not None:
+            worker.trace.add('submit', worker.trace.origin, time.perf_counter_ns())
+            self.show_timings(worker.trace)
+
+    def show_timings(self, trace):
+        """ Fills the timing panel with the spans of one submit, in the order they started. """
+        self.last_trace = trace
+        self.btn_export_trace.setEnabled(True)
+        rows = trace.breakdown()
+        self.timing_table.setRowCount(len(rows))
+        for i, (name, thread, start_ms, duration_ms) in enumerate(rows):
+            self.timing_table.setItem(i, 0, QTableWidgetItem(name))
+            self.timing_table.setItem(i, 1, QTableWidgetItem(thread))
+            self.timing_table.setItem(i, 2, QTableWidgetItem(f"{start_ms:.2f}"))
+            self.timing_table.setItem(i, 3, QTableWidgetItem(f"{duration_ms:.2f}"))
+        self.timing_table.resizeColumnsToContents()
+
+    @traced('draw_plan_graph')
+    def draw_plan_graph(self, layout):
+        """ Brings the scene in line with a layout from layout_plan. Items of nodes that keep their place in
+        the tree and their node type are reused and only moved if needed, the rest are added or removed. """
+        old_items = self.graph_items
+        self.graph_items = {}
+        for key, node, parent, x, y in layout:
+            node_graphics_item, line = old_items.pop(key, (None, None))
+            if node_graphics_item is not None and node_graphics_item.label != node.node_type:
+                self.scene.removeItem(node_graphics_item)
+                node_graphics_item = None
+            if node_graphics_item is None:
+                node_graphics_item = GraphNode(node.node_type, self.graph_layer)
+                node_graphics_item.setZValue(1)
+            if node_graphics_item.pos() != QPointF(x, y):
+                node_graphics_item.setPos(x, y)
+
+            # Edge from the parent, the root has none
+            if parent >= 0:
+                edge = QLineF(layout[parent][3], layout[parent][4], x, y)
+                if line is None:
+                    line = QGraphicsLineItem(edge, self.graph_layer)
+                    line.setPen(QPen(QColor('white')))
+                    line.setZValue(0.2)
+                elif line.line() != edge:
+                    line.setLine(edge)
+            elif line is not None:
+                self.scene.removeItem(line)
+                line = None
+            self.graph_items[key] = (node_graphics_item, line)
+
+        # Whatever is left belongs to nodes that are not in the new plan
+        for node_graphics_item, line in old_items.values():
+            self.scene.removeItem(node_graphics_item)
+            if line is not None:
+                self.scene.removeItem(line)
+
+    @traced('showPlan')
+    def showPlan(self, plan, layout=None):
+        if layout is None:
+            layout = layout_plan(plan)
+        self.current_plan = plan
+        self.current_layout = layout
+        self.scene.setBspTreeDepth(bsp_tree_depth(2 * len(layout)))
+        self.draw_plan_graph(layout)  # Only changed nodes and edges are touched
+        self.plan_overview.set_layout(layout, self.graph_items)
+
+        self.view.fitInView(self.plan_overview.boundingRect(), Qt.KeepAspectRatio)  # Fit the scene in the view
+        self.view.update_level_of_detail()
+
+        # The tree model wraps the plan directly, rows are created as branches are expanded
+        self.tree_model.set_plan(plan)
+        self.expand_top_levels(TREE_EXPAND_DEPTH, TREE_EXPAND_MAX_ROWS)
 
         self.tree_view.resizeColumnToContents(0)
 
-    def load_nodes(self, node, parent_item):
-        # Create an item with the node type
-        node_item = QStandardItem(node['Node Type'])
-        # Additional details can be added in a similar manner
-        cost_item = QStandardItem(f"{node['Total Cost']}")
-        planned_rows_item = QStandardItem(f"{node['Plan Rows']}")
-        actual_rows_item = QStandardItem(f"{node['Actual Rows']}")
-        # width_item = QStandardItem(f"{node['Plan Width']}")
-        actual_time_item = QStandardItem(f"{node['Actual Total Time']}")
-        
-        parent_item.appendRow([node_item, cost_item, planned_rows_item, actual_rows_item, actual_time_item])
-        
-        # If this node has children (sub-plans), recursively add them
-        if 'Plans' in node:
-            for subplan in node['Plans']:
-                self.load_nodes(subplan, node_item)
-
-    def update_result_table(self, sql_query):
-        sql_query_results = query_to_dataframe(sql_query)
-
-        self.table_widget.setRowCount(sql_query_results.shape[0])
-        self.table_widget.setColumnCount(sql_query_results.shape[1])
-        self.table_widget.setHorizontalHeaderLabels(sql_query_results.columns)
-
-        for i in range(sql_query_results.shape[0]):
-            for j in range(sql_query_results.shape[1]):
-                self.table_widget.setItem(i, j, QTableWidgetItem(str(sql_query_results.iat[i, j])))
-
-        self.table_widget.resizeColumnsToContents()
-
-        self.statusBar().showMessage("Query executed successfully. Total rows: " + str(sql_query_results.shape[0]))
-
+    @traced('update_hotspot_table')
+    def update_hotspot_table(self, plan):
+        """ Lists the top nodes by exclusive time. Without ANALYZE data they are ranked by exclusive cost. """
+        self.hotspots = plan_hotspots(plan)
+        timed = any(hotspot['self_time'] is not None for hotspot in self.hotspots)
+        measure = 'self_time' if timed else 'self_cost'
+        total = sum(hotspot[measure] or 0.0 for hotspot in self.hotspots) or 1.0
+        for hotspot in self.hotspots:
+            hotspot['share'] = (hotspot[measure] or 0.0) / total
+
+        self.hotspot_label.setText("Hotspots (exclusive time):" if timed else "Hotspots (exclusive cost, no ANALYZE data):")
+        top = top_hotspots(self.hotspots)
+        self.hotspot_table.setRowCount(len(top))
+        for i, hotspot in enumerate(top):
+            node = hotspot['node']
+            self_time = hotspot['self_time']
+            error = hotspot['estimate_error']
+            self.hotspot_table.setItem(i, 0, QTableWidgetItem(node.node_type))
+            self.hotspot_table.setItem(i, 1, QTableWidgetItem(node.relation_name))
+            self.hotspot_table.setItem(i, 2, QTableWidgetItem("" if self_time is None else f"{self_time:.3f}"))
+            self.hotspot_table.setItem(i, 3, QTableWidgetItem(f"{hotspot['share'] * 100:.1f}"))
+            self.hotspot_table.setItem(i, 4, QTableWidgetItem(str(hotspot['self_read_blocks'])))
+            self.hotspot_table.setItem(i, 5, QTableWidgetItem(str(hotspot['self_hit_blocks'])))
+            self.hotspot_table.setItem(i, 6, QTableWidgetItem("" if error is None else f"{error:.1f}x"))
+            self.hotspot_table.item(i, 0).setBackground(hotspot_color(hotspot['share']))
+        self.hotspot_table.resizeColumnsToContents()
+
+    @traced('color_plan_nodes')
+    def color_plan_nodes(self):
+        """ Colors the graph nodes by their share of the plan time (see update_hotspot_table), or, while
+        comparing, the nodes that changed since the previous run of the current query. Tooltips show the
+        node's exclusive figures and its changes. """
+        if self.current_plan is None:
+            return
+        # Sampled, limited and estimated-only plans are not recorded, they would only show bogus changes
+        previous = None
+        if self.compare_checkbox.isChecked() and self.current_recorded:
+            previous = previous_plan(self.current_sql, self.current_plan)
+        diffs = {}
+        removed = 0
+        if previous is not None:
+            for old, new, status, changes in diff_plans(previous[1], self.current_plan):
+                if new is None:
+                    removed += 1
+                elif status is not None:
+                    diffs[id(new)] = (status, changes)
+
+        hotspots = {id(hotspot['node']): hotspot for hotspot in self.hotspots}
+        counts = dict.fromkeys(PLAN_DIFF_COLORS, 0)
+        for key, node, _, _, _ in self.current_layout:
+            node_graphics_item = self.graph_items[key][0]
+            status, changes = diffs.get(id(node), (None, []))
+            hotspot = hotspots.get(id(node))
+            if previous is not None:
+                node_graphics_item.set_color(PLAN_DIFF_COLORS.get(status, QColor('white')))
+            elif hotspot is not None:
+                node_graphics_item.set_color(hotspot_color(hotspot['share']))
+            else:
+                node_graphics_item.set_color(QColor('white'))
+
+            tooltip = []
+            if hotspot is not None:
+                if hotspot['self_time'] is not None:
+                    tooltip.append(f"self time {hotspot['self_time']:.3f} ms ({hotspot['share'] * 100:.1f}%)")
+                else:
+                    tooltip.append(f"self cost {hotspot['self_cost']:.2f} ({hotspot['share'] * 100:.1f}%)")
+                tooltip.append(f"self blocks read {hotspot['self_read_blocks']}, hit {hotspot['self_hit_blocks']}")
+                if hotspot['estimate_error'] is not None:
+                    tooltip.append(f"rows estimated {node.plan_rows}, actual {node.actual_rows}")
+            node_graphics_item.setToolTip("\n".join(tooltip + changes))
+            if status is not None:
+                counts[status] += 1
+
+        if previous is not None:
+            self.statusBar().showMessage(f"Compared with the run at {time.strftime('%H:%M:%S', time.localtime(previous[0]))}: "
+                                         f"{counts['regression']} regressions, {counts['improvement']} improvements, "
+                                         f"{counts['changed'] + removed} other changes ({removed} nodes removed)")
+        elif self.compare_checkbox.isChecked() and not self.current_recorded:
+            self.statusBar().showMessage("Only full analyze runs are compared, this plan is not.")
+        elif self.compare_checkbox.isChecked():
+            self.statusBar().showMessage("No earlier run of this query to compare with.")
+
+    @traced('expand_top_levels')
+    def expand_top_levels(self, max_depth, max_rows):
+        """ Expands the plan tree level by level, up to max_depth levels or until max_rows rows are shown. """
+        level = [self.tree_model.index(0, 0)]
+        shown = 1
+        for _ in range(max_depth):
+            next_level = []
+            for index in level:
+                if shown >= max_rows:
+                    return
+                if self.tree_model.canFetchMore(index):
+                    self.tree_model.fetchMore(index)
+                self.tree_view.expand(index)
+                for row in range(self.tree_model.rowCount(index)):
+                    next_level.append(self.tree_model.index(row, 0, index))
+                shown += self.tree_model.rowCount(index)
+            level = next_level
+
+    @traced('update_result_table')
+    def update_result_table(self, sql_query_results, total_rows):
+        self.result_model.set_dataframe(sql_query_results)
+
+        self.result_view.resizeColumnsToContents()
+
+        self.statusBar().showMessage("Query executed successfully. Total rows: " + str(total_rows)
+                                     + " (showing " + str(sql_query_results.shape[0]) + ")"
+                                     + f"; connection setup saved: {connection_time_saved() * 1000:.0f} ms"
+                                     + f"; plan cache: {plan_cache.hits} hits / {plan_cache.misses} misses"
+                                     + (f". {sql_query_results.attrs['note']}" if sql_query_results.attrs.get('note') else ""))
+
+    @traced('update_explain_table')
     def update_explain_table(self, plan):
-
-        plan = json.loads(plan)
-        root_plan = plan[0]["Plan"]
-        nodes = parse_plan(root_plan)
+        nodes = list(plan.walk())
+        expected_costs, _ = compute_expected_costs(flatten_plans([plan]), cost_params)
+        spills = {id(spill['node']): spill for spill in detect_spills(plan)}
 
         self.explain_table.setRowCount(len(nodes))
 
-        for i, node in enumerate(nodes):
-            expected_cost = compute_expected_cost(node, cost_params)
-
+        for i, (node, expected_cost) in enumerate(zip(nodes, expected_costs)):
             self.explain_table.setItem(i, 0, QTableWidgetItem(node['Node Type']))
             self.explain_table.setItem(i, 1, QTableWidgetItem(f"{expected_cost:.4f}"))
             self.explain_table.setItem(i, 2, QTableWidgetItem(f"{node['Total Cost']}"))
             self.explain_table.setItem(i, 3, QTableWidgetItem(f"{node['Total Cost'] - expected_cost:.4f}"))
+            spill = spills.get(id(node))
+            if spill is None:
+                for column in (4, 5, 6):
+                    self.explain_table.setItem(i, column, QTableWidgetItem(""))
+                continue
+            detail = spill['detail'] + (f" ({spill['relation']})" if spill['relation'] else "")
+            work_mem = format_work_mem(spill['work_mem_kb']) if spill['work_mem_kb'] is not None else "?"
+            for column, text in ((4, detail), (5, work_mem), (6, f"{spill['saving_ms']:.1f}")):
+                item = QTableWidgetItem(text)
+                item.setBackground(QBrush(SPILL_COLOR))
+                self.explain_table.setItem(i, column, item)
 
         self.explain_table.resizeColumnsToContents()
\ No newline at end of file
@@ -0,0 +1,39 @@
+""" Per-node figures derived from a PlanNode tree, shared by the interface, explain.py and the plan store. """
+from tracing import traced
+
+
+def estimate_error(node):
+    """ Factor between Plan Rows and Actual Rows, at least 1, or None without ANALYZE data. """
+    if node.actual_rows is None:
+        return None
+    planned, actual = max(node.plan_rows, 1), max(node.actual_rows, 1)
+    return max(planned / actual, actual / planned)
+
+
+@traced('plan_hotspots')
+def plan_hotspots(root):
+    """ Exclusive (self) figures of every node, in pre-order: a list of dicts with 'node', 'self_time' (ms
+    over all loops, None without ANALYZE data), 'self_cost', 'self_hit_blocks', 'self_read_blocks' and
+    'estimate_error' (Plan Rows vs Actual Rows factor, see estimate_error).
+    Actual Total Time is an average per loop, so it is multiplied by Actual Loops before the children are
+    subtracted. Buffer counts and costs are already totals. Values are clamped at 0, as parallel children
+    can add up to more than their parent. """
+    hotspots = []
+    for node in root.walk():
+        self_time = None
+        if node.actual_total_time is not None:
+            self_time = node.actual_total_time * (node.actual_loops or 1)
+            for child in node.children:
+                if child.actual_total_time is not None:
+                    self_time -= child.actual_total_time * (child.actual_loops or 1)
+            self_time = max(self_time, 0.0)
+        hotspots.append({
+            'node': node,
+            'self_time': self_time,
+            'self_cost': max(node.total_cost - sum(child.total_cost for child in node.children), 0.0),
+            'self_hit_blocks': max(node.shared_hit_blocks - sum(child.shared_hit_blocks for child in node.children), 0),
+            'self_read_blocks': max(node.shared_read_blocks - sum(child.shared_read_blocks for child in node.children), 0),
+            'self_written_blocks': max(node.shared_written_blocks - sum(child.shared_written_blocks for child in node.children), 0),
+            'estimate_error': estimate_error(node),
+        })
+    return hotspots
@@ -0,0 +1,208 @@
+""" Persistent plan store: every captured plan with its per-node metrics in a local SQLite file.
+
+Writes are queued and committed in batches by a background thread, so recording a plan costs a queue put
+on the calling thread. Query the store from Python with PlanStore.query_nodes, or from the command line:
+    python plan_store.py plan_history.sqlite --node-type "Seq Scan" --relation lineitem --min-time 1000 --days 7
+"""
+import argparse
+import contextlib
+import json
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+
+from plan_analysis import plan_hotspots
+from plan_traversal import walk_with_parents
+
+# Records committed per transaction by the writer thread
+PLAN_STORE_BATCH_SIZE = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    plan_id INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    query TEXT NOT NULL,
+    captured_at REAL NOT NULL,
+    settings TEXT,
+    plan BLOB NOT NULL,               -- zlib compressed EXPLAIN JSON text
+    total_cost REAL,
+    total_time REAL
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    plan_id INTEGER NOT NULL REFERENCES plans (plan_id),
+    node_index INTEGER NOT NULL,      -- pre-order position in the plan
+    parent_index INTEGER,
+    node_type TEXT NOT NULL,
+    relation_name TEXT,
+    startup_cost REAL,
+    total_cost REAL,
+    plan_rows REAL,
+    actual_rows REAL,
+    actual_loops REAL,
+    actual_total_time REAL,           -- ms over all loops
+    self_time REAL,                   -- exclusive ms over all loops
+    shared_hit_blocks INTEGER,
+    shared_read_blocks INTEGER,
+    shared_written_blocks INTEGER,
+    captured_at REAL NOT NULL,
+    PRIMARY KEY (plan_id, node_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS plans_fingerprint ON plans (fingerprint, captured_at);
+CREATE INDEX IF NOT EXISTS nodes_node_type ON nodes (node_type, actual_total_time);
+CREATE INDEX IF NOT EXISTS nodes_relation ON nodes (relation_name, node_type, actual_total_time);
+"""
+
+
+def flatten_nodes(root):
+    """ Per-node metric rows of a PlanNode tree in pre-order, as tuples in nodes table column order
+    from node_index to shared_written_blocks. Times are multiplied by loops, self times are those of
+    plan_hotspots. """
+    rows = []
+    indexes = {}  # id(node) -> its pre-order index
+    for (node, parent, _, _), hotspot in zip(walk_with_parents(root), plan_hotspots(root)):
+        index = indexes[id(node)] = len(rows)
+        parent_index = None if parent is None else indexes[id(parent)]
+        total_time = None if node.actual_total_time is None else node.actual_total_time * (node.actual_loops or 1)
+        rows.append((index, parent_index, node.node_type, node.relation_name or None, node.startup_cost,
+                     node.total_cost, node.plan_rows, node.actual_rows, node.actual_loops, total_time,
+                     hotspot['self_time'], node.shared_hit_blocks, node.shared_read_blocks, node.shared_written_blocks))
+    return rows
+
+
+class PlanStore:
+    """ SQLite backed history of plans. Does nothing until opened. """
+
+    def __init__(self, path=None):
+        self.path = None
+        self.queue = None
+        self.writer = None
+        self.errors = 0
+        if path is not None:
+            self.open(path)
+
+    def open(self, path):
+        self.close()
+        self.path = path
+        with contextlib.closing(sqlite3.connect(path)) as db:
+            db.execute("PRAGMA journal_mode = WAL;")  # Readers are not blocked by the writer thread
+            db.executescript(SCHEMA)
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, name="plan-store-writer", daemon=True)
+        self.writer.start()
+
+    def close(self):
+        """ Writes out everything still queued and stops the writer thread. """
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+            self.queue = None
+
+    def add(self, fingerprint, sql_query, plan, plan_text, settings=None):
+        """ Queues a plan (PlanNode root and the EXPLAIN JSON text it was built from) for writing. """
+        if self.queue is not None:
+            self.queue.put((fingerprint, sql_query, time.time(), plan, plan_text, settings))
+
+    def flush(self):
+        """ Blocks until every plan queued so far is written. """
+        if self.queue is not None:
+            done = threading.Event()
+            self.queue.put(done)
+            done.wait()
+
+    def _write_loop(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA synchronous = NORMAL;")  # Safe with WAL, a crash can only lose the last batches
+        try:
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < PLAN_STORE_BATCH_SIZE:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                records = [item for item in batch if isinstance(item, tuple)]
+                if records:
+                    try:
+                        with db:
+                            for record in records:
+                                self._insert(db, *record)
+                    except (sqlite3.Error, TypeError, ValueError) as error:
+                        self.errors += 1
+                        print(f"Error writing to the plan store: {error}")
+                for item in batch:
+                    if isinstance(item, threading.Event):
+                        item.set()
+                if None in batch:
+                    return
+        finally:
+            db.close()
+
+    @staticmethod
+    def _insert(db, fingerprint, sql_query, captured_at, plan, plan_text, settings):
+        nodes = flatten_nodes(plan)
+        cursor = db.execute(
+            "INSERT INTO plans (fingerprint, query, captured_at, settings, plan, total_cost, total_time) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?);",
+            (fingerprint, sql_query, captured_at, json.dumps(settings),
+             zlib.compress(plan_text.encode()), plan.total_cost, nodes[0][9]))
+        plan_id = cursor.lastrowid
+        db.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                       [(plan_id,) + row + (captured_at,) for row in nodes])
+
+    def query_nodes(self, node_type=None, relation_name=None, min_time=None, since=None, fingerprint=None,
+                    limit=1000):
+        """ Stored nodes matching every given filter, slowest first: dicts with the nodes columns plus the
+        plan's fingerprint and query. min_time is in ms (Actual Total Time over all loops), since a
+        time.time() timestamp. """
+        conditions, params = [], []
+        for column, value in (('n.node_type = ?', node_type), ('n.relation_name = ?', relation_name),
+                              ('n.actual_total_time >= ?', min_time), ('n.captured_at >= ?', since),
+                              ('p.fingerprint = ?', fingerprint)):
+            if value is not None:
+                conditions.append(column)
+                params.append(value)
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        with contextlib.closing(sqlite3.connect(self.path)) as db:
+            db.row_factory = sqlite3.Row
+            rows = db.execute(f"SELECT n.*, p.fingerprint, p.query FROM nodes n JOIN plans p USING (plan_id) {where} "
+                              f"ORDER BY n.actual_total_time DESC LIMIT ?;", params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def plan_history(self, fingerprint):
+        """ (plan_id, captured_at, total_cost, total_time) of every stored run of a query, oldest first. """
+        with contextlib.closing(sqlite3.connect(self.path)) as db:
+            return db.execute("SELECT plan_id, captured_at, total_cost, total_time FROM plans "
+                              "WHERE fingerprint = ? ORDER BY captured_at;", (fingerprint,)).fetchall()
+
+    def load_plan(self, plan_id):
+        """ The EXPLAIN JSON of a stored plan, decompressed and decoded: a list of plans, or a single plan
+        object for plans captured by auto_explain. """
+        with contextlib.closing(sqlite3.connect(self.path)) as db:
+            row = db.execute("SELECT plan FROM plans WHERE plan_id = ?;", (plan_id,)).fetchone()
+        return None if row is None else json.loads(zlib.decompress(row[0]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search the plan store for plan nodes.")
+    parser.add_argument('path', help="plan store file")
+    parser.add_argument('--node-type', help="e.g. 'Seq Scan'")
+    parser.add_argument('--relation', help="relation name, e.g. lineitem")
+    parser.add_argument('--min-time', type=float, help="minimum Actual Total Time in ms")
+    parser.add_argument('--days', type=float, help="only plans captured in the last DAYS days")
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    store = PlanStore()
+    store.path = args.path  # Read only, no writer thread needed
+    since = None if args.days is None else time.time() - args.days * 86400
+    for row in store.query_nodes(args.node_type, args.relation, args.min_time, since, limit=args.limit):
+        captured = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['captured_at']))
+        print(f"{captured}  {row['node_type']:<20} {row['relation_name'] or '':<12} "
+              f"{row['actual_total_time'] or 0:>12.3f} ms  {row['query'][:60]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+""" Iterative traversal of plan trees, shared by every plan walker. Works on PlanNode trees and on EXPLAIN
+JSON plan dicts alike, keeps its own stack instead of recursing, and visits each node exactly once, so
+arbitrarily deep plans (long Nested Loop or Append chains) are walked in O(n). """
+
+
+def plan_children(node):
+    """ Children of a PlanNode, or the 'Plans' of an EXPLAIN JSON plan dict. """
+    children = getattr(node, 'children', None)
+    if children is None:
+        children = node.get('Plans', ())
+    return children
+
+
+def preorder(root, children=plan_children):
+    """ Yields every node before its descendants, children left to right. """
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(children(node)))
+
+
+def postorder(root, children=plan_children):
+    """ Yields every node after all of its descendants, children left to right. """
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            yield node
+            continue
+        stack.append((node, True))
+        stack.extend((child, False) for child in reversed(children(node)))
+
+
+def walk_with_parents(root, children=plan_children):
+    """ Yields (node, parent, child index, depth) in pre-order. The root has parent None and index 0. """
+    stack = [(root, None, 0, 0)]
+    while stack:
+        entry = stack.pop()
+        yield entry
+        node, _, _, depth = entry
+        node_children = children(node)
+        for child_no in range(len(node_children) - 1, -1, -1):
+            stack.append((node_children[child_no], node, child_no, depth + 1))
@@ -1,14 +1,21 @@
 from PySide6.QtWidgets import QApplication
 import sys
 from interface import MainWindow, LoginWindow  # Make sure the class name and file are correctly referenced
+from explain import close_pool, plan_cache, plan_store, PLAN_CACHE_PATH, PLAN_STORE_PATH
 
 
 def main():
     """ Main function to execute the application. """
     app = QApplication(sys.argv)
+    plan_store.open(PLAN_STORE_PATH)
+    plan_cache.open_disk(PLAN_CACHE_PATH)  # Results of earlier sessions answer repeated submits
     main_window = LoginWindow()
     main_window.show()
-    sys.exit(app.exec())
+    exit_code = app.exec()
+    close_pool()  # Close pooled database connections before exiting
+    plan_cache.close()
+    plan_store.close()  # Writes out plans still queued
+    sys.exit(exit_code)
 
 
 if __name__ == '__main__':
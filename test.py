@@ -1,19 +1,12 @@
 import json
 
-# Default PostgreSQL cost settings extracted from pgAdmin4
-cost_params = {
-    'seq_page_cost': 1.0,
-    'random_page_cost': 4.0,
-    'cpu_tuple_cost': 0.01,
-    'cpu_operator_cost': 0.0025,
-    'cpu_index_tuple_cost': 0.005,
-    'cpu_hash_cost': 0.0025
-}
+from explain import cost_params
+from plan_traversal import preorder
 
 def parse_plan(plan):
     nodes = []
 
-    def recurse(node):
+    for node in preorder(plan):
         # Basic node details
         node_info = {
             'Node Type': node.get('Node Type'),
@@ -27,13 +20,7 @@ def parse_plan(plan):
             'Parent Relationship': node.get('Parent Relationship', None)
         }
         nodes.append(node_info)
-        
-        # Recursive parse subplans if they exist
-        if 'Plans' in node:
-            for subplan in node['Plans']:
-                recurse(subplan)
 
-    recurse(plan)
     return nodes
 
 def compute_expected_cost(node, params):
@@ -0,0 +1,373 @@
+""" Unit tests for the plan analysis helpers in explain.py. No database needed, run with: python -m pytest """
+import json
+import os
+
+import numpy as np
+import pytest
+
+from explain import (
+    COST_FORMULAS, PlanCache, PlanNode, align_plans, calibrate_cost_params, compute_expected_costs, cost_params,
+    cost_params_sql, detect_spills, diff_plans, expected_plan_costs, flatten_plans, format_work_mem, normalize_sql,
+    parallel_divisor, plan_hotspots, sample_query, split_statements, top_hotspots, validate_cost_model
+)
+from plan_traversal import preorder
+
+
+def plan_node(node_type, *children, **fields):
+    """ A hand-built EXPLAIN (FORMAT JSON) plan node. Keyword names stand for the JSON field names with the
+    underscores read as spaces, e.g. Actual_Total_Time. """
+    node = {'Node Type': node_type, 'Startup Cost': 0.0, 'Total Cost': 1.0, 'Plan Rows': 1, 'Plan Width': 4}
+    node.update({name.replace('_', ' '): value for name, value in fields.items()})
+    if children:
+        node['Plans'] = list(children)
+    return node
+
+
+def load_test_json():
+    """ The 'Plan' dict of the EXPLAIN ANALYZE output in test.json. """
+    with open(os.path.join(os.path.dirname(__file__), 'test.json'), 'r') as json_file:
+        return json.load(json_file)[0]['Plan']
+
+
+def load_test_plan():
+    """ The EXPLAIN ANALYZE plan in test.json as a PlanNode tree. """
+    return PlanNode(load_test_json())
+
+
+def test_normalize_sql_ignores_formatting_and_literals():
+    text, literals = normalize_sql("SELECT *\n  FROM Orders  -- recent only\nWHERE o_totalprice>1000;")
+    assert text == "select*from orders where o_totalprice>?"
+    assert literals == ('1000',)
+    assert normalize_sql("select * from orders where o_totalprice > 5")[0] == text
+    assert normalize_sql("select * from orders where o_totalprice > 5 and o_orderkey = 1")[0] != text
+
+
+def test_normalize_sql_keeps_quoted_text():
+    text, literals = normalize_sql("SELECT \"Name\" FROM t WHERE c = 'A;b'")
+    assert literals == ("'A;b'",)
+    assert '"Name"' in text and ';' not in text
+    assert normalize_sql("select \"name\" from t where c = 'x'")[0] != text
+
+
+def test_plan_cache_evicts_least_recently_used():
+    cache = PlanCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1  # b is now the least recently used
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert list(cache.entries) == ['a', 'c']
+
+
+def test_plan_cache_expires_old_entries():
+    cache = PlanCache(max_age=-1)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+    assert 'a' not in cache.entries
+    assert cache.get(None) is None
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_plan_cache_survives_reopening_its_file(tmp_path):
+    path = str(tmp_path / 'plan_cache')
+    cache = PlanCache(disk_path=path)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.invalidate('b')
+    cache.close()
+    cache = PlanCache(disk_path=path)
+    assert cache.get('a') == 1 and cache.get('b') is None
+    cache.close()
+    # Entries that expired while the file was closed are dropped on opening
+    cache = PlanCache(max_age=-1, disk_path=path)
+    assert len(cache.disk) == 0
+    cache.close()
+
+
+def test_align_plans_matches_children_by_type_and_relation():
+    old = PlanNode(plan_node('Hash Join', plan_node('Seq Scan', Relation_Name='orders'),
+                             plan_node('Hash', plan_node('Seq Scan', Relation_Name='customer'))))
+    new = PlanNode(plan_node('Hash Join', plan_node('Hash', plan_node('Index Scan', Relation_Name='customer')),
+                             plan_node('Seq Scan', Relation_Name='orders')))
+    pairs = [(old_node and old_node.node_type, new_node and new_node.node_type) for old_node, new_node in
+             align_plans(old, new)]
+    # The swapped children still pair up by signature, the changed scan falls back to position
+    assert pairs == [('Hash Join', 'Hash Join'), ('Hash', 'Hash'), ('Seq Scan', 'Index Scan'),
+                     ('Seq Scan', 'Seq Scan')]
+    assert align_plans(old, new)[-1][0].relation_name == 'orders'
+
+
+def test_align_plans_reports_added_and_removed_nodes():
+    old = PlanNode(plan_node('Sort', plan_node('Seq Scan', Relation_Name='orders')))
+    new = PlanNode(plan_node('Limit', plan_node('Sort', plan_node('Seq Scan', Relation_Name='orders'))))
+    pairs = [(old_node and old_node.node_type, new_node and new_node.node_type) for old_node, new_node in
+             align_plans(old, new)]
+    assert pairs == [('Sort', 'Limit'), ('Seq Scan', 'Sort'), (None, 'Seq Scan')]
+
+
+def test_diff_plans_flags_regressions_and_improvements():
+    old = PlanNode(plan_node('Hash Join',
+                             plan_node('Seq Scan', Relation_Name='orders', Actual_Total_Time=100.0, Actual_Rows=1000,
+                                       Plan_Rows=1000, Actual_Loops=1, Shared_Read_Blocks=5000),
+                             plan_node('Seq Scan', Relation_Name='customer', Actual_Total_Time=10.0, Actual_Rows=10,
+                                       Plan_Rows=10, Actual_Loops=1),
+                             Actual_Total_Time=200.0, Actual_Rows=10, Plan_Rows=10, Actual_Loops=1))
+    new = PlanNode(plan_node('Hash Join',
+                             plan_node('Seq Scan', Relation_Name='orders', Actual_Total_Time=20.0, Actual_Rows=1000,
+                                       Plan_Rows=1000, Actual_Loops=1, Shared_Read_Blocks=100),
+                             plan_node('Seq Scan', Relation_Name='customer', Actual_Total_Time=10.5, Actual_Rows=5000,
+                                       Plan_Rows=10, Actual_Loops=1),
+                             Actual_Total_Time=400.0, Actual_Rows=10, Plan_Rows=10, Actual_Loops=1))
+    statuses = [(new_node.relation_name, status) for _, new_node, status, _ in diff_plans(old, new)]
+    assert statuses == [('', 'regression'), ('orders', 'improvement'), ('customer', 'regression')]
+    changes = diff_plans(old, new)[2][3]
+    assert changes == ["rows estimated 10, actual 5000"]
+    assert all(status is None for _, _, status, _ in diff_plans(old, old))
+
+
+def test_plan_hotspots_subtracts_children():
+    hotspots = plan_hotspots(load_test_plan())
+    root, inner_join = hotspots[0], hotspots[1]
+    assert root['node'].node_type == 'Hash Join'
+    assert root['self_time'] == pytest.approx(23204.73 - 1170.467 - 5.652)
+    assert inner_join['self_time'] == pytest.approx(1170.467 - 206.102 - 72.451)
+    assert root['self_cost'] == pytest.approx(6755388.19 - 69252.68 - 323.0)
+    assert top_hotspots(hotspots, 1)[0] is root
+
+
+def test_plan_hotspots_multiplies_loops_and_clamps():
+    root = PlanNode(plan_node(
+        'Nested Loop',
+        plan_node('Seq Scan', Actual_Total_Time=2.0, Actual_Loops=1, Shared_Hit_Blocks=10),
+        plan_node('Index Scan', Actual_Total_Time=0.5, Actual_Loops=100, Shared_Hit_Blocks=300, Shared_Read_Blocks=7),
+        Actual_Total_Time=40.0, Actual_Loops=1, Shared_Hit_Blocks=300, Shared_Read_Blocks=7))
+    hotspots = plan_hotspots(root)
+    assert hotspots[2]['self_time'] == pytest.approx(50.0)
+    # The children add up to more than the parent, which must not go negative
+    assert hotspots[0]['self_time'] == 0.0
+    assert hotspots[0]['self_hit_blocks'] == 0 and hotspots[0]['self_read_blocks'] == 0
+    assert [hotspot['self_read_blocks'] for hotspot in hotspots] == [0, 0, 7]
+
+
+def test_plan_hotspots_without_analyze_data():
+    root = PlanNode(plan_node('Sort', plan_node('Seq Scan', Total_Cost=100.0, Plan_Rows=50), Total_Cost=130.0))
+    hotspots = plan_hotspots(root)
+    assert [hotspot['self_time'] for hotspot in hotspots] == [None, None]
+    assert [hotspot['self_cost'] for hotspot in hotspots] == [30.0, 100.0]
+    assert hotspots[1]['estimate_error'] is None
+    assert top_hotspots(hotspots, 1)[0] is hotspots[1]
+
+
+def seq_scan_plans(ms_per_block, ms_per_row):
+    """ Single Seq Scan plans whose times follow exactly from their blocks and rows. """
+    plans = []
+    for blocks, rows in [(100, 1000), (400, 200), (50, 8000), (1000, 1000), (10, 50)]:
+        plans.append(PlanNode(plan_node('Seq Scan', Relation_Name='orders', Shared_Read_Blocks=blocks, Actual_Rows=rows,
+                                        Actual_Loops=1, Actual_Total_Time=blocks * ms_per_block + rows * ms_per_row)))
+    return plans
+
+
+def test_calibrate_cost_params_recovers_exact_weights():
+    result = calibrate_cost_params(seq_scan_plans(0.002, 0.00005))
+    assert result['params'] == pytest.approx({'seq_page_cost': 1.0, 'cpu_tuple_cost': 0.025})
+    assert result['ms_per_cost_unit'] == pytest.approx(0.002)
+    assert result['rmse'] == pytest.approx(0.0, abs=1e-9)
+    assert result['nodes'] == 5
+    assert 'random_page_cost' in result['fixed'] and result['undetermined'] == []
+
+
+def test_calibrate_cost_params_leaves_out_undetermined_params():
+    # Rows cost nothing here, so cpu_tuple_cost comes out at zero
+    result = calibrate_cost_params(seq_scan_plans(0.002, 0.0))
+    assert result['undetermined'] == ['cpu_tuple_cost']
+    assert 'cpu_tuple_cost' not in result['params']
+    assert 'cpu_tuple_cost' not in cost_params_sql(result['params'])
+
+    # A Bitmap Heap Scan charges cpu_tuple_cost and cpu_operator_cost for the same rows, so only their sum is known
+    plans = [PlanNode(plan_node('Bitmap Heap Scan', Relation_Name='orders', Shared_Read_Blocks=blocks, Actual_Rows=rows,
+                                Actual_Loops=1, Actual_Total_Time=blocks * 0.004 + rows * 0.0001))
+             for blocks, rows in [(100, 1000), (400, 200), (50, 8000)]]
+    result = calibrate_cost_params(plans)
+    assert sorted(result['undetermined']) == ['cpu_operator_cost', 'cpu_tuple_cost']
+    assert result['params'] == pytest.approx({'random_page_cost': 4.0})
+    assert cost_params_sql(result['params']) == "SET random_page_cost = 4;"
+
+
+def test_calibrate_cost_params_needs_timing_data():
+    assert calibrate_cost_params([PlanNode(plan_node('Seq Scan'))]) is None
+    sql = cost_params_sql(calibrate_cost_params([load_test_plan()])['params'])
+    assert '= 0;' not in sql
+
+
+def test_split_statements_skips_quoted_semicolons():
+    script = """
+        -- nightly report; run as reporter
+        SELECT 'a;b' AS "x;y" FROM t;
+        /* ; */ UPDATE t SET c = 1 WHERE d = $$;$$;;
+        -- trailing comment only;
+        SELECT 2
+    """
+    assert split_statements(script) == [
+        "-- nightly report; run as reporter\n        SELECT 'a;b' AS \"x;y\" FROM t",
+        "/* ; */ UPDATE t SET c = 1 WHERE d = $$;$$",
+        "-- trailing comment only;\n        SELECT 2",
+    ]
+    assert split_statements("-- nothing here;\n;") == []
+
+
+def test_sample_query_samples_every_reference():
+    sql = ("SELECT extract(year FROM l_shipdate), count(*) FROM public.lineitem l JOIN orders AS o ON l_orderkey = o_orderkey "
+           "WHERE l_quantity > (SELECT avg(l_quantity) FROM lineitem) GROUP BY 1")
+    assert sample_query(sql, 'lineitem', 1) == (
+        "SELECT extract(year FROM l_shipdate), count(*) FROM public.lineitem l TABLESAMPLE SYSTEM (1) "
+        "JOIN orders AS o ON l_orderkey = o_orderkey "
+        "WHERE l_quantity > (SELECT avg(l_quantity) FROM lineitem TABLESAMPLE SYSTEM (1)) GROUP BY 1")
+    assert sample_query("SELECT * FROM orders, customer c WHERE true", 'customer', 0.5) == (
+        "SELECT * FROM orders, customer c TABLESAMPLE SYSTEM (0.5) WHERE true")
+    assert sample_query("SELECT * FROM orders", 'lineitem', 1) == "SELECT * FROM orders"
+
+
+def test_detect_spills_finds_sorts_and_hashes_on_disk():
+    scan = plan_node('Seq Scan', Relation_Name='orders', Actual_Total_Time=50.0, Actual_Loops=1)
+    sort = plan_node('Sort', scan, Sort_Method='external merge', Sort_Space_Used=3000, Sort_Space_Type='Disk',
+                     Temp_Read_Blocks=400, Temp_Written_Blocks=400, Actual_Total_Time=80.0, Actual_Loops=1)
+    hash_node = plan_node('Hash', plan_node('Seq Scan', Relation_Name='customer', Actual_Total_Time=5.0, Actual_Loops=1),
+                          Hash_Batches=4, Original_Hash_Batches=1, Peak_Memory_Usage=4096, Temp_Written_Blocks=100,
+                          Actual_Total_Time=9.0, Actual_Loops=1)
+    root = PlanNode(plan_node('Hash Join', sort, hash_node, Temp_Read_Blocks=500, Temp_Written_Blocks=500,
+                              Actual_Total_Time=200.0, Actual_Loops=1))
+    spills = {spill['node'].node_type: spill for spill in detect_spills(root)}
+    assert sorted(spills) == ['Hash', 'Hash Join', 'Sort']
+
+    assert spills['Sort']['relation'] == 'orders'
+    assert spills['Sort']['temp_blocks'] == 800
+    assert spills['Sort']['work_mem_kb'] == 6000  # Twice the space used on disk
+    assert spills['Sort']['saving_ms'] == pytest.approx(16.0)
+    assert spills['Hash']['detail'] == "4 batches (planned 1)"
+    assert spills['Hash']['work_mem_kb'] == 8192  # Peak Memory Usage of one batch, times the batches, over hash_mem_multiplier
+    assert spills['Hash']['saving_ms'] == pytest.approx(2.0)  # Bounded by the node's own time
+    # The join's own temp blocks are those it wrote for the outer side's batches
+    assert spills['Hash Join']['temp_blocks'] == 100
+    assert spills['Hash Join']['detail'] == "outer side split into 4 batches"
+
+
+def test_detect_spills_on_test_plan():
+    # The Hash over customer needed 2 batches, nothing else spilled
+    spills = detect_spills(load_test_plan())
+    assert [(spill['node'].node_type, spill['relation'], spill['detail']) for spill in spills] == [
+        ('Hash', 'customer', '2 batches')]
+    assert format_work_mem(spills[0]['work_mem_kb']) == '6MB'
+
+
+def test_detect_spills_ignores_in_memory_plans():
+    assert detect_spills(PlanNode(plan_node('Sort', Sort_Method='quicksort', Sort_Space_Used=25,
+                                            Sort_Space_Type='Memory'))) == []
+
+
+def test_format_work_mem_rounds_up_to_whole_mb():
+    assert format_work_mem(6000) == '6MB'
+    assert format_work_mem(8192) == '8MB'
+    assert format_work_mem(8193) == '9MB'
+    assert format_work_mem(1) == '1MB'
+    assert format_work_mem(0) == '1MB'
+
+
+def test_cost_formulas_charge_blocks_rows_and_sort_levels():
+    # Every formula names known parameters and a leaf with 10 own blocks and 100 rows is charged its terms
+    for node_type, (per_block, per_row, per_row_log, once) in COST_FORMULAS.items():
+        node = plan_node(node_type, Plan_Rows=100, Shared_Read_Blocks=10)
+        expected = (10 * sum(cost_params[name] for name in per_block) +
+                    100 * sum(cost_params[name] for name in per_row) +
+                    100 * np.log2(100) * sum(cost_params[name] for name in per_row_log) +
+                    sum(cost_params[name] for name in once))
+        assert expected_plan_costs(node, cost_params) == [pytest.approx(expected)], node_type
+    # Spelled out for a few: pages read in order, index entries visited, and a sort's 2 comparisons per level
+    assert expected_plan_costs(plan_node('Seq Scan', Plan_Rows=100, Shared_Hit_Blocks=10), cost_params) == [
+        pytest.approx(10 * 1.0 + 100 * 0.01)]
+    assert expected_plan_costs(plan_node('Index Scan', Plan_Rows=100, Shared_Read_Blocks=10), cost_params) == [
+        pytest.approx(10 * 4.0 + 100 * 0.005)]
+    assert expected_plan_costs(plan_node('Sort', Plan_Rows=1024, Temp_Written_Blocks=8), cost_params) == [
+        pytest.approx(8 * 1.0 + 1024 * 0.0025 + 1024 * 10 * 0.005)]
+    assert expected_plan_costs(plan_node('Hash Join', Plan_Rows=4), cost_params) == [pytest.approx(4 * 0.005)]
+    # Node types without a formula cost nothing themselves
+    assert expected_plan_costs(plan_node('Foo', Plan_Rows=100, Shared_Read_Blocks=10), cost_params) == [0]
+
+
+def test_expected_costs_only_count_own_blocks():
+    scan = plan_node('Seq Scan', Plan_Rows=100, Shared_Read_Blocks=10)
+    sort = plan_node('Sort', scan, Plan_Rows=1, Shared_Read_Blocks=10, Temp_Written_Blocks=3)
+    sort_cost, scan_cost = expected_plan_costs(sort, cost_params)
+    assert scan_cost == pytest.approx(10 * 1.0 + 100 * 0.01)
+    assert sort_cost == pytest.approx(3 * 1.0 + 0.0025 + 0.005 + scan_cost)
+
+
+def test_expected_costs_on_test_plan():
+    # test.json has no buffer counts, so every node is charged per row only
+    costs = expected_plan_costs(load_test_json(), cost_params)
+    orders, customer, supplier = 1469551 * 0.01, 150000 * 0.01, 10000 * 0.01
+    customer_hash, supplier_hash = customer + 150000 * 0.0025, supplier + 10000 * 0.0025
+    inner_join = orders + customer_hash + 1469551 * 0.005
+    assert costs == pytest.approx([inner_join + supplier_hash + 587743446 * 0.005, inner_join, orders, customer_hash,
+                                   customer, supplier_hash, supplier])
+    summary = validate_cost_model([load_test_json()])
+    assert summary['nodes'].to_dict() == {'Seq Scan': 3, 'Hash': 2, 'Hash Join': 2}
+    assert summary['modelled'].all()
+
+
+def test_expected_costs_scale_limit_children_by_fetched_share():
+    scan = plan_node('Seq Scan', Plan_Rows=1000, Startup_Cost=20.0, Total_Cost=100.0)
+    limit_cost, scan_cost = expected_plan_costs(plan_node('Limit', scan, Plan_Rows=10), cost_params)
+    assert scan_cost == pytest.approx(1000 * 0.01)
+    # The startup fifth of the scan, then 10 of its 1000 rows of the rest
+    assert limit_cost == pytest.approx(scan_cost * (0.2 + 0.8 * 10 / 1000))
+    # A limit above the rows the child returns fetches all of it
+    limit_cost, scan_cost = expected_plan_costs(plan_node('Limit', scan, Plan_Rows=5000), cost_params)
+    assert limit_cost == pytest.approx(scan_cost)
+
+
+def test_expected_costs_scale_rows_below_gather_to_launched_workers():
+    scan = plan_node('Seq Scan', Plan_Rows=100, Parallel_Aware=True)
+    gather = plan_node('Gather', scan, Plan_Rows=240, Workers_Planned=2, Workers_Launched=1)
+    gather_cost, scan_cost = expected_plan_costs(gather, cost_params)
+    # One worker and the leader do the rows planned for two workers and the leader
+    assert parallel_divisor(2) == pytest.approx(2.4) and parallel_divisor(1) == pytest.approx(1.7)
+    assert scan_cost == pytest.approx(100 * 2.4 / 1.7 * 0.01)
+    assert gather_cost == pytest.approx(1000.0 + 240 * 0.1 + scan_cost)
+    # All planned workers launched: Plan Rows are used as they are
+    gather['Workers Launched'] = 2
+    assert expected_plan_costs(gather, cost_params)[1] == pytest.approx(100 * 0.01)
+
+
+def test_expected_costs_repeat_nested_loop_inner_side():
+    outer = plan_node('Seq Scan', Plan_Rows=5)
+    inner = plan_node('Index Scan', Plan_Rows=1, Shared_Hit_Blocks=3)
+    join = plan_node('Nested Loop', outer, inner, Plan_Rows=5)
+    join_cost, outer_cost, inner_cost = expected_plan_costs(join, cost_params)
+    # Without ANALYZE the inner side runs once per estimated outer row
+    assert inner_cost == pytest.approx(3 * 4.0 + 0.005)
+    assert join_cost == pytest.approx(5 * 0.0025 + outer_cost + 5 * inner_cost)
+    # With ANALYZE the loops counted; the inner blocks are averaged over its 4 loops
+    for node, loops in ((join, 1), (outer, 1), (inner, 4)):
+        node['Actual Loops'] = loops
+    join_cost, outer_cost, inner_cost = expected_plan_costs(join, cost_params)
+    assert inner_cost == pytest.approx(3 / 4 * 4.0 + 0.005)
+    assert join_cost == pytest.approx(5 * 0.0025 + outer_cost + 4 * inner_cost)
+
+
+def test_compute_expected_costs_matches_scalar_version():
+    limited = plan_node('Limit', plan_node('Sort', plan_node('Seq Scan', Plan_Rows=1000, Shared_Read_Blocks=50),
+                                           Plan_Rows=1000, Startup_Cost=80.0, Total_Cost=90.0, Temp_Written_Blocks=4),
+                        Plan_Rows=10)
+    gathered = plan_node('Gather', plan_node('Hash Join', plan_node('Seq Scan', Plan_Rows=400, Parallel_Aware=True,
+                                                                    Shared_Hit_Blocks=30),
+                                             plan_node('Hash', plan_node('Seq Scan', Plan_Rows=50)), Plan_Rows=300),
+                         Plan_Rows=700, Workers_Planned=3, Workers_Launched=1)
+    nested = plan_node('Nested Loop', plan_node('Seq Scan', Plan_Rows=7),
+                       plan_node('Memoize', plan_node('Index Scan', Plan_Rows=2, Shared_Hit_Blocks=3)), Plan_Rows=14)
+    plans = [limited, gathered, nested, load_test_json(), plan_node('Foo', nested)]
+    expected, discrepancy = compute_expected_costs(flatten_plans(plans), cost_params)
+    scalar = [cost for plan in plans for cost in expected_plan_costs(plan, cost_params)]
+    assert expected == pytest.approx(scalar)
+    total_costs = [node['Total Cost'] for plan in plans for node in preorder(plan)]
+    assert discrepancy == pytest.approx(np.array(total_costs) - np.array(scalar))
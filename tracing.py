@@ -0,0 +1,115 @@
+import functools
+import json
+import os
+import threading
+import time
+
+# Spans are only recorded while this is True. When False, span() and @traced cost one global lookup.
+enabled = False
+
+_local = threading.local()
+
+
+class Trace:
+    """ Spans recorded for one submit. A trace can be active on several threads at once,
+    e.g. the query worker and the GUI thread rendering its result. """
+
+    def __init__(self):
+        self.events = []  # (name, start ns, end ns, thread name)
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter_ns()
+
+    def add(self, name, start, end):
+        with self.lock:
+            self.events.append((name, start, end, threading.current_thread().name))
+
+    def breakdown(self):
+        """ Returns (name, thread, start ms, duration ms) rows ordered by start time. """
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event[1])
+        return [(name, thread, (start - self.origin) / 1e6, (end - start) / 1e6) for name, start, end, thread in events]
+
+    def export_chrome_trace(self, path):
+        """ Writes the spans as Chrome trace-event JSON, viewable in chrome://tracing or Perfetto. """
+        with self.lock:
+            events = list(self.events)
+        thread_ids = {}
+        trace_events = [{
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self.origin) / 1000,
+            'dur': (end - start) / 1000,
+            'pid': os.getpid(),
+            'tid': thread_ids.setdefault(thread, len(thread_ids)),
+            'args': {'thread': thread},
+        } for name, start, end, thread in events]
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+class activate:
+    """ Makes trace the one spans are recorded into on the current thread: with activate(trace): ... """
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'trace', None)
+        _local.trace = self.trace
+        return self.trace
+
+    def __exit__(self, *exc):
+        _local.trace = self.previous
+        return False
+
+
+class _Span:
+    __slots__ = ('name', 'trace', 'start')
+
+    def __init__(self, name, trace):
+        self.name = name
+        self.trace = trace
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, self.start, time.perf_counter_ns())
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name):
+    """ Times a block into the active trace: with span('connect'): ... """
+    if not enabled:
+        return _NULL_SPAN
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(name, trace)
+
+
+def traced(name):
+    """ Decorator recording every call of a function as a span. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator